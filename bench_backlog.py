@@ -0,0 +1,98 @@
+"""
+Benchmark for a client reconnecting to a backlog of queued messages.
+
+Starts a single replica, queues the same number of messages for two users,
+and times how long each user takes to drain their backlog:
+- ListenMessages: one MessageInfo per message, archived by the server as it
+  goes, and
+- ReceiveMessages: MessageBatch frames, each acknowledged with one
+  AcknowledgeMessages call that archives the batch in bulk.
+
+Usage: python bench_backlog.py --messages 10000
+"""
+import argparse
+import os
+import sys
+import tempfile
+from multiprocessing import Process
+from time import perf_counter
+
+import grpc
+
+import chat_pb2 as pb2
+import chat_pb2_grpc as pb2_grpc
+from server import serve
+
+
+def run_server(port, workdir):
+    """Runs a lone primary replica inside workdir, without its per-message logging"""
+    os.chdir(workdir)
+    sys.stdout = open(os.devnull, 'w')
+    serve(0, [('127.0.0.1', port)])
+
+
+def fill_backlog(stub, username, messages):
+    """Queues the given number of messages for username"""
+    batch = [pb2.MessageInfo(destination=username, source='sender', text=f'message {i}') for i in range(messages)]
+    stub.SendMessages(iter(batch))
+
+
+def drain_listen(stub, username, messages):
+    """Receives the backlog through ListenMessages"""
+    received = 0
+    stream = stub.ListenMessages(pb2.Account(username=username))
+    for _ in stream:
+        received += 1
+        if received == messages:
+            break
+    stream.cancel()
+    return received
+
+
+def drain_receive(stub, username, messages):
+    """Receives the backlog through ReceiveMessages, acknowledging every batch"""
+    received = 0
+    stream = stub.ReceiveMessages(pb2.Cursor(username=username))
+    for batch in stream:
+        received += len(batch.messages)
+        stub.AcknowledgeMessages(pb2.Cursor(username=username, id=batch.messages[-1].id))
+        if received == messages:
+            break
+    stream.cancel()
+    return received
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=10000, help='size of each backlog')
+    parser.add_argument('--port', type=int, default=8700)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    server = Process(target=run_server, args=(args.port, workdir))
+    server.start()
+
+    channel = grpc.insecure_channel(f'127.0.0.1:{args.port}')
+    grpc.channel_ready_future(channel).result(timeout=10)
+    stub = pb2_grpc.ChatStub(channel)
+
+    try:
+        for username in ('sender', 'listener', 'receiver'):
+            account = pb2.Account(username=username, password='password')
+            stub.CreateAccount(account)
+            stub.Login(account)
+
+        print(f'{"rpc":<16} {"messages":>9} {"seconds":>8} {"msg/s":>9}')
+        for username, drain, rpc in (('listener', drain_listen, 'ListenMessages'), ('receiver', drain_receive, 'ReceiveMessages')):
+            fill_backlog(stub, username, args.messages)
+            start = perf_counter()
+            received = drain(stub, username, args.messages)
+            elapsed = perf_counter() - start
+            print(f'{rpc:<16} {received:>9} {elapsed:>8.2f} {received / elapsed:>9.0f}')
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == '__main__':
+    main()
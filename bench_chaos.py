@@ -0,0 +1,341 @@
+"""
+Chaos benchmark for failover under load.
+
+Starts a three-replica cluster on localhost. Several clients send numbered
+messages to one receiver in a loop, and the receiver listens with
+ListenMessages (or ReceiveMessages with --stream receive). Meanwhile the harness keeps injecting faults into a random
+replica: it either kills it and restarts it on the same database, or pauses
+it with SIGSTOP and resumes it. Only one replica is faulty at a time.
+
+For every fault the harness reports:
+- how long it took another replica to take over when the victim was the
+  primary;
+- the longest stall of any sender;
+- the longest stall of the listener.
+
+Once the cluster has healed and converged, it checks every replica's
+chat_N.db, and the stream the listener received, against the log of sent
+messages. It counts:
+- lost messages: sends the server acknowledged that are missing;
+- duplicated messages: messages stored or delivered more than once, e.g.
+  after a retried send;
+- reordered messages: messages stored or delivered after a later message of
+  the same sender;
+- unknown messages: messages that were never sent;
+- diverged messages: messages stored under a different id than on the
+  primary, or not at all.
+
+Usage: python bench_chaos.py --seconds 60 --faults kill pause --consensus
+"""
+import argparse
+import os
+import random
+import signal
+import sqlite3
+import sys
+import tempfile
+from collections import Counter
+from multiprocessing import get_context
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep
+
+import grpc
+
+import chat_pb2 as pb2
+import chat_pb2_grpc as pb2_grpc
+from client import ChatClient
+from constants import PROBE_TIMEOUT, RETRY_BACKOFF, WRITE_CONCERNS
+from server import serve
+from sharding import choose_primary
+
+RECEIVER = 'receiver'
+
+# Replicas are spawned rather than forked, since the harness restarts them after it has used gRPC itself
+spawn = get_context('spawn')
+
+
+def run_replica(i, hierarchy, workdir, settings):
+    """Runs one replica inside workdir, with its output going to a log file there"""
+    os.chdir(workdir)
+    sys.stdout = sys.stderr = open(f'replica_{i}.log', 'a', buffering=1)
+    serve(i, hierarchy, **settings)
+
+
+class Cluster:
+    """The replica processes of the cluster, which the harness kills, pauses and brings back"""
+
+    def __init__(self, hierarchy, workdir, settings):
+        self.hierarchy = hierarchy
+        self.workdir = workdir
+        self.settings = settings
+        self.processes = [None] * len(hierarchy)
+        for i in range(len(hierarchy)):
+            self.start(i)
+
+    def start(self, i):
+        """Starts replica i on the database it left behind"""
+        process = spawn.Process(target=run_replica, args=(i, self.hierarchy, self.workdir, self.settings), daemon=True)
+        process.start()
+        self.processes[i] = process
+
+    def kill(self, i):
+        """Kills replica i without giving it a chance to clean up"""
+        self.processes[i].kill()
+        self.processes[i].join()
+
+    def pause(self, i):
+        """Stops replica i, which keeps its sockets open but answers nothing"""
+        os.kill(self.processes[i].pid, signal.SIGSTOP)
+
+    def resume(self, i):
+        """Continues a paused replica i"""
+        os.kill(self.processes[i].pid, signal.SIGCONT)
+
+    def stop(self):
+        """Stops every replica"""
+        for process in self.processes:
+            process.kill()
+            process.join()
+
+
+def probe(stubs, skip=None):
+    """Returns {replica: Leader answer} of the replicas that answer a heartbeat"""
+    calls = {i: stub.Heartbeat.future(pb2.NoParam(), timeout=PROBE_TIMEOUT) for i, stub in enumerate(stubs) if i != skip}
+    answers = {}
+    for i, call in calls.items():
+        try:
+            answers[i] = call.result()
+        except grpc.RpcError:
+            pass
+    return answers
+
+
+def primary(stubs, skip=None):
+    """Returns the replica clients would pick as the primary, if it considers itself the primary, or None"""
+    answers = probe(stubs, skip)
+    if not answers:
+        return None
+    chosen = choose_primary({i: a.index for i, a in answers.items()}, {i: a.term for i, a in answers.items()})
+    return chosen if answers[chosen].index == chosen else None
+
+
+def wait_for_primary(stubs, victim, timeout):
+    """Waits until a replica other than the victim acts as the primary and returns how long that took, or None"""
+    start = perf_counter()
+    while perf_counter() - start < timeout:
+        if primary(stubs, skip=victim) is not None:
+            return perf_counter() - start
+        sleep(0.02)
+    return None
+
+
+def wait_for_convergence(stubs, timeout):
+    """Waits until every replica answers, follows the same primary and has the same last sequence number"""
+    start = perf_counter()
+    while perf_counter() - start < timeout:
+        answers = probe(stubs)
+        if len(answers) == len(stubs) and len({(a.index, a.seq) for a in answers.values()}) == 1:
+            return True
+        sleep(0.2)
+    return False
+
+
+def longest_stall(times, start, end):
+    """Returns the longest gap in the sorted times that starts in [start, end), cut off at end"""
+    stall = 0.0
+    previous = max((t for t in times if t < start), default=start)
+    for t in times:
+        if t < start:
+            continue
+        stall = max(stall, min(t, end) - previous)
+        if t >= end:
+            return stall
+        previous = t
+    return max(stall, end - previous)
+
+
+def check(messages, acked, attempted):
+    """
+    Checks (id, source, text) rows, in the order they were stored or
+    delivered, against the sent messages. Returns the counts of lost,
+    duplicated, reordered and unknown messages.
+    """
+    copies = Counter(text for _, _, text in messages)
+    lost = len(acked - copies.keys())
+    duplicated = sum(n - 1 for n in copies.values())
+    unknown = len(copies.keys() - attempted)
+
+    reordered = 0
+    latest = {}
+    for _, source, text in messages:
+        number = int(text.split()[1])
+        if number < latest.get(source, 0):
+            reordered += 1
+        latest[source] = max(latest.get(source, 0), number)
+    return lost, duplicated, reordered, unknown
+
+
+def stored_messages(path):
+    """Returns the (id, source, text) rows of every message to the receiver in a replica's database, by id"""
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        return conn.execute('''SELECT id, source, text FROM messages WHERE destination = ?
+                               UNION ALL SELECT id, source, text FROM history WHERE destination = ?
+                               ORDER BY id''', (RECEIVER, RECEIVER)).fetchall()
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=60.0, help='length of the run before the cluster heals')
+    parser.add_argument('--senders', type=int, default=4)
+    parser.add_argument('--stream', choices=['listen', 'receive'], default='listen',
+                        help='receive with ListenMessages, or with ReceiveMessages and acknowledgements')
+    parser.add_argument('--faults', nargs='+', choices=['kill', 'pause'], default=['kill', 'pause'])
+    parser.add_argument('--interval', type=float, default=6.0, help='seconds from the start of one fault to the next')
+    parser.add_argument('--downtime', type=float, default=3.0, help='seconds a replica stays killed or paused')
+    parser.add_argument('--primary-share', type=float, default=0.5, help='share of the faults that hit the primary')
+    parser.add_argument('--consensus', action='store_true', help='run the replicas in consensus mode')
+    parser.add_argument('--write-concern', choices=WRITE_CONCERNS, help="the cluster's write concern, by default the server's")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--port', type=int, default=8400)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    hierarchy = [('127.0.0.1', args.port + i) for i in range(3)]
+    workdir = tempfile.mkdtemp()
+    print(f'replica databases and logs in {workdir}')
+    settings = {'consensus': args.consensus, 'write_concern': args.write_concern, 'mode': 'thread'}
+    cluster = Cluster(hierarchy, workdir, settings)
+    channels = [grpc.insecure_channel(f'{host}:{port}') for host, port in hierarchy]
+    for channel in channels:
+        grpc.channel_ready_future(channel).result(timeout=30)
+    stubs = [pb2_grpc.ChatStub(channel) for channel in channels]
+    # Faults only tell something about failover once every replica follows the same primary
+    if not wait_for_convergence(stubs, 30.0):
+        cluster.stop()
+        sys.exit('the cluster did not converge on one primary before the faults, aborting')
+    # Give the primary time to open its replication streams
+    sleep(2)
+
+    senders = [f'sender{k}' for k in range(args.senders)]
+    setup = ChatClient('127.0.0.1', hierarchy)
+    for username in [RECEIVER] + senders:
+        setup.create_account(username, 'password')
+        setup.login(username, 'password')
+
+    lock = Lock()
+    done = Event()
+    acked, attempted = set(), set()
+    outcomes = Counter()
+    successes = {sender: [] for sender in senders}
+    received = []
+
+    def send(sender):
+        client = ChatClient('127.0.0.1', hierarchy)
+        number = 0
+        while not done.is_set():
+            number += 1
+            text = f'{sender} {number}'
+            with lock:
+                attempted.add(text)
+            try:
+                response = client.send_message(RECEIVER, sender, text)
+                outcome = 'rejected' if response.error else 'acked'
+            except grpc.RpcError:
+                outcome = 'failed'
+            with lock:
+                outcomes[outcome] += 1
+                if outcome == 'acked':
+                    acked.add(text)
+                    successes[sender].append(perf_counter())
+
+    drained = Event()
+
+    def listen():
+        # Both streams end once the receiver is logged out
+        client = ChatClient('127.0.0.1', hierarchy)
+        if args.stream == 'receive':
+            for msg in client.receive_messages(RECEIVER):
+                received.append((perf_counter(), msg.id, msg.source, msg.text))
+            return
+        while not drained.is_set():
+            stub = client.stub
+            try:
+                for msg in stub.ListenMessages(pb2.Account(username=RECEIVER)):
+                    received.append((perf_counter(), msg.id, msg.source, msg.text))
+            except grpc.RpcError:
+                pass
+            sleep(RETRY_BACKOFF)
+            client.determine_primary(stub)
+
+    threads = [Thread(target=send, args=(sender,)) for sender in senders]
+    listener = Thread(target=listen, daemon=True)
+    for th in threads + [listener]:
+        th.start()
+
+    # Inject one fault at a time, each after a healthy spell, and end on a healthy spell
+    faults = []
+    healthy = args.interval - args.downtime
+    start = perf_counter()
+    for _ in range(int((args.seconds - healthy) // args.interval)):
+        sleep(healthy)
+        leader = primary(stubs)
+        if leader is not None and rng.random() < args.primary_share:
+            victim = leader
+        else:
+            victim = rng.choice([i for i in range(len(hierarchy)) if i != leader])
+        kind = rng.choice(args.faults)
+
+        began = perf_counter()
+        cluster.kill(victim) if kind == 'kill' else cluster.pause(victim)
+        failover = wait_for_primary(stubs, victim, args.downtime) if victim == leader else None
+        sleep(max(0.0, args.downtime - (perf_counter() - began)))
+        cluster.start(victim) if kind == 'kill' else cluster.resume(victim)
+        faults.append((kind, victim, victim == leader, began, failover))
+
+    sleep(healthy)
+
+    # Stop sending and let the replicas converge and the listener catch up
+    done.set()
+    for th in threads:
+        th.join()
+    stopped = perf_counter()
+    converged = wait_for_convergence(stubs, 30.0)
+    final = primary(stubs)
+    while True:
+        count = len(received)
+        sleep(2.0)
+        if len(received) == count:
+            break
+    drained.set()
+    setup.logout(RECEIVER)
+    listener.join(timeout=10)
+
+    print(f'{outcomes["acked"]} sends acknowledged, {outcomes["rejected"]} rejected, {outcomes["failed"]} failed'
+          f' over {stopped - start:.0f} s; cluster {"converged" if converged else "did NOT converge"}')
+
+    deliveries = [t for t, _, _, _ in received]
+    for n, (kind, victim, was_primary, began, failover) in enumerate(faults):
+        until = faults[n + 1][3] if n + 1 < len(faults) else stopped
+        sends = max(longest_stall(successes[sender], began, until) for sender in senders)
+        takeover = '' if not was_primary else \
+            f', new primary after {failover * 1000:.0f} ms' if failover is not None else ', no new primary'
+        print(f'fault {n}: {kind} replica {victim}{" (primary)" if was_primary else ""} at {began - start:.1f} s{takeover},'
+              f' sends stalled {sends * 1000:.0f} ms, deliveries stalled {longest_stall(deliveries, began, until) * 1000:.0f} ms')
+    cluster.stop()
+
+    # Check what every replica stored, and what the listener got, against the sent messages
+    stored = [stored_messages(os.path.join(workdir, f'chat_{i}.db')) for i in range(len(hierarchy))]
+    reference = set(stored[final if final is not None else 0])
+    print(f'{"":>10} {"messages":>9} {"lost":>6} {"duplicated":>11} {"reordered":>10} {"unknown":>8} {"diverged":>9}')
+    for i, rows in enumerate(stored):
+        lost, duplicated, reordered, unknown = check(rows, acked, attempted)
+        print(f'{f"replica {i}":>10} {len(rows):>9} {lost:>6} {duplicated:>11} {reordered:>10} {unknown:>8} {len(reference ^ set(rows)):>9}')
+    lost, duplicated, reordered, unknown = check([(i, s, t) for _, i, s, t in received], acked, attempted)
+    print(f'{"stream":>10} {len(received):>9} {lost:>6} {duplicated:>11} {reordered:>10} {unknown:>8} {"":>9}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+"""
+Benchmark harness for a whole cluster.
+
+Starts a cluster of replicas on localhost ports, like `server.py` does, and
+drives it from a number of concurrent simulated clients. Every client owns an
+account, keeps a ListenMessages stream open for it, and then loops over
+randomly picked rpcs from the configured mix until the time is up. Messages
+go to random clients, and their delivery through ListenMessages is timed from
+the send to the receive. With --max-staleness, ListAccounts is spread over
+all replicas as a follower read, falling back to the primary when the chosen
+replica is too stale. --write-concern sets how many replicas must apply a
+write before the primary answers. --abusers adds clients that flood
+SendMessage from many threads at once, which are left out of the latencies,
+to see how they slow down everyone else, e.g. with and without --user-rate.
+
+Reports the throughput and the p50/p95/p99 latency of every rpc and saves the
+results, the configuration and the current git commit as JSON, so runs can be
+compared across commits.
+
+Usage: python bench_cluster.py --clients 20 --seconds 10 \\
+           --mix SendMessage=60 ListAccounts=20 Login=10 CreateAccount=10 \\
+           --output results.json
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from itertools import count
+from multiprocessing import Process
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep
+
+import grpc
+
+import chat_pb2 as pb2
+import chat_pb2_grpc as pb2_grpc
+from constants import GLOBAL_RATE_LIMIT, USER_RATE_LIMIT, WRITE_CONCERN, WRITE_CONCERNS
+from server import serve
+
+RPCS = ['CreateAccount', 'Login', 'SendMessage', 'ListAccounts']
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of a list of values"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run_replica(i, hierarchy, mode, write_concern, user_rate, global_rate, workdir):
+    """Runs one replica inside workdir, without its per-request logging"""
+    os.chdir(workdir)
+    sys.stdout = open(os.devnull, 'w')
+    serve(i, hierarchy, mode=mode, write_concern=write_concern, user_rate=user_rate, global_rate=global_rate)
+
+
+def git_commit():
+    """Returns the commit the benchmark runs on, or None outside a git checkout"""
+    try:
+        return subprocess.check_output(['git', '-C', os.path.dirname(os.path.abspath(__file__)), 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_mix(mix):
+    """Turns ['SendMessage=60', ...] into a {rpc: weight} dict"""
+    weights = {}
+    for item in mix:
+        rpc, _, weight = item.partition('=')
+        if rpc not in RPCS:
+            raise ValueError(f'unknown rpc {rpc!r}, pick from {", ".join(RPCS)}')
+        weights[rpc] = float(weight or 1)
+    return weights
+
+
+class Workload:
+    """Simulated clients sending a random mix of rpcs to the primary"""
+    def __init__(self, stubs, clients, weights, max_staleness=None, abusers=0, abuser_threads=8, abuse_rate=0):
+        self.stub = stubs[0]
+        self.stubs = stubs
+        self.max_staleness = max_staleness
+        self.reads = count()
+        self.usernames = [f'client{i}' for i in range(clients)]
+        self.abusers = [f'abuser{i}' for i in range(abusers)]
+        self.abuser_threads = abuser_threads
+        self.abuse_rate = abuse_rate
+        self.rpcs = list(weights)
+        self.weights = list(weights.values())
+        self.new_accounts = count()
+
+        self.lock = Lock()
+        self.latencies = {rpc: [] for rpc in self.rpcs + ['ListenMessages']}
+        self.errors = {rpc: 0 for rpc in self.latencies}
+        self.sent_at = {}
+        self.stale_reads = 0
+        self.abuse = {'sent': 0, 'throttled': 0}
+        self.stop = Event()
+
+    def record(self, rpc, latency, error=False):
+        with self.lock:
+            if error:
+                self.errors[rpc] += 1
+            else:
+                self.latencies[rpc].append(latency)
+
+    def setup(self):
+        """Creates and logs in the account of every client and abuser"""
+        for username in self.usernames + self.abusers:
+            account = pb2.Account(username=username, password='password')
+            self.stub.CreateAccount(account)
+            self.stub.Login(account)
+
+    def call(self, rpc, username):
+        """Sends one rpc on behalf of the given client"""
+        if rpc == 'CreateAccount':
+            request = pb2.Account(username=f'new{next(self.new_accounts)}', password='password')
+        elif rpc == 'Login':
+            request = pb2.Account(username=username, password='password')
+        elif rpc == 'SendMessage':
+            text = f'{username} {perf_counter()}'
+            request = pb2.MessageInfo(destination=random.choice(self.usernames), source=username, text=text)
+            with self.lock:
+                self.sent_at[text] = perf_counter()
+        else:
+            request = pb2.SearchTerm(searchterm='^client1')
+
+        start = perf_counter()
+        try:
+            if rpc == 'ListAccounts' and self.max_staleness is not None:
+                response = self.follower_read(rpc, request)
+            else:
+                response = getattr(self.stub, rpc)(request)
+            error = getattr(response, 'error', False)
+        except grpc.RpcError:
+            error = True
+        self.record(rpc, perf_counter() - start, error)
+
+    def follower_read(self, rpc, request):
+        """Sends a read to the next replica in turn, or to the primary if that one is too stale"""
+        stub = self.stubs[next(self.reads) % len(self.stubs)]
+        try:
+            return getattr(stub, rpc)(request, metadata=(('max-staleness', str(self.max_staleness)),))
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.FAILED_PRECONDITION:
+                raise
+            with self.lock:
+                self.stale_reads += 1
+            return getattr(self.stub, rpc)(request)
+
+    def client(self, username):
+        while not self.stop.is_set():
+            self.call(random.choices(self.rpcs, self.weights)[0], username)
+
+    def flood(self, username):
+        """Sends messages to random clients at the abuse rate, or as fast as the primary answers"""
+        interval = self.abuser_threads / self.abuse_rate if self.abuse_rate else 0
+        due = perf_counter()
+        while not self.stop.is_set():
+            due += interval
+            sleep(max(0.0, due - perf_counter()))
+            request = pb2.MessageInfo(destination=random.choice(self.usernames), source=username, text='spam')
+            try:
+                self.stub.SendMessage(request)
+                outcome = 'sent'
+            except grpc.RpcError as e:
+                outcome = 'throttled' if e.code() == grpc.StatusCode.RESOURCE_EXHAUSTED else None
+            if outcome:
+                with self.lock:
+                    self.abuse[outcome] += 1
+
+    def listen(self, username):
+        try:
+            for msg in self.stub.ListenMessages(pb2.Account(username=username)):
+                received = perf_counter()
+                with self.lock:
+                    sent = self.sent_at.pop(msg.text, None)
+                if sent is not None and not self.stop.is_set():
+                    self.record('ListenMessages', received - sent)
+        except grpc.RpcError:
+            pass
+
+    def run(self, seconds):
+        """Runs the workload and returns the elapsed time in seconds"""
+        for username in self.usernames:
+            Thread(target=self.listen, args=(username,), daemon=True).start()
+        sleep(1)
+
+        clients = [Thread(target=self.client, args=(username,)) for username in self.usernames]
+        clients += [Thread(target=self.flood, args=(username,)) for username in self.abusers for _ in range(self.abuser_threads)]
+        start = perf_counter()
+        for th in clients:
+            th.start()
+        sleep(seconds)
+        self.stop.set()
+        for th in clients:
+            th.join()
+        return perf_counter() - start
+
+    def results(self, elapsed):
+        """Returns per-rpc counts, throughput and latency percentiles in ms"""
+        results = {}
+        for rpc, latencies in self.latencies.items():
+            results[rpc] = {
+                'count': len(latencies),
+                'errors': self.errors[rpc],
+                'throughput': len(latencies) / elapsed,
+            }
+            for p in (50, 95, 99):
+                results[rpc][f'p{p}_ms'] = percentile(latencies, p) * 1000 if latencies else None
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--clients', type=int, default=20, help='number of concurrent simulated clients')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--mix', nargs='+', default=['SendMessage=60', 'ListAccounts=20', 'Login=10', 'CreateAccount=10'],
+                        help='rpc=weight pairs, from ' + ', '.join(RPCS))
+    parser.add_argument('--mode', choices=['aio', 'thread'], default='aio')
+    parser.add_argument('--max-staleness', type=float, help='serve ListAccounts from any replica at most this many seconds behind')
+    parser.add_argument('--write-concern', choices=WRITE_CONCERNS, default=WRITE_CONCERN)
+    parser.add_argument('--abusers', type=int, default=0, help='number of clients flooding SendMessage')
+    parser.add_argument('--abuser-threads', type=int, default=8, help='concurrent SendMessage calls of each abuser')
+    parser.add_argument('--abuse-rate', type=float, default=0, help='messages per second each abuser tries to send, 0 for as many as it can')
+    parser.add_argument('--user-rate', type=float, default=USER_RATE_LIMIT, help='messages per second each user may send, 0 for no limit')
+    parser.add_argument('--global-rate', type=float, default=GLOBAL_RATE_LIMIT, help='messages per second each replica accepts, 0 for no limit')
+    parser.add_argument('--port', type=int, default=8600)
+    parser.add_argument('--output', help='file to save the results to as JSON')
+    args = parser.parse_args()
+    try:
+        weights = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    hierarchy = [('127.0.0.1', args.port + i) for i in range(args.replicas)]
+    workdir = tempfile.mkdtemp()
+    replicas = [
+        Process(target=run_replica, args=(i, hierarchy, args.mode, args.write_concern, args.user_rate, args.global_rate, workdir))
+        for i in range(args.replicas)
+    ]
+    for replica in replicas:
+        replica.start()
+
+    try:
+        for host, port in hierarchy:
+            grpc.channel_ready_future(grpc.insecure_channel(f'{host}:{port}')).result(timeout=10)
+        sleep(2)
+
+        stubs = [pb2_grpc.ChatStub(grpc.insecure_channel(f'{host}:{port}')) for host, port in hierarchy]
+        workload = Workload(stubs, args.clients, weights, args.max_staleness, args.abusers, args.abuser_threads, args.abuse_rate)
+        workload.setup()
+        elapsed = workload.run(args.seconds)
+    finally:
+        for replica in replicas:
+            replica.terminate()
+            replica.join()
+
+    results = workload.results(elapsed)
+    total = sum(r['count'] for rpc, r in results.items() if rpc != 'ListenMessages')
+
+    print(f'{args.replicas} replicas, {args.clients} clients, {args.seconds:.0f} s ({args.mode} mode, {args.write_concern} write concern)')
+    print(f'{"rpc":<15} {"count":>7} {"errors":>7} {"ops/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for rpc, r in results.items():
+        latencies = ' '.join(f'{r[f"p{p}_ms"]:>8.2f}' if r[f'p{p}_ms'] is not None else f'{"-":>8}' for p in (50, 95, 99))
+        print(f'{rpc:<15} {r["count"]:>7} {r["errors"]:>7} {r["throughput"]:>8.0f} {latencies}')
+    print(f'total: {total / elapsed:.0f} rpcs/s')
+    if args.max_staleness is not None:
+        print(f'{workload.stale_reads} follower reads were too stale and went to the primary')
+    if args.abusers:
+        print(f'abusers: {workload.abuse["sent"]} messages sent, {workload.abuse["throttled"]} throttled')
+
+    if args.output:
+        report = {
+            'commit': git_commit(),
+            'date': datetime.now(timezone.utc).isoformat(),
+            'config': vars(args),
+            'elapsed': elapsed,
+            'throughput': total / elapsed,
+            'stale_reads': workload.stale_reads,
+            'abuse': workload.abuse,
+            'rpcs': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'results saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
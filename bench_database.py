@@ -0,0 +1,112 @@
+"""
+Benchmark for the database layer of a replica.
+
+Runs the same workload against two setups and reports operations per second:
+- legacy: one shared connection in rollback-journal mode, serialized by a
+  lock, with a commit after every statement (how ChatService used to work)
+- pool: the Database class, with a WAL connection per thread and group commit
+
+Every simulated client queues a message for a random user and then reads the
+inbox of a random user, in a loop.
+
+Usage: python bench_database.py --clients 10 50 200 --seconds 5
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep
+
+from database import Database
+
+USERS = 1000
+
+SCHEMA = [
+    'CREATE TABLE messages (id INTEGER PRIMARY KEY, source TEXT, destination TEXT, text TEXT)',
+    'CREATE INDEX messages_destination ON messages (destination, id)',
+]
+
+
+class Legacy:
+    """One shared connection that commits after every statement"""
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = Lock()
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+        self.conn.commit()
+
+    def send(self, destination):
+        with self.lock:
+            self.conn.execute('INSERT INTO messages (source, destination, text) VALUES (?, ?, ?)', ('bench', destination, 'hello'))
+            self.conn.commit()
+
+    def inbox(self, username):
+        with self.lock:
+            return self.conn.execute('SELECT id, source, text FROM messages WHERE destination = ?', (username,)).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+class Pool:
+    """The Database class used by ChatService"""
+    def __init__(self, path):
+        self.db = Database(path)
+        for statement in SCHEMA:
+            self.db.write(lambda conn: conn.execute(statement))
+
+    def send(self, destination):
+        self.db.write(lambda conn: conn.execute('INSERT INTO messages (source, destination, text) VALUES (?, ?, ?)', ('bench', destination, 'hello')))
+
+    def inbox(self, username):
+        return self.db.read().execute('SELECT id, source, text FROM messages WHERE destination = ?', (username,)).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+def run(setup, clients, seconds):
+    """Runs the workload with the given number of clients and returns operations per second"""
+    workdir = tempfile.mkdtemp()
+    backend = setup(os.path.join(workdir, 'bench.db'))
+    stop = Event()
+    counts = [0] * clients
+
+    def client(i):
+        while not stop.is_set():
+            backend.send(f'user{random.randrange(USERS)}')
+            backend.inbox(f'user{random.randrange(USERS)}')
+            counts[i] += 2
+
+    threads = [Thread(target=client, args=(i,)) for i in range(clients)]
+    start = perf_counter()
+    for th in threads:
+        th.start()
+    sleep(seconds)
+    stop.set()
+    for th in threads:
+        th.join()
+    elapsed = perf_counter() - start
+
+    backend.close()
+    return sum(counts) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+
+    print(f'{"clients":>8} {"legacy ops/s":>14} {"pool ops/s":>12} {"speedup":>8}')
+    for clients in args.clients:
+        legacy = run(Legacy, clients, args.seconds)
+        pool = run(Pool, clients, args.seconds)
+        print(f'{clients:>8} {legacy:>14.0f} {pool:>12.0f} {pool / legacy:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
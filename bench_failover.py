@@ -0,0 +1,94 @@
+"""
+Benchmark for client-visible failover time.
+
+Starts a three-replica cluster on localhost, has a ChatClient send messages
+in a tight loop, kills the primary in the middle of the storm and reports how
+long the client could not send (the longest gap between two successful
+sends) and whether any send failed outright.
+
+Usage: python bench_failover.py --trials 3
+"""
+import argparse
+import os
+import tempfile
+from multiprocessing import Process
+from threading import Event, Thread
+from time import perf_counter, sleep
+
+import grpc
+
+from client import ChatClient
+from server import serve
+
+
+def run_replica(i, hierarchy, workdir):
+    """Runs one replica inside workdir"""
+    os.chdir(workdir)
+    serve(i, hierarchy)
+
+
+def trial(base_port, seconds):
+    """Runs one failover and returns (longest stall in seconds, sends, failed sends)"""
+    hierarchy = [('127.0.0.1', base_port + i) for i in range(3)]
+    workdir = tempfile.mkdtemp()
+    replicas = [Process(target=run_replica, args=(i, hierarchy, workdir)) for i in range(3)]
+    for replica in replicas:
+        replica.start()
+
+    for host, port in hierarchy:
+        grpc.channel_ready_future(grpc.insecure_channel(f'{host}:{port}')).result(timeout=10)
+    sleep(2)
+
+    client = ChatClient('127.0.0.1', hierarchy)
+    for username in ('sender', 'receiver'):
+        client.create_account(username, 'password')
+    client.login('sender', 'password')
+
+    stop = Event()
+    successes = []
+    failures = []
+
+    def storm():
+        while not stop.is_set():
+            try:
+                client.send_message('receiver', 'sender', 'hello')
+                successes.append(perf_counter())
+            except grpc.RpcError:
+                failures.append(perf_counter())
+
+    sender = Thread(target=storm)
+    sender.start()
+    sleep(seconds / 2)
+    # Claims go by term, so the primary is not necessarily replica 0
+    killed = perf_counter()
+    replicas[client.primary_index].terminate()
+    sleep(seconds / 2)
+    stop.set()
+    sender.join()
+
+    for replica in replicas:
+        replica.terminate()
+        replica.join()
+
+    # A send in flight may still succeed right after the kill, so the stall is the longest gap from there on
+    gaps = [after - before for before, after in zip(successes, successes[1:]) if after > killed]
+    return max(gaps), len(successes), len(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, default=3)
+    parser.add_argument('--seconds', type=float, default=6.0, help='length of each send storm')
+    parser.add_argument('--port', type=int, default=8300)
+    args = parser.parse_args()
+
+    stalls = []
+    for i in range(args.trials):
+        stall, sends, failed = trial(args.port + 10 * i, args.seconds)
+        stalls.append(stall)
+        print(f'trial {i}: client stalled {stall * 1000:.0f} ms, {sends} sends, {failed} failed')
+    print(f'mean failover time: {sum(stalls) / len(stalls) * 1000:.0f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Benchmark for idle ListenMessages streams.
+
+Starts a single replica, logs in a number of users that all keep a
+ListenMessages stream open, and reports:
+- the CPU used by the server process per idle listener, and
+- the send-to-receive latency of messages sent to random listeners.
+
+The thread mode needs a worker thread per stream, the aio mode serves every
+stream from the event loop with the default pool of worker threads.
+
+Usage: python bench_listeners.py --users 1000 --messages 2000 --mode aio
+"""
+import argparse
+import os
+import random
+import tempfile
+from multiprocessing import Process
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep
+
+import grpc
+import psutil
+
+import chat_pb2 as pb2
+import chat_pb2_grpc as pb2_grpc
+from constants import MAX_WORKERS
+from server import serve
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of a list of values"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run_server(port, max_workers, mode, workdir):
+    """Runs a lone primary replica inside workdir"""
+    os.chdir(workdir)
+    serve(0, [('127.0.0.1', port)], max_workers=max_workers, mode=mode)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000, help='number of connected listeners')
+    parser.add_argument('--messages', type=int, default=2000, help='number of messages to send')
+    parser.add_argument('--idle-seconds', type=float, default=5.0, help='length of the idle CPU measurement')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--mode', choices=['aio', 'thread'], default='aio')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    max_workers = args.users + 16 if args.mode == 'thread' else MAX_WORKERS
+    server = Process(target=run_server, args=(args.port, max_workers, args.mode, workdir))
+    server.start()
+
+    channel = grpc.insecure_channel(f'127.0.0.1:{args.port}')
+    grpc.channel_ready_future(channel).result(timeout=10)
+    stub = pb2_grpc.ChatStub(channel)
+
+    # Create and log in every user
+    usernames = [f'user{i}' for i in range(args.users)]
+    for username in usernames:
+        account = pb2.Account(username=username, password='password')
+        stub.CreateAccount(account)
+        stub.Login(account)
+
+    # Open one listener stream per user
+    sent_at = {}
+    latencies = []
+    lock = Lock()
+    done = Event()
+
+    def listen(username):
+        for msg in stub.ListenMessages(pb2.Account(username=username)):
+            received = perf_counter()
+            with lock:
+                latencies.append(received - sent_at[msg.text])
+                if len(latencies) == args.messages:
+                    done.set()
+
+    listeners = [Thread(target=listen, args=(username,), daemon=True) for username in usernames]
+    for th in listeners:
+        th.start()
+
+    # Let every stream reach its idle state before measuring
+    sleep(2)
+    process = psutil.Process(server.pid)
+    before = process.cpu_times()
+    sleep(args.idle_seconds)
+    after = process.cpu_times()
+    cpu = (after.user - before.user) + (after.system - before.system)
+
+    print(f'{args.users} idle listeners ({args.mode} mode)')
+    print(f'  server CPU: {cpu / args.idle_seconds * 100:.2f}% of a core')
+    print(f'  per listener: {cpu / args.idle_seconds / args.users * 1e6:.1f} us of CPU per second')
+
+    # Send messages to random listeners and time their delivery
+    source = usernames[0]
+    for i in range(args.messages):
+        text = str(i)
+        with lock:
+            sent_at[text] = perf_counter()
+        stub.SendMessage(pb2.MessageInfo(destination=random.choice(usernames), source=source, text=text))
+    done.wait(timeout=60)
+
+    print(f'{len(latencies)} of {args.messages} messages delivered')
+    if latencies:
+        print(f'  p50 latency: {percentile(latencies, 50) * 1000:.2f} ms')
+        print(f'  p99 latency: {percentile(latencies, 99) * 1000:.2f} ms')
+
+    server.terminate()
+    server.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark for the storage engines of a replica.
+
+Runs the same workload against every engine in storage.STORAGE_ENGINES
+through the Storage interface ChatService uses, and reports operations per
+second and the p50/p99 latency of each operation. Every simulated client
+loops over the message path: it logs and queues a message for a random user
+in one write, reads that user's queue, acknowledges it in a second write and
+reads a page of a random conversation.
+
+Usage: python bench_storage.py --clients 1 10 50 --seconds 5
+"""
+import argparse
+import os
+import random
+import tempfile
+from itertools import count
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep
+
+from storage import STORAGE_ENGINES
+
+USERS = 1000
+OPERATIONS = ['queue', 'read', 'acknowledge', 'history']
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of a list of values"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def run(engine, clients, seconds):
+    """Runs the workload with the given number of clients and returns operations per second and latencies"""
+    workdir = tempfile.mkdtemp()
+    store = engine(os.path.join(workdir, 'bench' + engine.suffix))
+    store.write(lambda tx: [store.add_account(tx, f'user{i}', 'pw') for i in range(USERS)])
+
+    ids = count(1)
+    lock = Lock()
+    stop = Event()
+    latencies = {operation: [] for operation in OPERATIONS}
+
+    def timed(operation, fn):
+        start = perf_counter()
+        result = fn()
+        with lock:
+            latencies[operation].append(perf_counter() - start)
+        return result
+
+    def queue(tx, seq, source, destination):
+        store.log_operation(tx, seq, 'SendMessage', b'', 0)
+        store.queue_messages(tx, [(seq, source, destination, 'hello')])
+
+    def client():
+        while not stop.is_set():
+            seq = next(ids)
+            source, destination = f'user{random.randrange(USERS)}', f'user{random.randrange(USERS)}'
+            timed('queue', lambda: store.write(lambda tx: queue(tx, seq, source, destination)))
+            rows = timed('read', lambda: store.queued_messages(destination))
+            if rows:
+                timed('acknowledge', lambda: store.write(lambda tx: store.acknowledge_messages(tx, destination, rows[-1][0])))
+            timed('history', lambda: store.conversation(source, destination, 1 << 62, 50))
+
+    threads = [Thread(target=client) for _ in range(clients)]
+    start = perf_counter()
+    for th in threads:
+        th.start()
+    sleep(seconds)
+    stop.set()
+    for th in threads:
+        th.join()
+    elapsed = perf_counter() - start
+
+    store.close()
+    return sum(len(l) for l in latencies.values()) / elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--engines', nargs='+', choices=STORAGE_ENGINES, default=list(STORAGE_ENGINES))
+    args = parser.parse_args()
+
+    print(f'{"engine":>8} {"clients":>8} {"ops/s":>8} ' + ' '.join(f'{o + " p50/p99 ms":>24}' for o in OPERATIONS))
+    for clients in args.clients:
+        for name in args.engines:
+            throughput, latencies = run(STORAGE_ENGINES[name], clients, args.seconds)
+            cells = ' '.join(
+                f'{percentile(latencies[o], 50) * 1000:>15.2f}/{percentile(latencies[o], 99) * 1000:>8.2f}' for o in OPERATIONS
+            )
+            print(f'{name:>8} {clients:>8} {throughput:>8.0f} {cells}')
+
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,7 @@ from google.protobuf import symbol_database as _symbol_database
 _sym_db = _symbol_database.Default()
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nchat.proto\"\t\n\x07NoParam\"-\n\x07\x41\x63\x63ount\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\"\x1d\n\x08\x41\x63\x63ounts\x12\x11\n\tusernames\x18\x01 \x01(\t\"0\n\x0eServerResponse\x12\x0f\n\x07message\x18\x01 \x01(\t\x12\r\n\x05\x65rror\x18\x02 \x01(\x08\"@\n\x0bMessageInfo\x12\x13\n\x0b\x64\x65stination\x18\x01 \x01(\t\x12\x0e\n\x06source\x18\x02 \x01(\t\x12\x0c\n\x04text\x18\x03 \x01(\t\" \n\nSearchTerm\x12\x12\n\nsearchterm\x18\x01 \x01(\t2\xda\x02\n\x04\x43hat\x12,\n\rCreateAccount\x12\x08.Account\x1a\x0f.ServerResponse\"\x00\x12,\n\rDeleteAccount\x12\x08.Account\x1a\x0f.ServerResponse\"\x00\x12$\n\x05Login\x12\x08.Account\x1a\x0f.ServerResponse\"\x00\x12%\n\x06Logout\x12\x08.Account\x1a\x0f.ServerResponse\"\x00\x12(\n\x0cListAccounts\x12\x0b.SearchTerm\x1a\t.Accounts\"\x00\x12.\n\x0bSendMessage\x12\x0c.MessageInfo\x1a\x0f.ServerResponse\"\x00\x12,\n\x0eListenMessages\x12\x08.Account\x1a\x0c.MessageInfo\"\x00\x30\x01\x12!\n\tHeartbeat\x12\x08.NoParam\x1a\x08.NoParam\"\x00\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nchat.proto\"\t\n\x07NoParam\"\x17\n\x07Metrics\x12\x0c\n\x04text\x18\x01 \x01(\t\"2\n\x06Leader\x12\r\n\x05index\x18\x01 \x01(\x05\x12\x0b\n\x03seq\x18\x02 \x01(\x03\x12\x0c\n\x04term\x18\x03 \x01(\x03\"Q\n\tCandidacy\x12\x0c\n\x04term\x18\x01 \x01(\x03\x12\x11\n\tcandidate\x18\x02 \x01(\x05\x12\x11\n\tlast_term\x18\x03 \x01(\x03\x12\x10\n\x08last_seq\x18\x04 \x01(\x03\"2\n\x05Lease\x12\x0c\n\x04term\x18\x01 \x01(\x03\x12\x0e\n\x06leader\x18\x02 \x01(\x05\x12\x0b\n\x03seq\x18\x03 \x01(\x03\"&\n\x05Grant\x12\x0c\n\x04term\x18\x01 \x01(\x03\x12\x0f\n\x07granted\x18\x02 \x01(\x08\"-\n\x07\x41\x63\x63ount\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\"?\n\x08\x41\x63\x63ounts\x12\x11\n\tusernames\x18\x01 \x01(\t\x12\x10\n\x08\x61\x63\x63ounts\x18\x02 \x03(\t\x12\x0e\n\x06\x63ursor\x18\x03 \x01(\t\"0\n\x0eServerResponse\x12\x0f\n\x07message\x18\x01 \x01(\t\x12\r\n\x05\x65rror\x18\x02 \x01(\x08\"`\n\x0bMessageInfo\x12\x13\n\x0b\x64\x65stination\x18\x01 \x01(\t\x12\x0e\n\x06source\x18\x02 \x01(\t\x12\x0c\n\x04text\x18\x03 \x01(\t\x12\n\n\x02id\x18\x04 \x01(\x03\x12\x12\n\nrequest_id\x18\x05 \x01(\t\"?\n\nSearchTerm\x12\x12\n\nsearchterm\x18\x01 \x01(\t\x12\x0e\n\x06\x63ursor\x18\x02 \x01(\t\x12\r\n\x05limit\x18\x03 \x01(\x05\".\n\x0cMessageBatch\x12\x1e\n\x08messages\x18\x01 \x03(\x0b\x32\x0c.MessageInfo\"&\n\x06\x43ursor\x12\x10\n\x08username\x18\x01 \x01(\t\x12\n\n\x02id\x18\x02 \x01(\x03\"P\n\x0cHistoryQuery\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x0c\n\x04peer\x18\x02 \x01(\t\x12\x11\n\tbefore_id\x18\x03 \x01(\x03\x12\r\n\x05limit\x18\x04 \x01(\x05\"<\n\x07History\x12\x1e\n\x08messages\x18\x01 \x03(\x0b\x32\x0c.MessageInfo\x12\x11\n\tbefore_id\x18\x02 \x01(\x03\"\x8f\x01\n\x0b\x41\x63\x63ountData\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\x12\x0e\n\x06status\x18\x03 \x01(\x05\x12\x1e\n\x08messages\x18\x04 \x03(\x0b\x32\x0c.MessageInfo\x12\x1d\n\x07history\x18\x05 \x03(\x0b\x32\x0c.MessageInfo\x12\r\n\x05\x66ound\x18\x06 \x01(\x08\"\x19\n\x05Shard\x12\x10\n\x08replicas\x18\x01 \x03(\t\"8\n\x04Ring\x12\x16\n\x06shards\x18\x01 \x03(\x0b\x32\x06.Shard\x12\x18\n\x08previous\x18\x02 \x03(\x0b\x32\x06.Shard\"\x1a\n\x0bLogPosition\x12\x0b\n\x03seq\x18\x01 \x01(\x03\"F\n\x08LogEntry\x12\x0b\n\x03seq\x18\x01 \x01(\x03\x12\x0e\n\x06method\x18\x02 \x01(\t\x12\x0f\n\x07payload\x18\x03 \x01(\x0c\x12\x0c\n\x04term\x18\x04 \x01(\x03\"&\n\x08LogBatch\x12\x1a\n\x07\x65ntries\x18\x01 \x03(\x0b\x32\t.LogEntry\"8\n\rSnapshotChunk\x12\x0c\n\x04\x64\x61ta\x18\x01 \x01(\x0c\x12\x0b\n\x03seq\x18\x02 \x01(\x03\x12\x0c\n\x04size\x18\x03 \x01(\x03\x32\xd5\x07\n\x04\x43hat\x12,\n\rCreateAccount\x12\x08.Account\x1a\x0f.ServerResponse\"\x00\x12,\n\rDeleteAccount\x12\x08.Account\x1a\x0f.ServerResponse\"\x00\x12$\n\x05Login\x12\x08.Account\x1a\x0f.ServerResponse\"\x00\x12%\n\x06Logout\x12\x08.Account\x1a\x0f.ServerResponse\"\x00\x12(\n\x0cListAccounts\x12\x0b.SearchTerm\x1a\t.Accounts\"\x00\x12.\n\x0bSendMessage\x12\x0c.MessageInfo\x1a\x0f.ServerResponse\"\x00\x12\x31\n\x0cSendMessages\x12\x0c.MessageInfo\x1a\x0f.ServerResponse\"\x00(\x01\x12,\n\x0eListenMessages\x12\x08.Account\x1a\x0c.MessageInfo\"\x00\x30\x01\x12-\n\x0fReceiveMessages\x12\x07.Cursor\x1a\r.MessageBatch\"\x00\x30\x01\x12\x31\n\x13\x41\x63knowledgeMessages\x12\x07.Cursor\x1a\x0f.ServerResponse\"\x00\x12\'\n\nGetHistory\x12\r.HistoryQuery\x1a\x08.History\"\x00\x12\x31\n\x0e\x44\x65liverMessage\x12\x0c.MessageInfo\x1a\x0f.ServerResponse\"\x00\x12\x30\n\rImportAccount\x12\x0c.AccountData\x1a\x0f.ServerResponse\"\x00\x12*\n\x0eReleaseAccount\x12\x08.Account\x1a\x0c.AccountData\"\x00\x12\x1c\n\x07SetRing\x12\x05.Ring\x1a\x08.NoParam\"\x00\x12\x1d\n\x05Stats\x12\x08.NoParam\x1a\x08.Metrics\"\x00\x12 \n\tHeartbeat\x12\x08.NoParam\x1a\x07.Leader\"\x00\x12%\n\x0e\x41nnounceLeader\x12\x07.Leader\x1a\x08.NoParam\"\x00\x12#\n\x0bRequestVote\x12\n.Candidacy\x1a\x06.Grant\"\x00\x12\x1e\n\nRenewLease\x12\x06.Lease\x1a\x06.Grant\"\x00\x12&\n\x07\x43\x61tchUp\x12\x0c.LogPosition\x1a\t.LogEntry\"\x00\x30\x01\x12*\n\tReplicate\x12\t.LogBatch\x1a\x0c.LogPosition\"\x00(\x01\x30\x01\x12.\n\x0eStreamSnapshot\x12\x08.NoParam\x1a\x0e.SnapshotChunk\"\x00\x30\x01\x62\x06proto3')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'chat_pb2', globals())
@@ -20,16 +20,48 @@ if _descriptor._USE_C_DESCRIPTORS == False:
   DESCRIPTOR._options = None
   _NOPARAM._serialized_start=14
   _NOPARAM._serialized_end=23
-  _ACCOUNT._serialized_start=25
-  _ACCOUNT._serialized_end=70
-  _ACCOUNTS._serialized_start=72
-  _ACCOUNTS._serialized_end=101
-  _SERVERRESPONSE._serialized_start=103
-  _SERVERRESPONSE._serialized_end=151
-  _MESSAGEINFO._serialized_start=153
-  _MESSAGEINFO._serialized_end=217
-  _SEARCHTERM._serialized_start=219
-  _SEARCHTERM._serialized_end=251
-  _CHAT._serialized_start=254
-  _CHAT._serialized_end=600
+  _METRICS._serialized_start=25
+  _METRICS._serialized_end=48
+  _LEADER._serialized_start=50
+  _LEADER._serialized_end=100
+  _CANDIDACY._serialized_start=102
+  _CANDIDACY._serialized_end=183
+  _LEASE._serialized_start=185
+  _LEASE._serialized_end=235
+  _GRANT._serialized_start=237
+  _GRANT._serialized_end=275
+  _ACCOUNT._serialized_start=277
+  _ACCOUNT._serialized_end=322
+  _ACCOUNTS._serialized_start=324
+  _ACCOUNTS._serialized_end=387
+  _SERVERRESPONSE._serialized_start=389
+  _SERVERRESPONSE._serialized_end=437
+  _MESSAGEINFO._serialized_start=439
+  _MESSAGEINFO._serialized_end=535
+  _SEARCHTERM._serialized_start=537
+  _SEARCHTERM._serialized_end=600
+  _MESSAGEBATCH._serialized_start=602
+  _MESSAGEBATCH._serialized_end=648
+  _CURSOR._serialized_start=650
+  _CURSOR._serialized_end=688
+  _HISTORYQUERY._serialized_start=690
+  _HISTORYQUERY._serialized_end=770
+  _HISTORY._serialized_start=772
+  _HISTORY._serialized_end=832
+  _ACCOUNTDATA._serialized_start=835
+  _ACCOUNTDATA._serialized_end=978
+  _SHARD._serialized_start=980
+  _SHARD._serialized_end=1005
+  _RING._serialized_start=1007
+  _RING._serialized_end=1063
+  _LOGPOSITION._serialized_start=1065
+  _LOGPOSITION._serialized_end=1091
+  _LOGENTRY._serialized_start=1093
+  _LOGENTRY._serialized_end=1163
+  _LOGBATCH._serialized_start=1165
+  _LOGBATCH._serialized_end=1203
+  _SNAPSHOTCHUNK._serialized_start=1205
+  _SNAPSHOTCHUNK._serialized_end=1261
+  _CHAT._serialized_start=1264
+  _CHAT._serialized_end=2245
 # @@protoc_insertion_point(module_scope)
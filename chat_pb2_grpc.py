@@ -44,16 +44,91 @@ class ChatStub(object):
                 request_serializer=chat__pb2.MessageInfo.SerializeToString,
                 response_deserializer=chat__pb2.ServerResponse.FromString,
                 )
+        self.SendMessages = channel.stream_unary(
+                '/Chat/SendMessages',
+                request_serializer=chat__pb2.MessageInfo.SerializeToString,
+                response_deserializer=chat__pb2.ServerResponse.FromString,
+                )
         self.ListenMessages = channel.unary_stream(
                 '/Chat/ListenMessages',
                 request_serializer=chat__pb2.Account.SerializeToString,
                 response_deserializer=chat__pb2.MessageInfo.FromString,
                 )
+        self.ReceiveMessages = channel.unary_stream(
+                '/Chat/ReceiveMessages',
+                request_serializer=chat__pb2.Cursor.SerializeToString,
+                response_deserializer=chat__pb2.MessageBatch.FromString,
+                )
+        self.AcknowledgeMessages = channel.unary_unary(
+                '/Chat/AcknowledgeMessages',
+                request_serializer=chat__pb2.Cursor.SerializeToString,
+                response_deserializer=chat__pb2.ServerResponse.FromString,
+                )
+        self.GetHistory = channel.unary_unary(
+                '/Chat/GetHistory',
+                request_serializer=chat__pb2.HistoryQuery.SerializeToString,
+                response_deserializer=chat__pb2.History.FromString,
+                )
+        self.DeliverMessage = channel.unary_unary(
+                '/Chat/DeliverMessage',
+                request_serializer=chat__pb2.MessageInfo.SerializeToString,
+                response_deserializer=chat__pb2.ServerResponse.FromString,
+                )
+        self.ImportAccount = channel.unary_unary(
+                '/Chat/ImportAccount',
+                request_serializer=chat__pb2.AccountData.SerializeToString,
+                response_deserializer=chat__pb2.ServerResponse.FromString,
+                )
+        self.ReleaseAccount = channel.unary_unary(
+                '/Chat/ReleaseAccount',
+                request_serializer=chat__pb2.Account.SerializeToString,
+                response_deserializer=chat__pb2.AccountData.FromString,
+                )
+        self.SetRing = channel.unary_unary(
+                '/Chat/SetRing',
+                request_serializer=chat__pb2.Ring.SerializeToString,
+                response_deserializer=chat__pb2.NoParam.FromString,
+                )
+        self.Stats = channel.unary_unary(
+                '/Chat/Stats',
+                request_serializer=chat__pb2.NoParam.SerializeToString,
+                response_deserializer=chat__pb2.Metrics.FromString,
+                )
         self.Heartbeat = channel.unary_unary(
                 '/Chat/Heartbeat',
                 request_serializer=chat__pb2.NoParam.SerializeToString,
+                response_deserializer=chat__pb2.Leader.FromString,
+                )
+        self.AnnounceLeader = channel.unary_unary(
+                '/Chat/AnnounceLeader',
+                request_serializer=chat__pb2.Leader.SerializeToString,
                 response_deserializer=chat__pb2.NoParam.FromString,
                 )
+        self.RequestVote = channel.unary_unary(
+                '/Chat/RequestVote',
+                request_serializer=chat__pb2.Candidacy.SerializeToString,
+                response_deserializer=chat__pb2.Grant.FromString,
+                )
+        self.RenewLease = channel.unary_unary(
+                '/Chat/RenewLease',
+                request_serializer=chat__pb2.Lease.SerializeToString,
+                response_deserializer=chat__pb2.Grant.FromString,
+                )
+        self.CatchUp = channel.unary_stream(
+                '/Chat/CatchUp',
+                request_serializer=chat__pb2.LogPosition.SerializeToString,
+                response_deserializer=chat__pb2.LogEntry.FromString,
+                )
+        self.Replicate = channel.stream_stream(
+                '/Chat/Replicate',
+                request_serializer=chat__pb2.LogBatch.SerializeToString,
+                response_deserializer=chat__pb2.LogPosition.FromString,
+                )
+        self.StreamSnapshot = channel.unary_stream(
+                '/Chat/StreamSnapshot',
+                request_serializer=chat__pb2.NoParam.SerializeToString,
+                response_deserializer=chat__pb2.SnapshotChunk.FromString,
+                )
 
 
 class ChatServicer(object):
@@ -95,18 +170,108 @@ class ChatServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def SendMessages(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def ListenMessages(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def ReceiveMessages(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def AcknowledgeMessages(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def GetHistory(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def DeliverMessage(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def ImportAccount(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def ReleaseAccount(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def SetRing(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Stats(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def Heartbeat(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def AnnounceLeader(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def RequestVote(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def RenewLease(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def CatchUp(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Replicate(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def StreamSnapshot(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_ChatServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -140,16 +305,91 @@ def add_ChatServicer_to_server(servicer, server):
                     request_deserializer=chat__pb2.MessageInfo.FromString,
                     response_serializer=chat__pb2.ServerResponse.SerializeToString,
             ),
+            'SendMessages': grpc.stream_unary_rpc_method_handler(
+                    servicer.SendMessages,
+                    request_deserializer=chat__pb2.MessageInfo.FromString,
+                    response_serializer=chat__pb2.ServerResponse.SerializeToString,
+            ),
             'ListenMessages': grpc.unary_stream_rpc_method_handler(
                     servicer.ListenMessages,
                     request_deserializer=chat__pb2.Account.FromString,
                     response_serializer=chat__pb2.MessageInfo.SerializeToString,
             ),
+            'ReceiveMessages': grpc.unary_stream_rpc_method_handler(
+                    servicer.ReceiveMessages,
+                    request_deserializer=chat__pb2.Cursor.FromString,
+                    response_serializer=chat__pb2.MessageBatch.SerializeToString,
+            ),
+            'AcknowledgeMessages': grpc.unary_unary_rpc_method_handler(
+                    servicer.AcknowledgeMessages,
+                    request_deserializer=chat__pb2.Cursor.FromString,
+                    response_serializer=chat__pb2.ServerResponse.SerializeToString,
+            ),
+            'GetHistory': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetHistory,
+                    request_deserializer=chat__pb2.HistoryQuery.FromString,
+                    response_serializer=chat__pb2.History.SerializeToString,
+            ),
+            'DeliverMessage': grpc.unary_unary_rpc_method_handler(
+                    servicer.DeliverMessage,
+                    request_deserializer=chat__pb2.MessageInfo.FromString,
+                    response_serializer=chat__pb2.ServerResponse.SerializeToString,
+            ),
+            'ImportAccount': grpc.unary_unary_rpc_method_handler(
+                    servicer.ImportAccount,
+                    request_deserializer=chat__pb2.AccountData.FromString,
+                    response_serializer=chat__pb2.ServerResponse.SerializeToString,
+            ),
+            'ReleaseAccount': grpc.unary_unary_rpc_method_handler(
+                    servicer.ReleaseAccount,
+                    request_deserializer=chat__pb2.Account.FromString,
+                    response_serializer=chat__pb2.AccountData.SerializeToString,
+            ),
+            'SetRing': grpc.unary_unary_rpc_method_handler(
+                    servicer.SetRing,
+                    request_deserializer=chat__pb2.Ring.FromString,
+                    response_serializer=chat__pb2.NoParam.SerializeToString,
+            ),
+            'Stats': grpc.unary_unary_rpc_method_handler(
+                    servicer.Stats,
+                    request_deserializer=chat__pb2.NoParam.FromString,
+                    response_serializer=chat__pb2.Metrics.SerializeToString,
+            ),
             'Heartbeat': grpc.unary_unary_rpc_method_handler(
                     servicer.Heartbeat,
                     request_deserializer=chat__pb2.NoParam.FromString,
+                    response_serializer=chat__pb2.Leader.SerializeToString,
+            ),
+            'AnnounceLeader': grpc.unary_unary_rpc_method_handler(
+                    servicer.AnnounceLeader,
+                    request_deserializer=chat__pb2.Leader.FromString,
                     response_serializer=chat__pb2.NoParam.SerializeToString,
             ),
+            'RequestVote': grpc.unary_unary_rpc_method_handler(
+                    servicer.RequestVote,
+                    request_deserializer=chat__pb2.Candidacy.FromString,
+                    response_serializer=chat__pb2.Grant.SerializeToString,
+            ),
+            'RenewLease': grpc.unary_unary_rpc_method_handler(
+                    servicer.RenewLease,
+                    request_deserializer=chat__pb2.Lease.FromString,
+                    response_serializer=chat__pb2.Grant.SerializeToString,
+            ),
+            'CatchUp': grpc.unary_stream_rpc_method_handler(
+                    servicer.CatchUp,
+                    request_deserializer=chat__pb2.LogPosition.FromString,
+                    response_serializer=chat__pb2.LogEntry.SerializeToString,
+            ),
+            'Replicate': grpc.stream_stream_rpc_method_handler(
+                    servicer.Replicate,
+                    request_deserializer=chat__pb2.LogBatch.FromString,
+                    response_serializer=chat__pb2.LogPosition.SerializeToString,
+            ),
+            'StreamSnapshot': grpc.unary_stream_rpc_method_handler(
+                    servicer.StreamSnapshot,
+                    request_deserializer=chat__pb2.NoParam.FromString,
+                    response_serializer=chat__pb2.SnapshotChunk.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'Chat', rpc_method_handlers)
@@ -262,6 +502,23 @@ class Chat(object):
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
+    @staticmethod
+    def SendMessages(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(request_iterator, target, '/Chat/SendMessages',
+            chat__pb2.MessageInfo.SerializeToString,
+            chat__pb2.ServerResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
     @staticmethod
     def ListenMessages(request,
             target,
@@ -279,6 +536,142 @@ class Chat(object):
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
+    @staticmethod
+    def ReceiveMessages(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/Chat/ReceiveMessages',
+            chat__pb2.Cursor.SerializeToString,
+            chat__pb2.MessageBatch.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def AcknowledgeMessages(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/Chat/AcknowledgeMessages',
+            chat__pb2.Cursor.SerializeToString,
+            chat__pb2.ServerResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def GetHistory(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/Chat/GetHistory',
+            chat__pb2.HistoryQuery.SerializeToString,
+            chat__pb2.History.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def DeliverMessage(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/Chat/DeliverMessage',
+            chat__pb2.MessageInfo.SerializeToString,
+            chat__pb2.ServerResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def ImportAccount(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/Chat/ImportAccount',
+            chat__pb2.AccountData.SerializeToString,
+            chat__pb2.ServerResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def ReleaseAccount(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/Chat/ReleaseAccount',
+            chat__pb2.Account.SerializeToString,
+            chat__pb2.AccountData.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def SetRing(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/Chat/SetRing',
+            chat__pb2.Ring.SerializeToString,
+            chat__pb2.NoParam.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def Stats(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/Chat/Stats',
+            chat__pb2.NoParam.SerializeToString,
+            chat__pb2.Metrics.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
     @staticmethod
     def Heartbeat(request,
             target,
@@ -292,6 +685,108 @@ class Chat(object):
             metadata=None):
         return grpc.experimental.unary_unary(request, target, '/Chat/Heartbeat',
             chat__pb2.NoParam.SerializeToString,
+            chat__pb2.Leader.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def AnnounceLeader(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/Chat/AnnounceLeader',
+            chat__pb2.Leader.SerializeToString,
             chat__pb2.NoParam.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def RequestVote(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/Chat/RequestVote',
+            chat__pb2.Candidacy.SerializeToString,
+            chat__pb2.Grant.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def RenewLease(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/Chat/RenewLease',
+            chat__pb2.Lease.SerializeToString,
+            chat__pb2.Grant.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def CatchUp(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/Chat/CatchUp',
+            chat__pb2.LogPosition.SerializeToString,
+            chat__pb2.LogEntry.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def Replicate(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(request_iterator, target, '/Chat/Replicate',
+            chat__pb2.LogBatch.SerializeToString,
+            chat__pb2.LogPosition.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def StreamSnapshot(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/Chat/StreamSnapshot',
+            chat__pb2.NoParam.SerializeToString,
+            chat__pb2.SnapshotChunk.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
@@ -1,7 +1,10 @@
 import re
 import threading
 from ipaddress import ip_address
+from itertools import count
 from textwrap import dedent
+from time import sleep
+from uuid import uuid4
 
 import grpc
 import inquirer
@@ -9,6 +12,7 @@ import inquirer
 import chat_pb2 as pb2
 import chat_pb2_grpc as pb2_grpc
 from constants import *
+from sharding import HashRing, choose_primary
 
 
 def validate_input(input):
@@ -32,7 +36,7 @@ def validate_user(username, client):
     """Validates that a username conforms to input requirements and
        reflects an existing user, using client to call server"""
     validate_input(username)
-    result = client.list_accounts(username)
+    result = client.list_accounts(f'^{username}$')
     if str(result).find(f"\"{username}\"") == -1:
         raise inquirer.errors.ValidationError("", reason=f"\"{username}\" is not an existing user.")
     return True
@@ -47,27 +51,121 @@ def validate_regex(search_term):
     return True
 
 
+def write(method, **kwargs):
+    """Calls a write of the client for the UI. A write the server turned away for
+       the rate limit, or whose write concern was not met, comes back as an error
+       response with the server's explanation instead of ending the UI"""
+    try:
+        return method(**kwargs)
+    except grpc.RpcError as e:
+        if e.code() not in (grpc.StatusCode.RESOURCE_EXHAUSTED, grpc.StatusCode.ABORTED):
+            raise
+        return pb2.ServerResponse(message=e.details(), error=True)
+
+
 class ChatClient:
-    def __init__(self, addr):
+    def __init__(self, addr, server_hierarchy=None, max_staleness=READ_STALENESS, write_concern=None):
         """
         Initialize the ChatClient instance.
 
         Args:
         - addr (str): IP address of the host.
+        - server_hierarchy (list): (host, port) of every replica, defaults to the replicas in constants.py.
+        - max_staleness (float): Seconds a replica may lag behind the primary and still serve
+          this client's reads, or None to read from the primary only.
+        - write_concern (str): 'primary', 'majority' or 'all', the replicas that must apply this
+          client's writes before the primary answers, or None for the cluster's write concern.
         """
+        if server_hierarchy is None:
+            server_hierarchy = [(addr, PRIMARY_PORT), (REP_1_HOST, REP_1_PORT), (REP_2_HOST, REP_2_PORT)]
 
         # Define stubs
+        options = [('grpc.max_reconnect_backoff_ms', MAX_RECONNECT_BACKOFF_MS)]
         self.STUBS = [
-            pb2_grpc.ChatStub(grpc.insecure_channel(f'{addr}:{PRIMARY_PORT}')),
-            pb2_grpc.ChatStub(grpc.insecure_channel(f'{REP_1_HOST}:{REP_1_PORT}')),
-            pb2_grpc.ChatStub(grpc.insecure_channel(f'{REP_2_HOST}:{REP_2_PORT}'))
+            pb2_grpc.ChatStub(grpc.insecure_channel(f'{host}:{port}', options=options))
+            for host, port in server_hierarchy
         ]
         self.NUM_REPLICAS = len(self.STUBS)
 
+        # The primary is cached and only determined again when a call to it fails
+        self.lock = threading.Lock()
         self.primary_index = 0
-        self.determine_primary()
+
+        # Reads are spread over the replicas that answered the last probe
+        self.max_staleness = max_staleness
+        self.alive = []
+        self.reads = count()
+
+        self.metadata = (('write-concern', write_concern),) if write_concern else ()
+
+        if not self.determine_primary():
+            # If all servers down, exit with error
+            print("We're sorry, all of our servers are down. Please try again later.")
+            exit(1)
         print(f'Replica {self.primary_index} chosen as the primary server.')
 
+    def call(self, method, request):
+        """
+        Call a unary rpc on the cached primary. If the primary cannot be
+        reached, the primary is determined again and the call is retried
+        with exponential backoff, up to CLIENT_RETRIES times. A call that
+        timed out may have been applied, so it is only retried if doing it
+        twice does no harm: messages carry a request id the replicas store
+        them once by, and the writes but those in UNSAFE_RETRIES have the
+        same effect twice. A write whose write concern
+        was not met fails with ABORTED and is not retried, as the primary
+        has applied it.
+
+        Args:
+        - method (str): The name of the rpc.
+        - request: The request message, or a list of messages for a client-streaming rpc.
+
+        Returns:
+        - The response message of the rpc.
+        """
+        delay = RETRY_BACKOFF
+        for attempt in range(CLIENT_RETRIES):
+            stub = self.stub
+            try:
+                # A streamed request is kept as a list so it can be sent again
+                sent = iter(request) if isinstance(request, list) else request
+                return getattr(stub, method)(sent, timeout=CLIENT_TIMEOUT, metadata=self.metadata)
+            except grpc.RpcError as e:
+                retryable = e.code() == grpc.StatusCode.UNAVAILABLE or (
+                    e.code() == grpc.StatusCode.DEADLINE_EXCEEDED and method not in UNSAFE_RETRIES
+                )
+                if not retryable or attempt == CLIENT_RETRIES - 1:
+                    raise
+
+            sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_BACKOFF)
+            self.determine_primary(stub)
+
+    def read(self, method, request):
+        """
+        Call a read-only unary rpc on the live replicas in turn. A replica
+        serves it if it is at most max_staleness seconds behind the primary;
+        if it is too stale or down, the call goes to the primary instead.
+
+        Args:
+        - method (str): The name of the rpc.
+        - request: The request message.
+
+        Returns:
+        - The response message of the rpc.
+        """
+        alive = self.alive
+        if self.max_staleness is not None and alive:
+            i = alive[next(self.reads) % len(alive)]
+            metadata = (('max-staleness', str(self.max_staleness)),)
+            try:
+                return getattr(self.STUBS[i], method)(request, timeout=CLIENT_TIMEOUT, metadata=metadata)
+            except grpc.RpcError as e:
+                if e.code() == grpc.StatusCode.UNAVAILABLE:
+                    self.alive = [j for j in self.alive if j != i]
+                elif e.code() not in (grpc.StatusCode.FAILED_PRECONDITION, grpc.StatusCode.DEADLINE_EXCEEDED):
+                    raise
+        return self.call(method, request)
 
     def create_account(self, username, password):
         """
@@ -81,7 +179,7 @@ class ChatClient:
         - A pb2.ServerResponse object representing the result of the operation.
         """
         account = pb2.Account(username=username, password=password)
-        return self.stub.CreateAccount(account)
+        return self.call('CreateAccount', account)
 
     def delete_account(self, username, password):
         """
@@ -95,7 +193,7 @@ class ChatClient:
         - A pb2.ServerResponse object representing the result of the operation.
         """
         account = pb2.Account(username=username, password=password)
-        return self.stub.DeleteAccount(account)
+        return self.call('DeleteAccount', account)
 
     def login(self, username, password):
         """
@@ -109,7 +207,7 @@ class ChatClient:
         - A pb2.ServerResponse object representing the result of the operation.
         """
         account = pb2.Account(username=username, password=password)
-        return self.stub.Login(account)
+        return self.call('Login', account)
 
     def logout(self, username):
         """
@@ -122,20 +220,55 @@ class ChatClient:
         - A pb2.ServerResponse object representing the result of the operation.
         """
         account = pb2.Account(username=username, password="")
-        return self.stub.Logout(account)
+        return self.call('Logout', account)
 
-    def list_accounts(self, searchterm):
+    def list_accounts(self, searchterm, cursor="", limit=0):
         """
-        Get a list of accounts that match the specified search term.
+        Get a page of accounts that match the specified search term.
 
         Args:
         - searchterm (str): The search term to use.
+        - cursor (str): The cursor of the previous page, or "" for the first page.
+        - limit (int): The maximum number of accounts to return, or 0 for the server default.
 
         Returns:
-        - A pb2.Accounts object representing the accounts list.
+        - A pb2.Accounts object with the accounts of this page and the cursor of the next one.
+        """
+        search_term = pb2.SearchTerm(searchterm=searchterm, cursor=cursor, limit=limit)
+        return self.read('ListAccounts', search_term)
+
+    def iter_accounts(self, searchterm):
         """
-        search_term = pb2.SearchTerm(searchterm=searchterm)
-        return self.stub.ListAccounts(search_term)
+        Iterate over every account that matches the specified search term,
+        fetching one page at a time.
+
+        Args:
+        - searchterm (str): The search term to use.
+        """
+        cursor = ""
+        while True:
+            result = self.list_accounts(searchterm, cursor)
+            yield from result.accounts
+            cursor = result.cursor
+            if not cursor:
+                return
+
+    def get_history(self, username, peer, before_id=0, limit=0):
+        """
+        Get a page of the delivered messages between a user and a peer.
+
+        Args:
+        - username (str): The username of the account whose history to read.
+        - peer (str): The username of the other side of the conversation.
+        - before_id (int): The before_id of the previous page, or 0 for the latest messages.
+        - limit (int): The maximum number of messages to return, or 0 for the server default.
+
+        Returns:
+        - A pb2.History object with the messages of this page, oldest first,
+          and the before_id of the page before it.
+        """
+        query = pb2.HistoryQuery(username=username, peer=peer, before_id=before_id, limit=limit)
+        return self.read('GetHistory', query)
 
     def send_message(self, destination, source, text):
         """
@@ -149,8 +282,25 @@ class ChatClient:
         Returns:
         - A pb2.ServerResponse object representing the result of the operation.
         """
-        message_info = pb2.MessageInfo(destination=destination, source=source, text=text)
-        return self.stub.SendMessage(message_info)
+        # The request id stays the same when the call is retried, so the message is stored once
+        message_info = pb2.MessageInfo(destination=destination, source=source, text=text, request_id=uuid4().hex)
+        return self.call('SendMessage', message_info)
+
+    def send_messages(self, messages):
+        """
+        Send a batch of messages in a single streaming call.
+
+        Args:
+        - messages (iterable): (destination, source, text) tuples, one per message.
+
+        Returns:
+        - A pb2.ServerResponse object representing the result of the operation.
+        """
+        message_infos = [
+            pb2.MessageInfo(destination=destination, source=source, text=text, request_id=uuid4().hex)
+            for destination, source, text in messages
+        ]
+        return self.call('SendMessages', message_infos)
 
     def listen_messages(self, username):
         """
@@ -159,42 +309,203 @@ class ChatClient:
         Args:
         - username (str): The username of the account to listen for messages on.
         """
-        account = pb2.Account(username=username)
-        try:
-            messages = self.stub.ListenMessages(account)
-            for msg in messages:
-                format = dedent(f'''
-                ______________________________________________________________
-                New message from {msg.source}:
-                {msg.text}
-                ______________________________________________________________
-                ''')
-                print(format)
-
-        # If we encounter a MultiThreadedRendezvous exception, we know that the current primary replica has gone down
-        # So we determine a new primary replica
-        except grpc._channel._MultiThreadedRendezvous:
-            self.determine_primary()
-            print(f'Switched to replica {self.primary_index} as primary.')
-            self.listen_messages(username)
-
-    def determine_primary(self):
-        """
-        Determines primary server stub.
-        """
-        while self.primary_index < self.NUM_REPLICAS:
-            # Send heartbeat to each of the server stubs, and if they are unresponsive, move to the next
+        for msg in self.receive_messages(username):
+            format = dedent(f'''
+            ______________________________________________________________
+            New message from {msg.source}:
+            {msg.text}
+            ______________________________________________________________
+            ''')
+            print(format)
+
+    def receive_messages(self, username):
+        """
+        Iterate over the messages sent to the specified user until they log
+        out. Messages arrive in batches, and each batch is acknowledged once
+        all of its messages have been consumed, which moves them to the
+        history on the server in one statement. If the stream breaks, it is
+        opened again on the current primary after the last message yielded,
+        so no message is lost and none is yielded twice. Messages that were
+        yielded but not acknowledged are acknowledged with the next batch.
+
+        Args:
+        - username (str): The username of the account to receive messages for.
+        """
+        position = 0
+        delay = RETRY_BACKOFF
+        while True:
+            stub = self.stub
             try:
-                s = self.STUBS[self.primary_index]
-                s.Heartbeat(pb2.NoParam())
-                self.stub = s
+                for batch in stub.ReceiveMessages(pb2.Cursor(username=username, id=position)):
+                    delay = RETRY_BACKOFF
+                    for msg in batch.messages:
+                        position = msg.id
+                        yield msg
+                    self.call('AcknowledgeMessages', pb2.Cursor(username=username, id=position))
                 return
-            except grpc._channel._InactiveRpcError:
-                self.primary_index += 1
 
-        # If all servers down, exit with error
-        print("We're sorry, all of our servers are down. Please try again later.")
-        exit(1)
+            # If the stream breaks, the current primary replica has most likely gone down
+            # So we determine a new primary replica and listen there
+            except grpc.RpcError:
+                sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_BACKOFF)
+                if self.determine_primary(stub):
+                    print(f'Switched to replica {self.primary_index} as primary.')
+
+    def determine_primary(self, failed=None):
+        """
+        Determines the primary server stub by probing every replica at once.
+        Replicas that consider themselves the primary are preferred, the one
+        of the latest term first, then the primary the replicas report, then
+        the lowest-indexed replica alive.
+
+        Args:
+        - failed: The stub that just failed, if any. If another thread has
+          already replaced it, the new primary is kept.
+
+        Returns:
+        - True if a replica answered, False if all of them are down.
+        """
+        with self.lock:
+            if failed is not None and self.stub is not failed:
+                return True
+
+            calls = [s.Heartbeat.future(pb2.NoParam(), timeout=PROBE_TIMEOUT) for s in self.STUBS]
+            leaders, terms = {}, {}
+            for i, call in enumerate(calls):
+                try:
+                    leaders[i], terms[i] = call.result().index, call.result().term
+                except grpc.RpcError:
+                    pass
+
+            if not leaders:
+                return False
+            self.alive = sorted(leaders)
+            self.primary_index = choose_primary(leaders, terms)
+            self.stub = self.STUBS[self.primary_index]
+            return True
+
+
+class ShardedChatClient:
+    def __init__(self, shards=SHARDS, max_staleness=READ_STALENESS, write_concern=None):
+        """
+        Initialize a client of a cluster whose users are spread over several
+        shards, each a replica group with its own primary. Calls about a user
+        go to the ChatClient of the user's shard on the consistent hash ring;
+        the servers forward calls that reach the wrong shard, e.g. during a
+        rebalance.
+
+        Args:
+        - shards (list): The (host, port) hierarchy of every shard, defaults to SHARDS in constants.py.
+        - max_staleness (float): See ChatClient.
+        - write_concern (str): See ChatClient.
+        """
+        self.clients = [ChatClient(hierarchy[0][0], hierarchy, max_staleness, write_concern) for hierarchy in shards]
+        self.ring = HashRing(range(len(shards)))
+
+    def client(self, username):
+        """Returns the ChatClient of the shard the user belongs to."""
+        return self.clients[self.ring.shard_for(username)]
+
+    def create_account(self, username, password):
+        """See ChatClient.create_account."""
+        return self.client(username).create_account(username, password)
+
+    def delete_account(self, username, password):
+        """See ChatClient.delete_account."""
+        return self.client(username).delete_account(username, password)
+
+    def login(self, username, password):
+        """See ChatClient.login."""
+        return self.client(username).login(username, password)
+
+    def logout(self, username):
+        """See ChatClient.logout."""
+        return self.client(username).logout(username)
+
+    def list_accounts(self, searchterm, cursor="", limit=0):
+        """
+        Get a page of accounts that match the specified search term from
+        every shard. Each shard's page starts after the same cursor, so the
+        merged page is complete up to the last name of the shortest page
+        that has more after it.
+
+        Args:
+        - searchterm (str): The search term to use.
+        - cursor (str): The cursor of the previous page, or "" for the first page.
+        - limit (int): The maximum number of accounts to return, or 0 for the server default.
+
+        Returns:
+        - A pb2.Accounts object with the accounts of this page and the cursor of the next one.
+        """
+        pages = [client.list_accounts(searchterm, cursor, limit) for client in self.clients]
+        limit = limit or ACCOUNTS_PAGE_SIZE
+        bound = min((page.accounts[-1] for page in pages if page.cursor), default=None)
+        accounts = sorted(a for page in pages for a in page.accounts if bound is None or a <= bound)
+        more = bound is not None or len(accounts) > limit
+        accounts = accounts[:limit]
+        return pb2.Accounts(accounts=accounts, cursor=accounts[-1] if more and accounts else "")
+
+    iter_accounts = ChatClient.iter_accounts
+
+    def get_history(self, username, peer, before_id=0, limit=0):
+        """
+        Get a page of the delivered messages between a user and a peer. A
+        message is stored on its destination's shard, so a conversation
+        between users of two shards is merged from both; message ids are
+        ordered by time across shards.
+
+        Args:
+        - username (str): The username of the account whose history to read.
+        - peer (str): The username of the other side of the conversation.
+        - before_id (int): The before_id of the previous page, or 0 for the latest messages.
+        - limit (int): The maximum number of messages to return, or 0 for the server default.
+
+        Returns:
+        - A pb2.History object with the messages of this page, oldest first,
+          and the before_id of the page before it.
+        """
+        shards = {self.ring.shard_for(username), self.ring.shard_for(peer)}
+        pages = [self.clients[shard].get_history(username, peer, before_id, limit) for shard in shards]
+        if len(pages) == 1:
+            return pages[0]
+
+        limit = limit or HISTORY_PAGE_SIZE
+        messages = sorted((m for page in pages for m in page.messages), key=lambda m: m.id)
+        more = any(page.before_id for page in pages) or len(messages) > limit
+        messages = messages[-limit:]
+        return pb2.History(messages=messages, before_id=messages[0].id if more and messages else 0)
+
+    def send_message(self, destination, source, text):
+        """See ChatClient.send_message. The sender's shard writes the message to the destination's shard."""
+        return self.client(source).send_message(destination, source, text)
+
+    def send_messages(self, messages):
+        """
+        Send a batch of messages, in one streaming call per sender shard.
+
+        Args:
+        - messages (iterable): (destination, source, text) tuples, one per message.
+
+        Returns:
+        - A pb2.ServerResponse object representing the result of the operation.
+        """
+        batches = {}
+        for destination, source, text in messages:
+            batches.setdefault(self.ring.shard_for(source), []).append((destination, source, text))
+        responses = [self.clients[shard].send_messages(batch) for shard, batch in batches.items()]
+        return pb2.ServerResponse(
+            message=' '.join(r.message for r in responses),
+            error=any(r.error for r in responses),
+        )
+
+    def listen_messages(self, username):
+        """See ChatClient.listen_messages."""
+        return self.client(username).listen_messages(username)
+
+    def receive_messages(self, username):
+        """See ChatClient.receive_messages."""
+        return self.client(username).receive_messages(username)
 
 
 def login_ui(client):
@@ -212,11 +523,11 @@ def login_ui(client):
         )
     ]
     answers = inquirer.prompt(questions)
-    result = client.create_account(username=answers['username'], password=answers['password'])
+    result = write(client.create_account, username=answers['username'], password=answers['password'])
     username, password = answers["username"], answers["password"]
     print(result.message, result.error)
     if result.error:
-        result = client.login(username=username, password=password)
+        result = write(client.login, username=username, password=password)
         while result.error == True:
             print(result.message)
             questions = [
@@ -225,7 +536,7 @@ def login_ui(client):
             ]
             answers = inquirer.prompt(questions)
             username, password = answers["username"], answers["password"]
-            result = client.login(username=username, password=password)
+            result = write(client.login, username=username, password=password)
         print(result.message)
     else:
         print(f'Welcome, {username}. I see this is your first time here. Confirm your password below:')
@@ -235,7 +546,7 @@ def login_ui(client):
                 inquirer.Password('password', message="Password")
             ]
             password = inquirer.prompt(questions)['password']
-            result = client.login(username=username, password=password)
+            result = write(client.login, username=username, password=password)
             err = result.error
             if err == True:
                 print(result.message)
@@ -252,7 +563,7 @@ if __name__ == '__main__':
     answers = inquirer.prompt(questions, raise_keyboard_interrupt=True)
     addr = answers['ip']
 
-    client = ChatClient(addr)
+    client = ShardedChatClient() if len(SHARDS) > 1 else ChatClient(addr)
     # Prompt the user to log in
     username, password = login_ui(client)
 
@@ -263,7 +574,7 @@ if __name__ == '__main__':
     list_questions = [
             inquirer.List('action',
                       message="What do you want to do?",
-                      choices=['List accounts', 'Send message', 'Logout', 'Delete account']
+                      choices=['List accounts', 'Send message', 'View history', 'Logout', 'Delete account']
                       ),
     ]
     while (True):
@@ -285,8 +596,7 @@ if __name__ == '__main__':
 
             # Call the list_accounts method on the ChatClient instance and print the result
             try:
-                result = client.list_accounts(regex)
-                print(f'{result}')
+                print(', '.join(client.iter_accounts(regex)))
             except grpc._channel._InactiveRpcError:
                 print('The regular expression you entered was invalid')
 
@@ -306,8 +616,26 @@ if __name__ == '__main__':
             answers = inquirer.prompt(msg_questions)
             destination, text = answers['recipient'], answers['message']
             # Call the send_message method on the ChatClient instance and print the result
-            result = client.send_message(destination=destination, source=username, text=text)
-            print('Message sent successfully!')
+            result = write(client.send_message, destination=destination, source=username, text=text)
+            print(result.message if result.error else 'Message sent successfully!')
+
+        elif answers['action'] == "View history":
+            # Ask the user whose conversation to show
+            question = [
+                inquirer.Text(
+                    'peer',
+                    message='Whose conversation would you like to see?',
+                    validate=lambda _, x: validate_user(x, client)
+                )
+            ]
+            peer = inquirer.prompt(question)['peer']
+
+            # Call the get_history method on the ChatClient instance and print the latest page
+            history = client.get_history(username=username, peer=peer)
+            for msg in history.messages:
+                print(f'{msg.source}: {msg.text}')
+            if not history.messages:
+                print(f'No messages with {peer} yet.')
 
         elif answers['action'] == "Logout":
             # Confirm that the user wants to log out
@@ -315,8 +643,8 @@ if __name__ == '__main__':
             confirmation = inquirer.prompt(logout_question)['logout']
             if confirmation:
                 # Call the logout method on the ChatClient instance
-                client.logout(username=username)
-                print("Successfully logged out")
+                result = write(client.logout, username=username)
+                print(result.message if result.error else "Successfully logged out")
                 exit(0)
             else:
                 pass
@@ -329,7 +657,7 @@ if __name__ == '__main__':
                 # Call the delete_account method on the ChatClient instance
                 delete_question = [inquirer.Password('password', message="Password"),]
                 password = inquirer.prompt(delete_question)['password']
-                result = client.delete_account(username=username, password=password)
+                result = write(client.delete_account, username=username, password=password)
                 if result.error == True:
                     print(result.message)
                 else:
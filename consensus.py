@@ -0,0 +1,138 @@
+import random
+from threading import Lock
+from time import monotonic
+
+from constants import *
+
+FOLLOWER, CANDIDATE, LEADER = 'follower', 'candidate', 'leader'
+
+
+class LogConflict(Exception):
+    '''An operation arrived under a sequence number this replica logged in another term.'''
+    def __init__(self, seq, logged, term):
+        super().__init__(f'Operation {seq} was logged in term {logged} here, but arrived from term {term}.')
+        self.seq = seq
+
+
+def log_up_to_date(candidate, own):
+    '''
+    Returns whether a candidate's log, as (term, seq) of its last applied
+    operation, holds at least everything a voter's log holds that a majority
+    may have acknowledged: it ends in a later term, or in the same term and
+    no earlier.
+    '''
+    return tuple(candidate) >= tuple(own)
+
+
+class Election:
+    '''
+    Raft-style leader election of one replica group, without the network.
+
+    Time is divided into terms with at most one leader each. A follower
+    that has not heard from a leader for its election timeout stands for
+    election in the next term, and becomes the leader once a majority of
+    the replicas voted for it. Every replica votes at most once per term,
+    only for candidates whose log is at least as up to date as its own,
+    and the term and vote are saved before the vote is cast.
+
+    The leader renews a lease with the other replicas every LEASE_INTERVAL.
+    A replica that granted it votes for nobody else until ELECTION_TIMEOUT
+    later, so once a majority granted a renewal, no other replica can be
+    elected until LEASE_TIMEOUT after it was sent. Only the holder of the
+    lease takes writes or serves reads as the primary, so two replicas never
+    do so at once, even when the network is partitioned.
+
+    Every method takes the current time, so that tests can simulate it.
+    '''
+    def __init__(self, index, size, term=0, voted_for=None, save=None, now=None):
+        self.index = index
+        self.size = size
+        self.lock = Lock()
+        self.term = term
+        self.voted_for = voted_for
+        self.save = save or (lambda term, voted_for: None)
+        self.role = FOLLOWER
+        self.leader = None      # Replica whose lease this replica last granted, or this replica as the leader
+        self.heard = monotonic() if now is None else now # When this replica last granted a lease or a vote
+        self.timeout = self.election_timeout()
+        self.lease = 0.0        # Until when this replica holds the lease, as the leader
+
+    def majority(self):
+        '''Returns how many replicas, the leader included, make a majority.'''
+        return self.size // 2 + 1
+
+    def election_timeout(self):
+        '''Picks a random election timeout, so that replicas rarely stand for election at once.'''
+        return random.uniform(ELECTION_TIMEOUT, 2 * ELECTION_TIMEOUT)
+
+    def advance(self, term):
+        '''Moves on to a later term as a follower. Called with the lock held.'''
+        if term > self.term:
+            self.term, self.voted_for = term, None
+            self.role, self.leader, self.lease = FOLLOWER, None, 0.0
+            self.save(self.term, None)
+
+    def observe(self, term):
+        '''Steps down if another replica answered from a later term.'''
+        with self.lock:
+            self.advance(term)
+
+    def election_due(self, now):
+        '''Returns whether this replica should stand for election.'''
+        with self.lock:
+            return self.role != LEADER and now - self.heard >= self.timeout
+
+    def stand(self, now):
+        '''Starts an election in the next term, voting for this replica. Returns the term.'''
+        with self.lock:
+            self.term += 1
+            self.voted_for, self.role, self.leader = self.index, CANDIDATE, None
+            self.heard, self.timeout = now, self.election_timeout()
+            self.save(self.term, self.index)
+            return self.term
+
+    def vote(self, term, candidate, candidate_log, own_log, now):
+        '''
+        Answers a candidate's request for a vote. Returns (term, granted).
+        A replica that granted a lease less than ELECTION_TIMEOUT ago, or
+        that holds one, does not help to depose its leader.
+        '''
+        with self.lock:
+            if self.leader is not None and (now - self.heard < ELECTION_TIMEOUT or now < self.lease):
+                return self.term, False
+            self.advance(term)
+            granted = term == self.term and self.voted_for in (None, candidate) and log_up_to_date(candidate_log, own_log)
+            if granted:
+                if self.voted_for is None:
+                    self.voted_for = candidate
+                    self.save(self.term, candidate)
+                self.heard = now
+            return self.term, granted
+
+    def won(self, term, votes):
+        '''Counts the votes of an election, this replica's included. Returns whether it became the leader.'''
+        with self.lock:
+            if self.role != CANDIDATE or self.term != term or votes < self.majority():
+                return False
+            self.role, self.leader = LEADER, self.index
+            return True
+
+    def follow(self, term, leader, now):
+        '''Answers a leader's lease renewal. Returns (term, granted).'''
+        with self.lock:
+            if term < self.term:
+                return self.term, False
+            self.advance(term)
+            self.role, self.leader, self.heard = FOLLOWER, leader, now
+            return self.term, True
+
+    def renew(self, term, sent, grants):
+        '''Extends the lease if a majority, this replica included, granted the renewal sent at the given time.'''
+        with self.lock:
+            if self.role == LEADER and self.term == term and grants >= self.majority():
+                self.lease = max(self.lease, sent + LEASE_TIMEOUT)
+
+    def has_lease(self, now):
+        '''Returns whether this replica is the leader and holds the lease.'''
+        with self.lock:
+            return self.role == LEADER and now < self.lease
@@ -16,4 +16,53 @@ DATABASE = {
     'password': 'michaelhu',
     'database': DB_NAME,
     'host': 'localhost',
-}
\ No newline at end of file
+}
+
+MAX_WORKERS = 10      # Number of gRPC worker threads per replica
+PROCESSES = 1         # Number of worker processes per replica, see workers.Workers
+LISTEN_TIMEOUT = 30.0 # Seconds an idle ListenMessages stream sleeps before rechecking its user
+REPLICATION_TIMEOUT = 2.0 # Deadline in seconds for relaying a write to a secondary replica
+REPLICATION_BATCH_SIZE = 256 # Most operations relayed to a secondary in one Replicate frame
+REPLICATION_WINDOW = 1       # Most Replicate frames sent to a secondary and not acknowledged yet
+REPLICATION_RETRY = 0.5      # Seconds between attempts to reopen the Replicate stream to a secondary
+WRITE_CONCERNS = ('primary', 'majority', 'all') # Replicas that must apply a write before the primary answers
+WRITE_CONCERN = 'primary'    # Write concern of writes whose client does not ask for one
+REQUEST_WINDOW = 10000       # Operations within which a message the client retried is stored only once
+USER_RATE_LIMIT = 0.0        # Messages per second each user may send, 0 for no limit, see server.Admission
+GLOBAL_RATE_LIMIT = 0.0      # Messages per second a replica accepts from all users together, 0 for no limit
+RATE_LIMIT_BURST = 2.0       # Seconds of its rate a sender may send at once after being idle
+SQLITE_TIMEOUT = 5.0      # Seconds a connection waits for a lock held by another process
+GROUP_COMMIT_SIZE = 256   # Maximum number of writes committed together in one transaction
+STORAGE = 'sqlite'        # Storage engine of a replica, 'sqlite' or 'memory', see storage.py
+MEMORY_SNAPSHOT_INTERVAL = 60.0 # Seconds between snapshots of the in-memory storage engine, which empty its journal
+ACCOUNTS_PAGE_SIZE = 100      # Default number of usernames returned by ListAccounts
+MAX_ACCOUNTS_PAGE_SIZE = 1000 # Largest page of usernames a client may ask for
+PATTERN_CACHE_SIZE = 256      # Number of compiled ListAccounts patterns kept around
+CATCH_UP_TIMEOUT = 60.0   # Deadline in seconds for streaming missed operations from another replica
+CATCH_UP_BATCH_SIZE = 500 # Number of operation log entries applied per transaction during catch-up
+SNAPSHOT_CHUNK_SIZE = 1 << 20 # Bytes per chunk when streaming a database snapshot
+SNAPSHOT_TIMEOUT = 3600.0     # Deadline in seconds for streaming a snapshot to a new replica
+CATCH_UP_INTERVAL = 1.0       # Seconds between checks for gaps in a replica's operation log
+MAX_RECONNECT_BACKOFF_MS = 1000 # Longest wait before reconnecting to a replica that was down
+HEARTBEAT_INTERVAL = 0.2      # Seconds between heartbeats sent to the primary
+HEARTBEAT_JITTER = 0.05       # Random extra delay in seconds added to each heartbeat interval
+SUSPICION_TIMEOUT = 1.0       # Seconds without a heartbeat answer before the primary is considered down
+ELECTION_TIMEOUT = 0.4        # Seconds a replica in consensus mode waits to hear from a leader before standing for election, randomized up to twice that
+LEASE_INTERVAL = 0.05         # Seconds between the leader's lease renewals in consensus mode
+LEASE_TIMEOUT = 0.3           # Seconds a lease lasts after a majority granted it, below ELECTION_TIMEOUT to allow for clock drift
+PROBE_TIMEOUT = 0.5           # Deadline in seconds for the client's heartbeat to each replica
+CLIENT_TIMEOUT = 10.0         # Deadline in seconds for a client's unary calls
+CLIENT_RETRIES = 8            # Attempts of a unary call before the client gives up
+RETRY_BACKOFF = 0.05          # Seconds the client waits before its first retry, doubled every time
+MAX_RETRY_BACKOFF = 1.0       # Longest wait in seconds between two retries
+UNSAFE_RETRIES = ('CreateAccount', 'DeleteAccount', 'ImportAccount', 'ReleaseAccount') # Writes not retried once they timed out, as they may have been applied
+SERVER_MODE = 'aio'           # 'aio' serves streams from an asyncio loop, 'thread' from a thread pool
+AIO_READ_THREADS = 4          # Threads running database reads for asyncio ListenMessages streams
+READ_STALENESS = 1.0          # Seconds a secondary may lag behind the primary and still serve a client's reads
+POSITION_HISTORY = 64         # Number of heartbeat answers of the primary a secondary remembers
+DELIVERY_BATCH_SIZE = 500     # Most messages sent to a client in one ReceiveMessages frame
+HISTORY_PAGE_SIZE = 50        # Default number of messages returned by GetHistory
+MAX_HISTORY_PAGE_SIZE = 500   # Largest page of history a client may ask for
+RING_VNODES = 64              # Points every shard owns on the consistent hash ring
+SHARD_BITS = 8                # Low bits of a message id that hold the shard it was sent on
+SHARDS = [[(PRIMARY_HOST, PRIMARY_PORT), (REP_1_HOST, REP_1_PORT), (REP_2_HOST, REP_2_PORT)]] # Replicas of every shard
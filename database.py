@@ -0,0 +1,171 @@
+import sqlite3
+from concurrent.futures import Future
+from queue import Queue
+from threading import Lock, Thread, local
+from time import perf_counter
+
+from constants import *
+from metrics import SQLITE_LATENCY
+
+
+class Database:
+    '''
+    Connections to a replica's SQLite database.
+
+    The database runs in WAL mode, so readers never block the writer and the
+    writer never blocks readers. Every thread reads through a connection of
+    its own. All writes go through a single writer thread that commits them
+    in groups: writes submitted while a commit is in progress are applied
+    together in the next transaction and share a single fsync.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.local = local()
+        self.lock = Lock()
+        self.connections = []
+
+        self.queue = Queue()
+        self.callbacks = []
+        self.undo = []
+        self.writer_conn = self.connect()
+        self.writer = Thread(target=self.run_writer, daemon=True)
+        self.writer.start()
+
+    def connect(self):
+        '''Opens a new connection to the database in WAL mode.'''
+        # Transactions are managed explicitly, so the connection runs in autocommit mode
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=SQLITE_TIMEOUT)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = FULL')
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+    def read(self):
+        '''Returns the calling thread's read connection.'''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+        return conn
+
+    def write(self, fn):
+        '''
+        Runs fn(conn) in the writer thread and returns its result once the
+        transaction containing it has been committed. If fn raises, only its
+        own changes are rolled back and the exception is raised here.
+        '''
+        return self.submit(fn).result()
+
+    def submit(self, fn):
+        '''
+        Like write(), but returns a concurrent.futures.Future instead of
+        waiting for the commit, e.g. for asyncio code to await it with
+        asyncio.wrap_future().
+        '''
+        future = Future()
+        self.queue.put((fn, future))
+        return future
+
+    def after_commit(self, callback):
+        '''
+        Called from inside a write: runs callback() in the writer thread once
+        the write has been committed. Use it for side effects that must not
+        be seen before the data is, like waking up readers.
+        '''
+        self.callbacks.append(callback)
+
+    def on_rollback(self, callback):
+        '''
+        Called from inside a write: runs callback() in the writer thread if
+        the write is rolled back after all. Use it to undo in-memory state
+        that is changed along with the database, so that later writes in
+        the same transaction already see the change.
+        '''
+        self.undo.append(callback)
+
+    def run_writer(self):
+        '''Applies queued writes in groups, one transaction per group.'''
+        conn = self.writer_conn
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < GROUP_COMMIT_SIZE and not self.queue.empty():
+                batch.append(self.queue.get())
+
+            if batch[-1] is None:
+                # close() was called, finish the remaining writes and stop
+                batch.pop()
+                self.commit(conn, batch)
+                return
+            self.commit(conn, batch)
+
+    def commit(self, conn, batch):
+        '''Runs a group of writes in one transaction and resolves their futures.'''
+        if not batch:
+            return
+
+        results = []
+        callbacks = []
+        undo = []
+        start = perf_counter()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for fn, future in batch:
+                # Each write gets a savepoint so that a failing write does not undo the others
+                conn.execute('SAVEPOINT write')
+                self.callbacks = []
+                self.undo = []
+                try:
+                    results.append((future, fn(conn), None))
+                    conn.execute('RELEASE write')
+                    callbacks.extend(self.callbacks)
+                    undo.extend(self.undo)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO write')
+                    conn.execute('RELEASE write')
+                    self.run_callbacks(reversed(self.undo))
+                    results.append((future, None, e))
+            conn.execute('COMMIT')
+        except Exception as e:
+            # The transaction as a whole failed, so none of the writes happened
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            self.run_callbacks(reversed(undo))
+            results = [(future, None, e) for _, future in batch]
+            callbacks = []
+        SQLITE_LATENCY.labels('transaction').observe(perf_counter() - start)
+
+        self.run_callbacks(callbacks)
+
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def run_callbacks(self, callbacks):
+        '''Runs after-commit or rollback callbacks, reporting the ones that fail.'''
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f'Error in database callback: {e}')
+
+    def snapshot(self, path):
+        '''
+        Writes a consistent copy of the database to path. The copy is taken
+        in a single read transaction, so it never blocks the writer.
+        '''
+        target = sqlite3.connect(path)
+        try:
+            self.read().backup(target)
+        finally:
+            target.close()
+
+    def close(self):
+        '''Stops the writer thread and closes every connection.'''
+        self.queue.put(None)
+        self.writer.join()
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
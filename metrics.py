@@ -0,0 +1,166 @@
+import asyncio
+import inspect
+from time import perf_counter
+
+import grpc
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, start_http_server
+
+# Buckets in seconds, fine enough to tell apart SQLite statements that take fractions of a millisecond
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUESTS = Counter('chat_requests_total', 'RPCs received.', ['method'])
+ERRORS = Counter('chat_errors_total', 'RPCs that ended with a status other than OK.', ['method', 'code'])
+LATENCY = Histogram('chat_request_seconds', 'Time spent handling RPCs with a unary response.', ['method'], buckets=BUCKETS)
+ACTIVE_STREAMS = Gauge('chat_active_streams', 'Response streams currently open.', ['method'])
+REPLICATION_LATENCY = Histogram('chat_replication_seconds', 'Time until a secondary acknowledged a relayed operation.',
+                                ['replica', 'method'], buckets=BUCKETS)
+REPLICATION_ERRORS = Counter('chat_replication_errors_total', 'Relayed operations a secondary did not acknowledge.', ['replica', 'method'])
+REPLICATION_LAG = Gauge('chat_replication_lag_operations', 'Operations a secondary has not acknowledged yet.', ['replica'])
+REPLICATION_LAG_SECONDS = Gauge('chat_replication_lag_seconds', 'Age of the oldest operation a secondary has not acknowledged yet.', ['replica'])
+ELECTIONS = Counter('chat_elections_total', 'Elections this replica stood for in consensus mode, by outcome.', ['outcome'])
+THROTTLED = Counter('chat_throttled_total', 'Writes rejected by admission control, by the rate limit they exceeded.', ['method', 'limit'])
+SQLITE_LATENCY = Histogram('chat_sqlite_seconds', 'Time spent in SQLite, by operation.', ['operation'], buckets=BUCKETS)
+
+
+def render():
+    '''Returns every metric in the Prometheus text format.'''
+    return generate_latest().decode()
+
+
+def serve_http(port):
+    '''Serves the metrics for Prometheus to scrape at http://<host>:<port>/metrics.'''
+    start_http_server(port)
+
+
+class AbortedCall(Exception):
+    '''Ends a plain handler of the grpc.aio server once it aborted its call, see RecordingContext.abort.'''
+
+
+class RecordingContext:
+    '''Passes everything through to a servicer context, remembering the status code set on it.'''
+    def __init__(self, context):
+        self.context = context
+        self.status = grpc.StatusCode.OK
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+    def set_code(self, code):
+        self.status = code
+        self.context.set_code(code)
+
+    def abort(self, code, details):
+        self.status = code
+        aborted = self.context.abort(code, details)
+        # grpc.aio runs plain handlers in its thread pool, where abort() ends the call but returns instead of raising
+        if aborted is None:
+            raise AbortedCall(details)
+        return aborted
+
+
+class Call:
+    '''Metrics of one RPC in flight.'''
+    def __init__(self, method, context, streaming):
+        self.method = method
+        self.streaming = streaming
+        self.context = RecordingContext(context)
+        self.start = perf_counter()
+        REQUESTS.labels(method).inc()
+        if streaming:
+            ACTIVE_STREAMS.labels(method).inc()
+
+    def finish(self, error=None):
+        code = self.context.status
+        if code == grpc.StatusCode.OK and error is not None:
+            cancelled = isinstance(error, (GeneratorExit, asyncio.CancelledError))
+            code = grpc.StatusCode.CANCELLED if cancelled else grpc.StatusCode.UNKNOWN
+        if code != grpc.StatusCode.OK:
+            ERRORS.labels(self.method, code.name).inc()
+
+        if self.streaming:
+            ACTIVE_STREAMS.labels(self.method).dec()
+        else:
+            LATENCY.labels(self.method).observe(perf_counter() - self.start)
+
+
+def instrument(behavior, method, streaming):
+    '''
+    Wraps an RPC handler function so that every call is counted and timed.
+    The wrapper is of the same kind as the handler (plain function,
+    generator, coroutine or async generator), so both the threaded and the
+    asyncio server keep running it the way they would run the handler.
+    '''
+    if inspect.isasyncgenfunction(behavior):
+        async def handle(request, context):
+            call = Call(method, context, streaming)
+            try:
+                async for response in behavior(request, call.context):
+                    yield response
+            except BaseException as e:
+                call.finish(e)
+                raise
+            call.finish()
+    elif inspect.iscoroutinefunction(behavior):
+        async def handle(request, context):
+            call = Call(method, context, streaming)
+            try:
+                response = await behavior(request, call.context)
+            except BaseException as e:
+                call.finish(e)
+                raise
+            call.finish()
+            return response
+    elif streaming:
+        def handle(request, context):
+            call = Call(method, context, streaming)
+            try:
+                yield from behavior(request, call.context)
+            except BaseException as e:
+                call.finish(e)
+                raise
+            call.finish()
+    else:
+        def handle(request, context):
+            call = Call(method, context, streaming)
+            try:
+                response = behavior(request, call.context)
+            except BaseException as e:
+                call.finish(e)
+                raise
+            call.finish()
+            return response
+    return handle
+
+
+def instrument_handler(handler, handler_call_details):
+    '''Returns a copy of an RpcMethodHandler whose function records metrics.'''
+    if handler is None:
+        return None
+
+    method = handler_call_details.method.rsplit('/', 1)[-1]
+    if handler.request_streaming and handler.response_streaming:
+        behavior, factory = handler.stream_stream, grpc.stream_stream_rpc_method_handler
+    elif handler.request_streaming:
+        behavior, factory = handler.stream_unary, grpc.stream_unary_rpc_method_handler
+    elif handler.response_streaming:
+        behavior, factory = handler.unary_stream, grpc.unary_stream_rpc_method_handler
+    else:
+        behavior, factory = handler.unary_unary, grpc.unary_unary_rpc_method_handler
+
+    return factory(
+        instrument(behavior, method, handler.response_streaming),
+        request_deserializer=handler.request_deserializer,
+        response_serializer=handler.response_serializer,
+    )
+
+
+class MetricsInterceptor(grpc.ServerInterceptor):
+    '''Records request counts, errors, latencies and open streams of the threaded server.'''
+    def intercept_service(self, continuation, handler_call_details):
+        return instrument_handler(continuation(handler_call_details), handler_call_details)
+
+
+class AsyncMetricsInterceptor(grpc.aio.ServerInterceptor):
+    '''Records request counts, errors, latencies and open streams of the grpc.aio server.'''
+    async def intercept_service(self, continuation, handler_call_details):
+        return instrument_handler(await continuation(handler_call_details), handler_call_details)
@@ -0,0 +1,105 @@
+"""
+Online rebalancing tool for a sharded cluster.
+
+Once the replicas of a new shard are running, moves the accounts whose hash
+range now belongs to it while the cluster keeps serving:
+1. every replica switches to the new ring, keeping the old one to find the
+   accounts that have not moved yet,
+2. every account whose shard changed is taken off its old shard, with its
+   queued messages and history (ReleaseAccount), and stored on its new one
+   (ImportAccount),
+3. every replica drops the old ring, and a last pass moves the accounts an
+   old shard created in the meantime.
+
+Calls about an account fail for the moment it takes to move it, with an error
+response like for an unknown user; nothing is lost. If an import fails for
+good, the released account is saved to a file to be imported by hand.
+
+New shards go at the end of --shards. Afterwards, set SHARDS in constants.py
+to the new layout so that restarted replicas and new clients use it.
+
+Usage: python rebalance.py --shards 'h:8000,h:8001,h:8002;h:8100,h:8101,h:8102' --previous 1
+"""
+import argparse
+
+import grpc
+
+import chat_pb2 as pb2
+import chat_pb2_grpc as pb2_grpc
+from constants import *
+from sharding import HashRing, ReplicaGroup, moved_ranges, parse_shards, ring_message
+
+
+def set_ring(shards, previous=None):
+    """Sends the new layout, and the previous one during the rebalance, to every replica"""
+    request = ring_message(shards, previous)
+    for hierarchy in shards:
+        for host, port in hierarchy:
+            try:
+                pb2_grpc.ChatStub(grpc.insecure_channel(f'{host}:{port}')).SetRing(request, timeout=CLIENT_TIMEOUT)
+            except grpc.RpcError:
+                print(f'Replica {host}:{port} is down, it picks up the layout from SHARDS when restarted.')
+
+
+def list_usernames(group):
+    """Returns every username stored on a shard, read from its primary"""
+    usernames, cursor = [], ''
+    while True:
+        page = group.call('ListAccounts', pb2.SearchTerm(searchterm='', cursor=cursor, limit=MAX_ACCOUNTS_PAGE_SIZE))
+        usernames.extend(page.accounts)
+        cursor = page.cursor
+        if not cursor:
+            return usernames
+
+
+def move_account(username, source, target):
+    """Moves one account from the source group to the target group, returns whether it existed"""
+    data = source.call('ReleaseAccount', pb2.Account(username=username))
+    if not data.found:
+        return False
+
+    try:
+        target.call('ImportAccount', data)
+    except grpc.RpcError:
+        path = f'rebalance_{username}.pb'
+        with open(path, 'wb') as f:
+            f.write(data.SerializeToString())
+        print(f'Could not import {username}, saved the account to {path}.')
+    return True
+
+
+def move_accounts(groups, ring):
+    """Moves every account that is not on its shard of the ring, returns how many moved"""
+    moved = 0
+    for source, group in enumerate(groups):
+        for username in list_usernames(group):
+            target = ring.shard_for(username)
+            if target != source and move_account(username, group, groups[target]):
+                moved += 1
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shards', required=True, help='host:port of every replica, shards separated by ;')
+    parser.add_argument('--previous', type=int, help='number of shards before the new ones, defaults to all but the last')
+    args = parser.parse_args()
+
+    shards = parse_shards(args.shards)
+    previous = len(shards) - 1 if args.previous is None else args.previous
+    old, new = HashRing(range(previous)), HashRing(range(len(shards)))
+
+    moves = moved_ranges(old, new)
+    share = sum((end - start) % (1 << 64) + 1 for start, end, _, _ in moves) / (1 << 64)
+    print(f'{len(moves)} hash ranges, {share:.1%} of the ring, move to the new shards.')
+
+    groups = [ReplicaGroup(hierarchy) for hierarchy in shards]
+    set_ring(shards, shards[:previous])
+    moved = move_accounts(groups, new)
+    set_ring(shards)
+    moved += move_accounts(groups, new)
+    print(f'Moved {moved} accounts.')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,72 +1,1214 @@
+import argparse
+import asyncio
+import os
+import random
 import re
-import sqlite3
+import tempfile
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, deque
 from concurrent import futures
+from functools import lru_cache
+from math import inf
 from multiprocessing import Process
-from threading import Thread
-from time import sleep
+from threading import Condition, Lock, Thread
+from time import monotonic, perf_counter, sleep, time_ns
 
 import grpc
 
 import chat_pb2 as pb2
 import chat_pb2_grpc as pb2_grpc
+import metrics
+from consensus import LEADER, Election, LogConflict
 from constants import *
+from sharding import HashRing, ReplicaGroup, ring_layout
+from storage import STORAGE_ENGINES, SqliteStorage
+from workers import Workers
+
+
+class MessageNotifier:
+    '''
+    Wakes up ListenMessages streams when something changes for their user.
+
+    Every user has a version counter that is bumped by notify(). A listener
+    remembers the version it last saw, checks the database, and then sleeps
+    in wait() until the version moves on, so a notification that arrives
+    between the check and the wait is never lost.
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.conditions = {}
+        self.versions = {}
+        self.callbacks = {}
+
+    def _condition(self, username):
+        with self.lock:
+            if username not in self.conditions:
+                self.conditions[username] = Condition(self.lock)
+                self.versions[username] = 0
+            return self.conditions[username]
+
+    def version(self, username):
+        '''Returns the current version counter of the given user.'''
+        self._condition(username)
+        with self.lock:
+            return self.versions[username]
+
+    def notify(self, username):
+        '''Wakes up every stream waiting on the given user.'''
+        condition = self._condition(username)
+        with condition:
+            self.versions[username] += 1
+            condition.notify_all()
+            callbacks = list(self.callbacks.get(username, ()))
+        for callback in callbacks:
+            callback()
+
+    def subscribe(self, username, callback):
+        '''
+        Calls callback() on every notify() for the given user, for listeners
+        that cannot block in wait(), like asyncio streams.
+        '''
+        with self.lock:
+            self.callbacks.setdefault(username, set()).add(callback)
+
+    def unsubscribe(self, username, callback):
+        '''Stops calling a callback registered with subscribe().'''
+        with self.lock:
+            callbacks = self.callbacks.get(username, set())
+            callbacks.discard(callback)
+            if not callbacks:
+                self.callbacks.pop(username, None)
+
+    def wait(self, username, version, timeout=None):
+        '''
+        Blocks until the user's version differs from the given one or the
+        timeout expires. Returns the user's current version.
+        '''
+        condition = self._condition(username)
+        with condition:
+            condition.wait_for(lambda: self.versions[username] != version, timeout)
+            return self.versions[username]
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_pattern(searchterm):
+    '''Compiles a ListAccounts search term, caching recent patterns.'''
+    return re.compile(searchterm)
+
+
+def literal_prefix(searchterm):
+    '''
+    Returns the literal text every match of an anchored search term starts
+    with, e.g. 'ab' for '^abc*'. Returns '' if there is no such prefix.
+    '''
+    if not searchterm.startswith('^') or '|' in searchterm:
+        return ''
+
+    prefix = ''
+    for i, char in enumerate(searchterm[1:], start=1):
+        if char in '.^$*+?{}[]()|\\':
+            # A quantifier may repeat the previous character zero times
+            if char in '*?{':
+                prefix = prefix[:-1]
+            return prefix
+        prefix += char
+    return prefix
+
+
+class AccountIndex:
+    '''
+    In-memory copy of the accounts table. A sorted list of usernames serves
+    ListAccounts: search terms with a literal prefix only scan the range of
+    names starting with it. Alongside it, the set of usernames and the set
+    of logged in users answer the existence and presence checks of the
+    message rpcs without a query.
+
+    Writes update it from inside their transaction, so that later writes in
+    the same group commit already see the change, and undo the update if
+    the write is rolled back.
+    '''
+    def __init__(self, usernames=(), logged_in=()):
+        self.lock = Lock()
+        self.usernames = sorted(usernames)
+        self.names = set(self.usernames)
+        self.online = set(logged_in) & self.names
+
+    def add(self, username):
+        with self.lock:
+            if username not in self.names:
+                insort(self.usernames, username)
+                self.names.add(username)
+
+    def remove(self, username):
+        with self.lock:
+            if username in self.names:
+                del self.usernames[bisect_left(self.usernames, username)]
+                self.names.discard(username)
+                self.online.discard(username)
+
+    def set_status(self, username, status):
+        '''Marks an existing account as logged in (1) or logged out (0).'''
+        with self.lock:
+            if username not in self.names:
+                return
+            if status:
+                self.online.add(username)
+            else:
+                self.online.discard(username)
+
+    def status(self, username):
+        '''Returns 1 if the user is logged in, 0 if not and None if there is no such account.'''
+        if username not in self.names:
+            return None
+        return int(username in self.online)
+
+    def search(self, searchterm, cursor, limit):
+        '''
+        Returns up to limit usernames after cursor that match searchterm, and
+        the cursor of the next page ('' if this is the last page).
+        '''
+        pattern = compile_pattern(searchterm)
+        prefix = literal_prefix(searchterm)
+
+        matches = []
+        with self.lock:
+            i = max(bisect_left(self.usernames, prefix), bisect_right(self.usernames, cursor))
+            while i < len(self.usernames) and self.usernames[i].startswith(prefix):
+                if pattern.search(self.usernames[i]) is not None:
+                    if len(matches) == limit:
+                        return matches, matches[-1]
+                    matches.append(self.usernames[i])
+                i += 1
+        return matches, ''
+
+
+class Admission:
+    '''
+    Admission control for the messages clients send. Token buckets refill
+    at a rate in messages per second: one per sender, and one for the
+    whole replica. Each holds up to RATE_LIMIT_BURST seconds of its rate. A
+    write takes a token from its sender's bucket and one from the replica's
+    for every message it carries. If either bucket is empty, the write is
+    rejected before any work is done for it, so a client flooding
+    SendMessage costs the replica little beyond the calls themselves. A
+    rate of 0 turns that limit off.
+
+    A batch larger than a bucket holds is admitted once the bucket is full
+    and leaves it in debt, so later writes wait for it to refill.
+    '''
+    def __init__(self, user_rate=USER_RATE_LIMIT, global_rate=GLOBAL_RATE_LIMIT):
+        self.lock = Lock()
+        self.user_rate = user_rate
+        self.global_rate = global_rate
+        self.users = {}   # Username -> (tokens, when they were counted)
+        self.total = (global_rate * RATE_LIMIT_BURST, monotonic())
+        self.kept = 0     # Number of user buckets after the last pruning
+
+    def tokens(self, bucket, rate, now):
+        '''Returns the tokens in a (tokens, when) bucket at the given time.'''
+        tokens, when = bucket
+        return min(rate * RATE_LIMIT_BURST, tokens + (now - when) * rate)
+
+    def admit(self, costs):
+        '''
+        Takes the tokens for a write that sends costs[username] messages
+        from each sender. Returns None if the write is admitted, or the
+        limit it exceeds, 'user' or 'global', in which case nothing is taken.
+        '''
+        now = monotonic()
+        cost = sum(costs.values())
+        with self.lock:
+            users = {}
+            if self.user_rate:
+                for username, n in costs.items():
+                    tokens = self.tokens(self.users.get(username, (inf, now)), self.user_rate, now)
+                    if tokens < min(n, self.user_rate * RATE_LIMIT_BURST):
+                        return 'user'
+                    users[username] = (tokens - n, now)
+            if self.global_rate:
+                total = self.tokens(self.total, self.global_rate, now)
+                if total < min(cost, self.global_rate * RATE_LIMIT_BURST):
+                    return 'global'
+                self.total = (total - cost, now)
+            self.users.update(users)
+
+            # A full bucket is the same as none, so the ones that refilled are dropped from time to time
+            if len(self.users) > max(2 * self.kept, 1024):
+                full = self.user_rate * RATE_LIMIT_BURST
+                self.users = {u: b for u, b in self.users.items() if self.tokens(b, self.user_rate, now) < full}
+                self.kept = len(self.users)
+        return None
+
+
+class RequestWindow:
+    '''
+    The request ids clients gave the messages of the latest REQUEST_WINDOW
+    operations. A client retries a send it got no answer for, although the
+    primary may have stored the message; a message whose request id is
+    still in the window is not stored again. Every replica applies the same
+    operations in order, so they all skip the same messages.
+    '''
+    def __init__(self):
+        self.seqs = {}   # Request id -> operation it first came in, oldest first
+
+    def seen(self, request_id, seq):
+        '''Returns whether a message with this request id came within the window before operation seq.'''
+        return request_id in self.seqs and self.seqs[request_id] > seq - REQUEST_WINDOW
+
+    def add(self, request_id, seq):
+        '''Records the request id of a message in operation seq, and forgets those the window has left behind.'''
+        self.seqs[request_id] = seq
+        while self.seqs:
+            oldest = next(iter(self.seqs))
+            if self.seqs[oldest] > seq - REQUEST_WINDOW:
+                break
+            del self.seqs[oldest]
+
+    def forget(self, seq):
+        '''Forgets the request ids of operation seq again, when the write that recorded them rolls back.'''
+        while self.seqs and next(reversed(self.seqs.values())) == seq:
+            self.seqs.popitem()
+
+
+class Aborted(Exception):
+    '''Raised by ThreadContext.abort(), with the status the call is to end with.'''
+    def __init__(self, code, details):
+        super().__init__(details)
+        self.code, self.details = code, details
+
+
+class ThreadContext:
+    '''
+    The context of a call for a plain handler that a coroutine handler
+    runs in a thread. Everything passes through to the call's context but
+    abort(), which is a coroutine on the grpc.aio server: it raises
+    Aborted, for the coroutine to end the call with. admitted tells that
+    the coroutine has already admitted the call, see ChatService.admit.
+    '''
+    admitted = False
+
+    def __init__(self, context):
+        self.context = context
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+    def abort(self, code, details):
+        raise Aborted(code, details)
+
+
+class AckContext(ThreadContext):
+    '''
+    The context a ListenMessages stream acknowledges the messages it
+    delivered in. A write concern that is not met does not end the stream
+    with ABORTED: the primary has archived the messages, and the other
+    replicas catch up on their own.
+    '''
+    def set_code(self, code):
+        pass
+
+    def set_details(self, details):
+        pass
+
+
+# Operations whose messages a client may retry, see RequestWindow
+RETRIED_METHODS = ('SendMessage', 'SendMessages', 'DeliverMessage')
+
+# Request type of every replicated operation, used to decode the operation log
+REQUEST_TYPES = {
+    'CreateAccount': pb2.Account,
+    'DeleteAccount': pb2.Account,
+    'Login': pb2.Account,
+    'Logout': pb2.Account,
+    'SendMessage': pb2.MessageInfo,
+    'SendMessages': pb2.MessageBatch,
+    'AcknowledgeMessages': pb2.Cursor,
+    'DeliverMessage': pb2.MessageInfo,
+    'ImportAccount': pb2.AccountData,
+    'ReleaseAccount': pb2.Account,
+    'Skip': pb2.NoParam,
+}
+
+
+def encode_request(request):
+    '''Serializes a replicated request for the operation log.'''
+    if isinstance(request, list):
+        request = pb2.MessageBatch(messages=request)
+    return request.SerializeToString()
+
+
+def decode_request(method, payload):
+    '''Parses a request stored in the operation log.'''
+    request = REQUEST_TYPES[method].FromString(payload)
+    return list(request.messages) if method == 'SendMessages' else request
+
+
+def relayed_seq(context):
+    '''Returns the sequence number the primary attached to a relayed operation, or 0.'''
+    return int(dict(context.invocation_metadata()).get('seq', 0))
+
+
+def forwarded(context):
+    '''Returns whether another shard forwarded this call, so it must not be forwarded again.'''
+    return 'forwarded' in dict(context.invocation_metadata())
+
+
+def write_concern(context):
+    '''Returns the write concern a client asked for in the write-concern metadata, or None.'''
+    return dict(context.invocation_metadata()).get('write-concern')
+
+
+def staleness_bound(context):
+    '''Returns the staleness in seconds a client accepts for a read, or None for any.'''
+    bound = dict(context.invocation_metadata()).get('max-staleness')
+    return None if bound is None else float(bound)
+
+
+# Write concern of the writes that do not ask for one, see ChatService.replicated
+cluster_concern = WRITE_CONCERN
+
+# (time sent, last sequence number) of the primary's recent heartbeat answers
+primary_positions = deque(maxlen=POSITION_HISTORY)
+
+# Rate limits on the messages clients send, see ChatService.admit
+admission = Admission()
+
+# Leader election of this replica's group in consensus mode, None when heartbeat_primary picks the primary
+election = None
+
+# Without consensus, the term in which the primary this replica follows took the role. Every replica that
+# takes over starts a later one, so a deposed primary's claim loses and its operations conflict with the new ones
+primary_term = 0
+
+# Worker processes of this replica, None when a single process serves it
+workers = None
+
+# Storage engine of this replica, see storage.Storage
+storage_engine = SqliteStorage
+
+# Shard of this replica's group, the ring that maps usernames to shards, the
+# ring before the rebalance in progress (if any) and a ReplicaGroup for every
+# other shard, see ChatService.route
+shard_index = 0
+RING = HashRing([0])
+PREVIOUS_RING = None
+GROUPS = [None]
+
+
+def database_path():
+    '''Returns the database file of this replica. Shard 0 keeps the names from before sharding.'''
+    name = f'chat_{index}' if shard_index == 0 else f'chat_{shard_index}_{index}'
+    return name + storage_engine.suffix
+
+
+def leading():
+    '''
+    Returns whether this replica acts as the primary. In consensus mode that
+    takes holding the leader's lease, so no two replicas do at once. Workers
+    other than the lead go by the lease the lead shares with them.
+    '''
+    if workers is not None and workers.worker:
+        return monotonic() < workers.lease.value
+    if election is None:
+        return primary_index == index
+    return election.has_lease(monotonic())
+
+
+def share_lease(until):
+    '''Tells the other workers of this replica until when it acts as the primary.'''
+    if workers is not None:
+        workers.lease.value = until
+
+
+def record_position(sent, seq):
+    '''Remembers how far the primary was at a given time, on every worker of this replica.'''
+    primary_positions.append((sent, seq))
+    if workers is not None:
+        workers.publish('position', sent, seq)
+
+
+def lead_address():
+    '''Returns the unix socket on which the lead worker of this replica takes the calls of the others.'''
+    return 'unix:' + os.path.splitext(database_path())[0] + '.sock'
+
+
+def current_term():
+    '''Returns the term of the primary this replica follows or is: the election's in consensus mode, primary_term otherwise.'''
+    return election.term if election is not None else primary_term
+
+
+def peers():
+    '''
+    Returns the (index, stub) of every replica the primary relays to: every
+    other one, since a replica before the primary may be back and follow it.
+    '''
+    return [(i, stub) for i, stub in enumerate(STUBS) if i != index]
+
+
+class Replicator:
+    '''
+    Relays the primary's operations to one secondary over a long-lived
+    Replicate stream. Operations are queued in sequence order and sent as
+    LogBatch frames holding whatever queued up since the previous frame,
+    with up to REPLICATION_WINDOW frames in flight. While the secondary
+    applies one, the next fills up, so frames grow by themselves under load
+    and the secondary commits one transaction per frame rather than per
+    operation. The secondary acknowledges each frame it applied with its
+    applied position, which covers every earlier operation.
+
+    If the stream breaks, the operations queued or in flight are given up
+    on and the secondary picks them up in catch_up(). Until the secondary
+    answers a heartbeat again, new operations are given up on right away,
+    so writes do not wait for a replica that is down.
+
+    The Replicators of a primary share one condition, so a write can wait
+    for acknowledgements from several secondaries at once.
+    '''
+    def __init__(self, i, stub, cond):
+        self.i = i
+        self.stub = stub
+        self.cond = cond
+        self.queue = deque()    # (seq, method, payload, term, start) not sent yet
+        self.inflight = deque() # (seq, method, start) sent and not acknowledged yet
+        self.frames = 0         # Frames sent and not answered yet, every frame gets one answer
+        self.acked = 0          # Every operation up to here was applied by the secondary
+        self.failed = 0         # Every operation up to here that was not applied was given up on
+        self.last = 0           # Last operation queued or given up on
+        self.oldest = None      # When the oldest operation the secondary has not acknowledged was sent
+        self.down = False
+        self.broken = False
+        metrics.REPLICATION_LAG.labels(str(i)).set_function(lambda: self.lag()[0])
+        metrics.REPLICATION_LAG_SECONDS.labels(str(i)).set_function(lambda: self.lag()[1])
+        Thread(target=self.run, daemon=True).start()
+
+    def send(self, seq, method, payload, term):
+        '''Queues an operation for the secondary. Called in sequence order.'''
+        with self.cond:
+            now = perf_counter()
+            self.last = seq
+            if self.oldest is None:
+                self.oldest = now
+            if self.down:
+                metrics.REPLICATION_ERRORS.labels(str(self.i), method).inc()
+                self.failed = seq
+            else:
+                self.queue.append((seq, method, payload, term, now))
+            self.cond.notify_all()
+
+    def settled(self, seq):
+        '''Returns whether the secondary applied an operation or it was given up on.'''
+        return self.acked >= seq or self.failed >= seq
+
+    def lag(self):
+        '''
+        Returns how many operations the secondary has not acknowledged, and
+        for how many seconds the oldest of them has been waiting.
+        '''
+        with self.cond:
+            return self.last - min(self.acked, self.last), 0.0 if self.oldest is None else perf_counter() - self.oldest
+
+    def batches(self):
+        '''Yields the frames of the Replicate stream until it breaks.'''
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.broken or self.queue and self.frames < REPLICATION_WINDOW)
+                if self.broken:
+                    return
+                entries = [self.queue.popleft() for _ in range(min(len(self.queue), REPLICATION_BATCH_SIZE))]
+                self.inflight.extend((seq, method, start) for seq, method, _, _, start in entries)
+                self.frames += 1
+            yield pb2.LogBatch(entries=[
+                pb2.LogEntry(seq=seq, method=method, payload=payload, term=term) for seq, method, payload, term, _ in entries
+            ])
+
+    def acknowledge(self, seq):
+        '''Records the answer to a frame: the secondary applied every operation up to seq.'''
+        now = perf_counter()
+        with self.cond:
+            while self.inflight and self.inflight[0][0] <= seq:
+                _, method, start = self.inflight.popleft()
+                metrics.REPLICATION_LATENCY.labels(str(self.i), method).observe(now - start)
+            self.frames -= 1
+            self.acked = max(self.acked, seq)
+
+            # Operations given up on earlier are left to catch_up() and no longer count as waiting
+            if self.acked >= self.last:
+                self.oldest = None
+            elif self.inflight or self.queue:
+                self.oldest = (self.inflight or self.queue)[0][-1]
+            self.cond.notify_all()
+
+    def give_up(self):
+        '''Gives up on the operations queued or in flight when the stream breaks.'''
+        with self.cond:
+            self.broken = True
+            dropped = [(seq, method) for seq, method, _ in self.inflight] + [(seq, method) for seq, method, _, _, _ in self.queue]
+            for seq, method in dropped:
+                metrics.REPLICATION_ERRORS.labels(str(self.i), method).inc()
+                self.failed = max(self.failed, seq)
+            self.inflight.clear()
+            self.frames = 0
+            self.queue.clear()
+            self.cond.notify_all()
+
+    def run(self):
+        '''Keeps a Replicate stream open to the secondary, reopening it when it breaks.'''
+        while True:
+            try:
+                self.stub.Heartbeat(pb2.NoParam(), timeout=PROBE_TIMEOUT)
+            except grpc.RpcError:
+                with self.cond:
+                    self.down = True
+                self.give_up()
+                sleep(REPLICATION_RETRY)
+                continue
+
+            with self.cond:
+                self.down = self.broken = False
+            try:
+                for position in self.stub.Replicate(self.batches()):
+                    self.acknowledge(position.seq)
+            except grpc.RpcError:
+                pass
+            self.give_up()
 
 
 class ChatService(pb2_grpc.ChatServicer):
     def __init__(self, *args, **kwargs):
-        # Add database and link it to this server
+        # Wakes up listening streams when new messages arrive
+        self.notifier = MessageNotifier()
+
+        # Add the storage of this replica and link it to this server, see load_storage
+        self.storage_lock = Lock()
+        self.rejoin_lock = Lock()
+        self.rejoined = 0
+        self.id_lock = Lock()
+        self.seq_lock = Lock()
+        self.db = storage_engine(database_path())
+        self.load_storage()
+
+        # A Replicator per secondary, started once this replica acts as the primary
+        self.relay_lock = Lock()
+        self.replicators = None
+        self.acks = Condition()
+
+        # When the primary's latest Replicate frame arrived, see repair_gaps
+        self.relayed_at = 0.0
+
+        # Every worker but the lead hands writes and replication to the lead, see workers.Workers
+        self.lead = None
+        if workers is not None and workers.worker:
+            self.lead = pb2_grpc.ChatStub(grpc.insecure_channel(lead_address()))
+
+        # Functions that apply each replicated operation inside a write transaction
+        self.operations = {
+            'CreateAccount': self.create_account,
+            'DeleteAccount': self.delete_account,
+            'Login': self.login,
+            'Logout': self.logout,
+            'SendMessage': self.send_message,
+            'SendMessages': self.send_messages,
+            'AcknowledgeMessages': self.acknowledge_messages,
+            'DeliverMessage': self.deliver_message,
+            'ImportAccount': self.import_account,
+            'ReleaseAccount': self.release_account,
+            'Skip': self.skip,
+        }
+
+    def load_storage(self):
+        '''Sets up what is kept in memory from the storage, when the replica starts or rejoins.'''
+        # Message ids are handed out by the primary so that they are the same on every replica
+        self.next_ticket = (self.db.last_message_id() >> SHARD_BITS) + 1
+
+        # Accounts and who is logged in are kept in memory for ListAccounts and the message rpcs
+        rows = self.db.accounts()
+        self.accounts = AccountIndex([r[0] for r in rows], [r[0] for r in rows if r[1] == 1])
+
+        # Every replicated operation gets a sequence number in the operation log
+        self.last_seq = self.db.last_seq()
+
+        # Messages that clients retried are stored once, see RequestWindow
+        self.requests = RequestWindow()
+        for seq, method, payload, _ in self.db.log_entries(max(0, self.last_seq - REQUEST_WINDOW), REQUEST_WINDOW):
+            if method in RETRIED_METHODS:
+                self.drop_retried(seq, method, decode_request(method, payload))
+
+    def assign_message_ids(self, messages):
+        '''
+        Gives each new message an id. Only the primary hands out ids, the
+        secondaries store messages under the id chosen by the primary. An id
+        is the time in microseconds with the shard in its low SHARD_BITS, so
+        ids are unique across shards and a conversation stored on two shards
+        can be merged in order. replicated() assigns them under relay_lock
+        along with the sequence number, so a message with a lower id is
+        never committed after one with a higher id. Otherwise a stream could
+        move its cursor past a message that commits later, and the range
+        acknowledgement would archive that message without delivering it.
+        '''
+        with self.id_lock:
+            for message in messages:
+                ticket = max(self.next_ticket, time_ns() // 1000)
+                message.id = ticket << SHARD_BITS | shard_index
+                self.next_ticket = ticket + 1
+
+    def reserve_message_ids(self, messages):
+        '''Moves the id counter past the ids of messages stored on this replica.'''
+        with self.id_lock:
+            for message in messages:
+                self.next_ticket = max(self.next_ticket, (message.id >> SHARD_BITS) + 1)
+
+    def next_seq(self, seq=0):
+        '''
+        Returns the sequence number of a new operation. Operations relayed by
+        the primary keep their number and only move this replica's counter.
+        '''
+        with self.seq_lock:
+            if not seq:
+                seq = self.last_seq + 1
+            self.last_seq = max(self.last_seq, seq)
+            return seq
+
+    def applied_seq(self):
+        '''Returns the sequence number up to which every operation has been applied.'''
+        return self.db.applied_seq()
+
+    def log_position(self):
+        '''Returns the (term, seq) of the last operation up to which every operation has been applied.'''
+        return self.db.log_position()
 
-        self.conn = sqlite3.connect(f'chat_{index}.db', check_same_thread=False)
+    def saved_vote(self):
+        '''Returns the term and the vote cast in it that this replica saved, for consensus mode.'''
+        return self.db.saved_vote()
 
-        cursor = self.conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS accounts
-                       (username TEXT unique, password TEXT, status INTEGER)''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS messages
-                       (source TEXT, destination TEXT, text TEXT)''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS history
-                       (source TEXT, destination TEXT, text TEXT)''')
-        self.conn.commit()
-        cursor.close()
+    def save_vote(self, term, voted_for):
+        '''Saves the current term and the vote cast in it before they are acted upon.'''
+        self.db.save_vote(term, voted_for)
 
-    def WriteToCommitLog(self, log_name, message):
+    def WriteToCommitLog(self, tx, seq, method, request, term):
+        '''
+        Writes a replicated operation to the operation log. Returns False if
+        the log already holds this sequence number, i.e. the operation has
+        been applied before. Raises LogConflict if it was logged in another
+        term: two leaders handed out the same number, and this replica has
+        applied the operation of one that a majority did not acknowledge.
+        '''
+        logged = self.db.log_operation(tx, seq, method, encode_request(request), term)
+        if logged is None:
+            return True
+        if logged != term:
+            raise LogConflict(seq, logged, term)
+        return False
+
+    def apply(self, entries):
+        '''
+        Logs and applies (seq, method, request, term) operations in one
+        transaction, skipping the ones that were applied before. Returns
+        their responses.
+        '''
+        return self.queue_entries(entries).result()
+
+    def queue_entries(self, entries):
+        '''
+        Like apply(), but only queues the transaction on the writer thread
+        and returns a Future of the responses. Writes are committed in the
+        order they are queued.
         '''
-        Writes the given message to the commit log.
+        def write(tx):
+            responses = []
+            for seq, method, request, term in entries:
+                if self.WriteToCommitLog(tx, seq, method, request, term):
+                    if method in RETRIED_METHODS:
+                        request = self.drop_retried(seq, method, request)
+                        self.db.on_rollback(lambda seq=seq: self.requests.forget(seq))
+                    if request is None:
+                        result = f"Operation {seq} sends a message that was already sent."
+                        responses.append(pb2.ServerResponse(message=result, error=False))
+                        continue
+                    with metrics.SQLITE_LATENCY.labels(method).time():
+                        responses.append(self.operations[method](tx, request))
+                else:
+                    result = f"Operation {seq} was already applied."
+                    responses.append(pb2.ServerResponse(message=result, error=False))
+            return responses
+        with self.storage_lock:
+            return self.db.submit(write)
+
+    def drop_retried(self, seq, method, request):
         '''
-        with open('commit.log', 'a') as f:
-            f.write(message)
+        Takes the messages a client already sent in the last REQUEST_WINDOW
+        operations out of a SendMessage, SendMessages or DeliverMessage
+        request, and records the request ids of the others. Returns what is
+        left of the request, or None if nothing is.
+        '''
+        messages = request if method == 'SendMessages' else [request]
+        fresh = [m for m in messages if not m.request_id or not self.requests.seen(m.request_id, seq)]
+        for message in fresh:
+            if message.request_id:
+                self.requests.add(message.request_id, seq)
+        if method == 'SendMessages':
+            return fresh
+        return request if fresh else None
+
+    def require_primary(self, context):
+        '''
+        Fails a write that the primary did not relay with UNAVAILABLE on a
+        replica that is not the primary. Returns whether this one is.
+        '''
+        primary = leading()
+        if not primary and not relayed_seq(context):
+            if election is not None:
+                context.abort(grpc.StatusCode.UNAVAILABLE, f'Replica {index} is not the leader of term {election.term}.')
+            context.abort(grpc.StatusCode.UNAVAILABLE, f'Replica {index} is not the primary, replica {primary_index} is.')
+        return primary
+
+    def replicated(self, method, request, context):
+        '''
+        Runs a mutating RPC. Every operation gets a sequence number and is
+        stored in the operation log together with its changes. If this
+        replica is the primary, the operation is queued on every secondary's
+        Replicate stream while it is applied locally, so a write costs
+        roughly one round-trip however many replicas there are, and many
+        writes share it. The primary answers once as many secondaries as
+        the write concern requires have applied it (see required_acks), and
+        the others catch up on their own. If fewer secondaries are reachable
+        than the write concern requires, the call fails with UNAVAILABLE
+        before anything is applied, and the client retries it. A write
+        concern that is not met within REPLICATION_TIMEOUT fails the call
+        with ABORTED, although the primary has applied the write. A replica that is not the primary, or
+        in consensus mode does not hold the leader's lease, fails the call
+        with UNAVAILABLE, so the client looks for the primary and retries;
+        taking a sequence number of its own would collide with the primary's.
+        '''
+        primary = self.require_primary(context)
+        if primary:
+            concern = write_concern(context) or cluster_concern
+            if concern not in WRITE_CONCERNS:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Unknown write concern '{concern}', pick one of {', '.join(WRITE_CONCERNS)}.")
+            required = self.required_acks(concern)
+            reachable = sum(not r.down for r in self.secondaries())
+            if reachable < required:
+                context.abort(grpc.StatusCode.UNAVAILABLE, f"Only {reachable} of the {required} secondaries the '{concern}' "
+                                                           f"write concern requires are reachable, the write was not applied.")
+
+        # The write is queued locally under the same lock as on the Replicate streams,
+        # so the primary commits operations in the order the secondaries apply them
+        replicators = self.secondaries() if primary else []
+        with self.relay_lock:
+            # Message ids grow with sequence numbers, so messages are committed in id order
+            if not relayed_seq(context) and method in ('SendMessage', 'SendMessages', 'DeliverMessage'):
+                self.assign_message_ids(request if method == 'SendMessages' else [request])
+            seq = self.next_seq(relayed_seq(context))
+            term = current_term()
+            if replicators:
+                payload = encode_request(request)
+                for replicator in replicators:
+                    replicator.send(seq, method, payload, term)
+            applied = self.queue_entries([(seq, method, request, term)])
+
+        response = applied.result()[0]
+
+        if primary:
+            acked = self.wait_for_acks(seq, required, REPLICATION_TIMEOUT)
+            if acked < required:
+                context.set_code(grpc.StatusCode.ABORTED)
+                context.set_details(f"Operation {seq} was applied on the primary, but only {acked} of the {required} "
+                                    f"secondaries the '{concern}' write concern requires acknowledged it.")
+
+        return response
+
+    def required_acks(self, concern):
+        '''
+        Returns how many secondaries must acknowledge a write under a write
+        concern: none for 'primary', enough to make a majority of all the
+        replicas with the primary for 'majority', and every other replica for
+        'all'. Replicas that are down still count, so a write is never
+        acknowledged by fewer replicas than the concern promises. In
+        consensus mode every write takes at least a majority: the next
+        leader only holds what a majority applied, and a replica that
+        applied anything else drops it when it rejoins, see rejoin.
+        '''
+        if concern == 'all':
+            return len(peers())
+        if concern == 'majority' or election is not None:
+            return len(STUBS) // 2
+        return 0
+
+    def wait_for_acks(self, seq, required, timeout):
+        '''
+        Waits until required secondaries have applied an operation, or it
+        can no longer happen, or the timeout expires. Returns how many have.
+        '''
+        replicators = self.replicators or []
+        with self.acks:
+            acked = lambda: sum(r.acked >= seq for r in replicators)
+            pending = lambda: sum(not r.settled(seq) for r in replicators)
+            self.acks.wait_for(lambda: acked() >= required or acked() + pending() < required, timeout)
+            return acked()
+
+    def secondaries(self):
+        '''Returns the Replicator of every secondary, starting them the first time.'''
+        with self.relay_lock:
+            if self.replicators is None:
+                self.replicators = [Replicator(i, s, self.acks) for i, s in peers()]
+            return self.replicators
+
+    def log_entry(self, entry):
+        '''Turns a LogEntry from another replica into a (seq, method, request, term) operation.'''
+        self.next_seq(entry.seq)
+        return entry.seq, entry.method, decode_request(entry.method, entry.payload), entry.term
+
+    def Replicate(self, request_iterator, context):
+        '''
+        Applies the operations the primary streams to this replica, a frame
+        at a time in one transaction, and acknowledges every frame with the
+        position up to which every operation has been applied. If operations
+        before the frame are missing, e.g. because the stream broke or the
+        primary changed, they are caught up on from the primary before the
+        frame is applied. Every replica thus applies operations in the same
+        order and drops the same retried messages, see RequestWindow.
+
+        A frame from a primary of an earlier term ends the stream. An
+        operation that conflicts with one logged here means this replica
+        holds operations of a deposed primary, so it rejoins from the
+        primary, see rejoin.
+        '''
+        if self.lead is not None:
+            try:
+                yield from self.forward('Replicate', request_iterator, context)
+            except grpc.RpcError as e:
+                context.abort(e.code(), e.details())
+            return
+        for batch in request_iterator:
+            self.relayed_at = monotonic()
+            if any(entry.term < current_term() for entry in batch.entries):
+                context.abort(grpc.StatusCode.FAILED_PRECONDITION, f'Replica {index} is in term {current_term()}, later than the sender.')
+            entries = [self.log_entry(entry) for entry in batch.entries]
+            if entries:
+                if self.applied_seq() < entries[0][0] - 1 and primary_index != index:
+                    self.catch_up(primary_index)
+                try:
+                    self.apply(entries)
+                except LogConflict as e:
+                    if primary_index == index:
+                        print(f'Replica {index} diverged from the replica relaying to it, restart it with --bootstrap. {e}')
+                        context.abort(grpc.StatusCode.FAILED_PRECONDITION, str(e))
+                    self.rejoin(primary_index)
+                if self.applied_seq() < entries[-1][0] and primary_index != index:
+                    self.catch_up(primary_index)
+                # Catching up may have taken long enough for another primary to take over, see take_over
+                if entries[-1][3] < current_term():
+                    context.abort(grpc.StatusCode.FAILED_PRECONDITION, f'Replica {index} moved on to term {current_term()}.')
+                yield pb2.LogPosition(seq=self.applied_seq())
+
+    def catch_up(self, source=None):
+        '''
+        Brings this replica up to date after it was down. Every other
+        reachable replica, or only the given source, streams the operations
+        logged after this replica's applied position, so recovery takes time
+        proportional to the downtime rather than to the size of the database.
+        In consensus mode a follower only catches up from the leader, as other
+        replicas may hold operations of a deposed leader that no majority
+        acknowledged. The stream starts at this replica's last operation,
+        so a secondary that logged it in another term than the primary,
+        e.g. as a leader that was deposed before it could relay it, finds
+        the conflict and rejoins from the primary, see rejoin.
+        '''
+        for i, stub in enumerate(STUBS):
+            if i == index or source is not None and i != source:
+                continue
+            if election is not None and election.role != LEADER and i != election.leader:
+                continue
+
+            # Streaming from this replica's last operation on shows whether the source logged it in the same term
+            applied = self.applied_seq()
+            position = pb2.LogPosition(seq=max(0, applied - 1))
+            following = i == primary_index
+            count = 0
+            try:
+                for entries in self.missed_entries(stub, position):
+                    # A deposed primary's later operations would only be undone again, see rejoin
+                    if following and i != primary_index:
+                        break
+                    self.apply(entries)
+                    count += sum(seq > applied for seq, _, _, _ in entries)
+            except LogConflict as e:
+                if i == primary_index != index:
+                    self.rejoin(i)
+                    return
+                print(f'Replica {index} diverged from replica {i}, restart it with --bootstrap. {e}')
+
+            if count:
+                print(f'Replica {index} caught up on {count} operations from replica {i}.')
+
+    def missed_entries(self, stub, position):
+        '''
+        Yields the operations another replica logged after the given position
+        in batches of CATCH_UP_BATCH_SIZE. If the stream breaks, e.g. because
+        that replica went down, the operations received so far still are.
+        '''
+        entries = []
+        try:
+            for entry in stub.CatchUp(position, timeout=CATCH_UP_TIMEOUT):
+                entries.append(self.log_entry(entry))
+                if len(entries) == CATCH_UP_BATCH_SIZE:
+                    yield entries
+                    entries = []
+        except grpc.RpcError:
+            pass
+        if entries:
+            yield entries
+
+    def repair_gaps(self):
+        '''
+        Runs forever on every replica. First catches up on what the replica
+        missed while it was down, then again from the primary whenever a
+        secondary is still missing an operation one interval after it heard
+        of a later one: one relayed to it, or the primary's position in its
+        latest heartbeat answer or lease, e.g. because relayed operations
+        failed to reach it. A secondary that received a Replicate frame in
+        the meantime is only lagging; Replicate catches up on gaps itself.
+        '''
+        self.catch_up(None if leading() else primary_index)
+        target = 0
+        while True:
+            sleep(CATCH_UP_INTERVAL)
+            relayed = monotonic() - self.relayed_at < CATCH_UP_INTERVAL
+            if not leading() and not relayed and self.applied_seq() < target:
+                self.catch_up(primary_index)
+            target = max(self.last_seq, primary_positions[-1][1] if primary_positions else 0)
+
+    def skip_missing(self, term):
+        '''
+        Logs a no-op under every sequence number up to the last one this
+        replica heard of for which it holds no operation, once it took over
+        as the primary and caught up from every replica it could reach.
+        Nobody holds those operations any more, e.g. because the old primary
+        went down before relaying them, and without the no-ops no replica's
+        applied position would move past them again.
+        '''
+        applied = self.applied_seq()
+        held = {seq for seq, _, _, _ in self.db.log_entries(applied, self.last_seq - applied)}
+        missing = [seq for seq in range(applied + 1, self.last_seq + 1) if seq not in held]
+        if missing:
+            self.apply([(seq, 'Skip', pb2.NoParam(), term) for seq in missing])
+            print(f'Replica {index} skipped {len(missing)} operations no replica holds, from {missing[0]} to {missing[-1]}.')
+
+    def skip(self, tx, request):
+        '''Applies a no-op that skip_missing() logged in place of a lost operation.'''
+        return pb2.ServerResponse(message='Operation skipped.', error=False)
+
+    def diverged_from(self, i):
+        '''
+        Returns whether replica i does not hold this replica's last applied
+        operation in the same term, i.e. this replica logged an operation
+        that replica i never saw, e.g. as a deposed primary.
+        '''
+        term, seq = self.log_position()
+        if not seq:
+            return False
+        try:
+            for entry in STUBS[i].CatchUp(pb2.LogPosition(seq=seq - 1), timeout=CATCH_UP_TIMEOUT):
+                return entry.seq != seq or entry.term != term
+        except grpc.RpcError:
+            return False
+        return True
+
+    def reconcile(self, source):
+        '''Brings a replica that was the primary up to date with the new one, rejoining if it diverged.'''
+        if self.diverged_from(source):
+            self.rejoin(source)
+        else:
+            self.catch_up(source)
+
+    def rejoin(self, source):
+        '''
+        Replaces this replica's storage with a snapshot of the source's, once
+        its log diverged from the primary's: the operations of a deposed
+        primary that the new one never saw are dropped, as if the replica was
+        restarted with --bootstrap. Writes wait while the storage is swapped.
+        In consensus mode, the term and vote this replica saved are kept
+        rather than the source's. A replica served by several worker
+        processes has to be restarted by hand.
+        '''
+        if workers is not None:
+            print(f'Replica {index} diverged from replica {source}, restart it with --bootstrap.')
+            return
+        rejoined = self.rejoined
+        with self.rejoin_lock:
+            # Another thread may have found the divergence first
+            if self.rejoined != rejoined:
+                return
+            path = database_path()
+            seq = download_snapshot(path, [source])
+            with self.storage_lock:
+                self.db.close()
+                replace_storage(path)
+                self.db = storage_engine(path)
+                self.load_storage()
+                if election is not None:
+                    with election.lock:
+                        self.save_vote(election.term, election.voted_for)
+            self.rejoined += 1
+        print(f'Replica {index} diverged from replica {source} and rejoined from its snapshot at operation {seq}.')
+
+    def follow_workers(self):
+        '''
+        Runs forever on every worker of a replica served by several: applies
+        the events the other workers publish, see workers.Workers.
+        '''
+        while True:
+            self.handle_event(workers.receive())
+
+    def handle_event(self, event):
+        '''Applies an event another worker of this replica published.'''
+        if event[0] == 'user':
+            self.reload_account(event[1])
+        elif event[0] == 'position':
+            primary_positions.append(event[1:])
+        elif event[0] == 'ring':
+            use_ring(pb2.Ring.FromString(event[1]))
+
+    def staleness(self):
+        '''
+        Returns how many seconds this replica may lag behind the primary: the
+        time since the latest heartbeat at which the primary had no operation
+        this replica is still missing. The primary is never stale; in
+        consensus mode the lease guarantees that without asking the others.
+        '''
+        if leading():
+            return 0.0
+        applied = self.applied_seq()
+        for sent, seq in reversed(list(primary_positions)):
+            if seq <= applied:
+                return monotonic() - sent
+        return float('inf')
+
+    def fresh_enough(self, context):
+        '''
+        Checks a read against the staleness bound the client sent along. If
+        this replica lags too far behind, the call fails with
+        FAILED_PRECONDITION so the client can ask another replica.
+        '''
+        bound = staleness_bound(context)
+        if bound is None:
+            return True
+        staleness = self.staleness()
+        if staleness <= bound:
+            return True
+        context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
+        context.set_details(f'Replica {index} is {staleness:.2f}s behind the primary, more than {bound:.2f}s.')
+        return False
+
+    def CatchUp(self, request, context):
+        '''
+        Streams the operation log entries after the given sequence number.
+        The stream stops being iterated if the caller goes away, so it only
+        has to end once the log is exhausted.
+        '''
+        seq = request.seq
+        while True:
+            rows = self.db.log_entries(seq, CATCH_UP_BATCH_SIZE)
+            if not rows:
+                break
+            for seq, method, payload, term in rows:
+                yield pb2.LogEntry(seq=seq, method=method, payload=payload, term=term)
+
+    def StreamSnapshot(self, request, context):
+        '''
+        Streams a consistent snapshot of this replica's storage in chunks,
+        to bootstrap a new replica. The first chunk carries the log position
+        of the snapshot, from which the new replica catches up.
+        '''
+        fd, path = tempfile.mkstemp(prefix=f'chat_{index}_', suffix='.snapshot', dir='.')
+        os.close(fd)
+        try:
+            seq = self.db.snapshot(path)
+
+            print(f'Streaming snapshot at operation {seq} from {index}.')
+
+            with open(path, 'rb') as f:
+                chunk = pb2.SnapshotChunk(data=f.read(SNAPSHOT_CHUNK_SIZE), seq=seq, size=os.path.getsize(path))
+                while chunk.data:
+                    yield chunk
+                    chunk = pb2.SnapshotChunk(data=f.read(SNAPSHOT_CHUNK_SIZE))
+        finally:
+            os.remove(path)
+
+    def locate(self, username):
+        '''
+        Returns the shard that holds the user's account: this one if it has
+        it, otherwise the user's shard on the ring. While a rebalance moves
+        accounts to this shard, the ones not moved yet are still on their
+        shard on the previous ring.
+        '''
+        if self.accounts.status(username) is not None:
+            return shard_index
+        owner = RING.shard_for(username)
+        if owner == shard_index and PREVIOUS_RING is not None:
+            owner = PREVIOUS_RING.shard_for(username)
+        return owner
+
+    def route(self, method, username, request, context):
+        '''
+        Forwards a call about a user whose account is on another shard to
+        that shard's primary and returns its response, or returns None if
+        this shard handles the call. Operations relayed by the primary and
+        calls forwarded by another shard are never forwarded again.
+        '''
+        if relayed_seq(context) or forwarded(context):
+            return None
+        owner = self.locate(username)
+        if owner == shard_index:
+            return None
+
+        print(f'{method} for {username} forwarded from shard {shard_index} to shard {owner}.')
+        return GROUPS[owner].call(method, request, metadata=(('forwarded', '1'),))
+
+    def forward(self, method, request, context):
+        '''
+        Hands a call to the lead worker of this replica and returns its
+        response, or returns None if this worker handles the call itself.
+        A call the lead fails fails here with the same status.
+        '''
+        if self.lead is None:
+            return None
+        metadata = [(key, value) for key, value in context.invocation_metadata() if key != 'user-agent']
+        try:
+            return getattr(self.lead, method)(request, metadata=metadata)
+        except grpc.RpcError as e:
+            context.abort(e.code(), e.details())
 
     def CreateAccount(self, request, context):
         '''
         Creates a new account with the given username and password.
         If the username already exists, an error is returned.
         '''
-        # Sync with all secondary replicas if necessary
-        if primary_index == index:
-            for s in STUBS[index + 1:]:
-                try:
-                    s.CreateAccount(request)
-                except grpc._channel._InactiveRpcError:
-                    pass
-
+        forwarded = self.forward('CreateAccount', request, context)
+        if forwarded is not None:
+            return forwarded
+        routed = self.route('CreateAccount', request.username, request, context)
+        if routed is not None:
+            return routed
+        return self.replicated('CreateAccount', request, context)
+
+    def create_account(self, tx, request):
+        '''Applies CreateAccount to this replica's database.'''
         username = request.username
         password = request.password
 
         print(f'CreateAccount called from {index} for {username}.')
 
-        cursor = self.conn.cursor()
-
-        # Try to insert the new account into the database, if it already exists, return an error
-        try:
-            cursor.execute('''INSERT INTO accounts VALUES (?, ?, ?)''', (username, password, 0))
-            self.conn.commit()
+        # Try to add the new account to the storage, if it already exists, return an error
+        if self.db.add_account(tx, username, password):
+            self.accounts.add(username)
+            self.db.on_rollback(lambda: self.accounts.remove(username))
+            self.changed(username)
             result = f"Account creation success: '{username}' added."
             response = {'message': result, 'error': False}
-        except:
+        else:
             result = f"Account creation error: username '{username}' already in use."
             response = {'message': result, 'error': True}
 
-        cursor.close()
-
         return pb2.ServerResponse(**response)
 
 
@@ -75,28 +1217,30 @@ class ChatService(pb2_grpc.ChatServicer):
         Deletes the account with the given username and password.
         If the username or password is incorrect, an error is returned.
         '''
-        # Sync with all secondary replicas if necessary
-        if primary_index == index:
-            for s in STUBS[index + 1:]:
-                try:
-                    s.DeleteAccount(request)
-                except grpc._channel._InactiveRpcError:
-                    pass
-
+        forwarded = self.forward('DeleteAccount', request, context)
+        if forwarded is not None:
+            return forwarded
+        routed = self.route('DeleteAccount', request.username, request, context)
+        if routed is not None:
+            return routed
+        return self.replicated('DeleteAccount', request, context)
+
+    def delete_account(self, tx, request):
+        '''Applies DeleteAccount to this replica's database.'''
         username = request.username
         password = request.password
 
         print(f'DeleteAccount called from {index} for {username}.')
 
-        cursor = self.conn.cursor()
-
         try:
-            cursor.execute('''DELETE FROM accounts WHERE username = ? AND password = ?''', (username, password,))
-            deleted = cursor.rowcount
-            self.conn.commit()
-
             # If the account was deleted, return a success message
-            if deleted > 0:
+            if self.db.delete_account(tx, username, password):
+                status = self.accounts.status(username)
+                self.accounts.remove(username)
+                self.db.on_rollback(lambda: self.restore_account(username, status))
+
+                # End the user's message streams
+                self.changed(username)
                 result = f"Account deletion success: '{username}' deleted."
                 response = {'message': result, 'error': False}
             else:
@@ -108,44 +1252,74 @@ class ChatService(pb2_grpc.ChatServicer):
             result = f"Account deletion error: password for '{username}' is incorrect."
             response = {'message': result, 'error': True}
 
-        cursor.close()
-
         return pb2.ServerResponse(**response)
 
 
+    def set_status(self, username, status):
+        '''From inside a write: updates the user's presence along with the accounts table.'''
+        previous = self.accounts.status(username)
+        self.accounts.set_status(username, status)
+        if previous is not None:
+            self.db.on_rollback(lambda: self.accounts.set_status(username, previous))
+
+    def changed(self, username):
+        '''
+        From inside a write: wakes up the user's streams once the write is
+        committed, and has the other workers of this replica reload the
+        user's account and wake up theirs.
+        '''
+        self.db.after_commit(lambda: self.notifier.notify(username))
+        if workers is not None:
+            self.db.after_commit(lambda: workers.publish('user', username))
+
+    def reload_account(self, username):
+        '''Updates the in-memory account of a user another worker changed, and wakes up the user's streams.'''
+        account = self.db.account(username)
+        if account is None:
+            self.accounts.remove(username)
+        else:
+            self.accounts.add(username)
+            self.accounts.set_status(username, account[1])
+        self.notifier.notify(username)
+
+    def restore_account(self, username, status):
+        '''Puts a deleted account back into the in-memory accounts after a rollback.'''
+        self.accounts.add(username)
+        self.accounts.set_status(username, status)
+
     def Login(self, request, context):
         '''
         Once use logs in, server immediately creates a thread for that
         user that is working on user's behalf looking for messages.
         '''
-        # Sync with all secondary replicas if necessary
-        if primary_index == index:
-            for s in STUBS[index + 1:]:
-                try:
-                    s.Login(request)
-                except grpc._channel._InactiveRpcError:
-                    pass
-
+        forwarded = self.forward('Login', request, context)
+        if forwarded is not None:
+            return forwarded
+        routed = self.route('Login', request.username, request, context)
+        if routed is not None:
+            return routed
+        return self.replicated('Login', request, context)
+
+    def login(self, tx, request):
+        '''Applies Login to this replica's database.'''
         username = request.username
         password = request.password
 
         print(f'Login called from {index} for {username}.')
 
-        cursor = self.conn.cursor()
-
         # Find the account with the given username
-        cursor.execute('''SELECT * FROM accounts WHERE username = ?''', (username,))
-        account = cursor.fetchone()
+        account = self.db.account(username, tx)
 
         if account:
             # If the account exists, check if the password is correct
-            if password != account[1]:
+            if password != account[0]:
                 result = f"Login error: incorrect password for '{username}'."
                 response = {'message': result, 'error': True}
             else:
                 try:
-                    cursor.execute('''UPDATE accounts SET status = 1 WHERE username = ?''', (username,))
-                    self.conn.commit()
+                    self.db.set_status(tx, username, 1)
+                    self.set_status(username, 1)
+                    self.changed(username)
                     result = f"Login success: '{username}' logged in. Welcome!"
                     response = {'message': result, 'error': False}
                 except:
@@ -155,165 +1329,975 @@ class ChatService(pb2_grpc.ChatServicer):
             result = f"Login error: username '{username}' not found."
             response = {'message': result, 'error': True}
 
-        cursor.close()
-
         return pb2.ServerResponse(**response)
 
 
     def Logout(self, request, context):
         '''Logout the client'''
-        # Sync with all secondary replicas if necessary
-        if primary_index == index:
-            for s in STUBS[index + 1:]:
-                try:
-                    s.Logout(request)
-                except grpc._channel._InactiveRpcError:
-                    pass
-
+        forwarded = self.forward('Logout', request, context)
+        if forwarded is not None:
+            return forwarded
+        routed = self.route('Logout', request.username, request, context)
+        if routed is not None:
+            return routed
+        return self.replicated('Logout', request, context)
+
+    def logout(self, tx, request):
+        '''Applies Logout to this replica's database.'''
         username = request.username
-        cursor = self.conn.cursor()
 
         print(f'Logout called from {index} for {username}.')
 
         try:
             # Set the status of the account to 0 (logged out)
-            cursor.execute("UPDATE accounts SET status = 0 WHERE username = ?", (username,))
-            self.conn.commit()
+            self.db.set_status(tx, username, 0)
+            self.set_status(username, 0)
+            self.changed(username)
             result = f"Logout success: '{username}' logged out. Goodbye!"
             response = {'message': result, 'error': False}
         except:
             result = f"Logout error: something went wrong, please try again."
             response = {'message': result, 'error': True}
 
-        cursor.close()
-
         return pb2.ServerResponse(**response)
 
 
     def ListAccounts(self, request, context):
-        '''Lists the available accounts'''
-        searchterm = request.searchterm
-        pattern = re.compile(searchterm)
+        '''
+        Lists the accounts matching the search term, one page at a time.
+        The response's cursor fetches the next page. Any replica serves it
+        as long as it is within the client's staleness bound.
+        '''
+        if not self.fresh_enough(context):
+            return pb2.Accounts()
 
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT username FROM accounts")
-        results = cursor.fetchall()
-        cursor.close()
+        searchterm = request.searchterm
+        limit = min(request.limit or ACCOUNTS_PAGE_SIZE, MAX_ACCOUNTS_PAGE_SIZE)
 
         print(f'ListAccounts called from {index} for {searchterm}.')
 
-        accounts = [r[0] for r in results]
-        accounts_str = ""
-        for account in accounts:
-            if pattern.search(account) is not None:
-                accounts_str += account + " "
-
-        response = {'usernames': accounts_str[:-1]}
-
-        # Replace space with newline character
-        response['usernames'] = response['usernames'].replace(' ', ', ')
+        try:
+            accounts, cursor = self.accounts.search(searchterm, request.cursor, limit)
+        except re.error:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(f"'{searchterm}' is not a valid regular expression.")
+            return pb2.Accounts()
 
-        return pb2.Accounts(**response)
+        return pb2.Accounts(accounts=accounts, cursor=cursor)
 
 
     def SendMessage(self, request, context):
-        '''Puts message into the destination user's queue'''
-        # Sync with all secondary replicas if necessary
-        if primary_index == index:
-            for s in STUBS[index + 1:]:
-                try:
-                    s.SendMessage(request)
-                except grpc._channel._InactiveRpcError:
-                    pass
+        '''
+        Puts message into the destination user's queue. The sender's shard
+        checks the sender, and writes the message to the destination's shard
+        if the destination's account is on another one.
+        '''
+        forwarded = self.forward('SendMessage', request, context)
+        if forwarded is not None:
+            return forwarded
+        routed = self.route('SendMessage', request.source, request, context)
+        if routed is not None:
+            return routed
+
+        if not relayed_seq(context):
+            self.admit('SendMessage', [request], context)
+            owner = self.locate(request.destination)
+            if owner != shard_index:
+                return self.deliver_remote(owner, request)
+        return self.replicated('SendMessage', request, context)
+
+    def admit(self, method, messages, context):
+        '''
+        Rejects a write with RESOURCE_EXHAUSTED, before any work is done for
+        it, if its senders or the replica send faster than their rate limit.
+        A replica that is not the primary rejects it with UNAVAILABLE first,
+        so a write it would not take costs its senders no tokens. On the
+        grpc.aio server, AsyncChatService admits the write on the event loop
+        already, before it takes a thread of the pool.
+        '''
+        if isinstance(context, ThreadContext) and context.admitted:
+            return
+        self.require_primary(context)
+        limit = admission.admit(Counter(m.source for m in messages))
+        if limit is None:
+            return
+        metrics.THROTTLED.labels(method, limit).inc()
+        if limit == 'user':
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                          f"Send error: at most {admission.user_rate:g} messages per second may be sent per user.")
+        context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                      f"Send error: replica {index} takes at most {admission.global_rate:g} messages per second.")
+
+    def check_sender(self, source):
+        '''Returns the error response for a sender that may not send messages, or None.'''
+        # If the source is not logged in, or does not exist at all, return an error
+        if self.accounts.status(source) != 1:
+            result = "Send error: you must be logged in to send messages."
+            return pb2.ServerResponse(message=result, error=True)
+        return None
+
+    def deliver_remote(self, owner, request):
+        '''Checks the sender of a message to a user on another shard, then writes it to that shard.'''
+        error = self.check_sender(request.source)
+        if error is not None:
+            return error
+        return GROUPS[owner].call('DeliverMessage', request, metadata=(('forwarded', '1'),))
+
+    def send_message(self, tx, request):
+        '''Applies SendMessage to this replica's database.'''
+        print(f'SendMessage called from {index} for {request.source} to {request.destination}.')
+
+        error = self.check_sender(request.source)
+        if error is not None:
+            return error
+        return self.deliver_message(tx, request)
+
+    def DeliverMessage(self, request, context):
+        '''
+        Puts a message sent on another shard into the destination user's
+        queue. The sender's shard has already checked the sender and admitted the message.
+        '''
+        forwarded = self.forward('DeliverMessage', request, context)
+        if forwarded is not None:
+            return forwarded
+        routed = self.route('DeliverMessage', request.destination, request, context)
+        if routed is not None:
+            return routed
+
+        return self.replicated('DeliverMessage', request, context)
 
+    def deliver_message(self, tx, request):
+        '''Applies DeliverMessage to this replica's database, and SendMessage once the sender is checked.'''
         destination = request.destination
         source = request.source
         text = request.text
 
-        print(f'SendMessage called from {index} for {source} to {destination}.')
-
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT status FROM accounts WHERE username = ?", (source,))
-        logged_in = cursor.fetchone()[0]
-
-        # If the source is not logged in, return an error
-        if logged_in == 0:
-            result = "Send error: you must be logged in to send messages."
-            response = {'message': result, 'error': True}
-            return pb2.ServerResponse(**response)
-
         # If the destination is not a valid account, return an error
-        cursor.execute("SELECT username FROM accounts WHERE username = ?", (destination,))
-        if cursor.fetchone() is None:
+        if self.accounts.status(destination) is None:
             result = f"Send error: destination account '{destination}' does not exist."
             response = {'message': result, 'error': True}
             return pb2.ServerResponse(**response)
 
         try:
             # Add the message to the destination user's queue
-            cursor.execute("INSERT INTO messages VALUES (?, ?, ?)", (source, destination, text,))
-            self.conn.commit()
+            self.db.queue_messages(tx, [(request.id, source, destination, text)])
+            self.reserve_message_ids([request])
+            self.changed(destination)
             result = f"Send success: message sent to '{destination}'."
             response = {'message': result, 'error': False}
         except:
             result = "Send error: something went wrong, please try again."
             response = {'message': result, 'error': True}
 
-        cursor.close()
+        return pb2.ServerResponse(**response)
+
+
+    def SendMessages(self, request_iterator, context):
+        '''
+        Puts a stream of messages into their destination users' queues.
+        The whole stream is validated, stored and replicated as one batch.
+        Like SendMessage, messages are sent by their sender's shard, so the
+        messages of senders on other shards go there as one batch per shard.
+        '''
+        forwarded_call = self.forward('SendMessages', request_iterator, context)
+        if forwarded_call is not None:
+            return forwarded_call
+        messages = list(request_iterator)
+        if relayed_seq(context):
+            return self.replicated('SendMessages', messages, context)
+
+        others = []
+        if not forwarded(context):
+            batches = {}
+            for m in messages:
+                batches.setdefault(self.locate(m.source), []).append(m)
+            messages = batches.pop(shard_index, [])
+            others = [GROUPS[owner].call('SendMessages', batch, metadata=(('forwarded', '1'),)) for owner, batch in batches.items()]
+        if not messages:
+            return pb2.ServerResponse(message=' '.join(r.message for r in others), error=any(r.error for r in others))
+        self.admit('SendMessages', messages, context)
+
+        # Messages to users on other shards are written there one by one
+        owners = [self.locate(m.destination) for m in messages]
+        remote = [(owner, m) for owner, m in zip(owners, messages) if owner != shard_index]
+        messages = [m for owner, m in zip(owners, messages) if owner == shard_index]
+        failed = sum(self.deliver_remote(owner, m).error for owner, m in remote)
+
+        response = self.replicated('SendMessages', messages, context) if messages else pb2.ServerResponse()
+        if remote:
+            result = f"{len(remote) - failed} of {len(remote)} messages to users on other shards sent."
+            response = pb2.ServerResponse(message=f'{response.message} {result}'.strip(), error=response.error or failed > 0)
+        responses = [response] + others
+        return pb2.ServerResponse(message=' '.join(r.message for r in responses), error=any(r.error for r in responses))
+
+    def send_messages(self, tx, messages):
+        '''Applies SendMessages to this replica's database.'''
+        print(f'SendMessages called from {index} for {len(messages)} messages.')
+
+        # Only keep messages from logged in senders to existing accounts
+        valid = [m for m in messages if self.accounts.status(m.source) == 1 and self.accounts.status(m.destination) is not None]
+
+        try:
+            self.db.queue_messages(tx, [(m.id, m.source, m.destination, m.text) for m in valid])
+            self.reserve_message_ids(valid)
+            for destination in {m.destination for m in valid}:
+                self.changed(destination)
+
+            if len(valid) == len(messages):
+                result = f"Send success: {len(valid)} messages sent."
+                response = {'message': result, 'error': False}
+            else:
+                result = (f"Send error: {len(messages) - len(valid)} of {len(messages)} messages were rejected "
+                          "because their sender is not logged in or their destination does not exist.")
+                response = {'message': result, 'error': True}
+        except:
+            result = "Send error: something went wrong, please try again."
+            response = {'message': result, 'error': True}
 
         return pb2.ServerResponse(**response)
 
 
     def ListenMessages(self, request, context):
+        '''
+        Streams the user's queued messages to them. Between deliveries the
+        stream sleeps until SendMessage or Logout notifies this user, so an
+        idle listener does not touch the database.
+        '''
         username = request.username
 
-        cursor = self.conn.cursor()
-        while True:
-            # First, check if the user is logged in
-            cursor.execute("SELECT status FROM accounts WHERE username = ?", (username,))
-            logged_in = cursor.fetchone()[0]
-            if logged_in == 0:
-                break
+        # Wake the stream up as soon as the client goes away
+        context.add_callback(lambda: self.notifier.notify(username))
 
-            # If the user is logged in, check if there are any messages for them
-            cursor.execute("SELECT source, text FROM messages WHERE destination = ?", (username,))
-            for row in cursor.fetchall():
-                source = row[0]
-                text = row[1]
-                response = {'source': source, 'text': text, 'destination': username}
-                yield pb2.MessageInfo(**response)
-                cursor.execute("DELETE FROM messages WHERE destination = ? AND source = ? AND text = ?", (username, source, text,))
-                cursor.execute("INSERT INTO history VALUES (?, ?, ?)", (username, source, text,))
+        version = self.notifier.version(username)
+        while context.is_active():
+            logged_in, delivered = self.pending_messages(username)
+            if not logged_in:
+                break
 
+            for message_id, source, text in delivered:
+                yield pb2.MessageInfo(id=message_id, source=source, text=text, destination=username)
                 print(f'Message from {source} to {username} sent.')
 
-            self.conn.commit()
+            # Move the delivered messages to the history on every replica
+            if delivered:
+                try:
+                    self.acknowledge_delivered(username, delivered, context)
+                except Aborted as e:
+                    context.abort(e.code, e.details)
+
+            # Sleep until something changes for this user
+            version = self.notifier.wait(username, version, LISTEN_TIMEOUT)
+
+    def ReceiveMessages(self, request, context):
+        '''
+        Streams the user's queued messages after the cursor's id in batches
+        of up to DELIVERY_BATCH_SIZE. Messages stay queued until the client
+        acknowledges them, so a client that reconnects with the id of the
+        last message it acknowledged gets every later message again.
+        '''
+        username = request.username
+        position = request.id
+
+        # Wake the stream up as soon as the client goes away
+        context.add_callback(lambda: self.notifier.notify(username))
+
+        version = self.notifier.version(username)
+        while context.is_active():
+            logged_in, batch = self.pending_messages(username, position, DELIVERY_BATCH_SIZE)
+            if not logged_in:
+                break
+
+            if batch:
+                yield self.message_batch(username, batch)
+                position = batch[-1][0]
+                continue
+
+            # Sleep until something changes for this user
+            version = self.notifier.wait(username, version, LISTEN_TIMEOUT)
+
+    def message_batch(self, username, batch):
+        '''Builds the MessageBatch frame for a user's (id, source, text) rows.'''
+        print(f'{len(batch)} messages to {username} sent.')
+        return pb2.MessageBatch(messages=[
+            pb2.MessageInfo(id=message_id, source=source, text=text, destination=username)
+            for message_id, source, text in batch
+        ])
+
+    def AcknowledgeMessages(self, request, context):
+        '''Moves the user's messages up to the cursor's id to the history.'''
+        forwarded = self.forward('AcknowledgeMessages', request, context)
+        if forwarded is not None:
+            return forwarded
+        return self.replicated('AcknowledgeMessages', request, context)
+
+    def acknowledge_delivered(self, username, delivered, context):
+        '''
+        Acknowledges the messages a ListenMessages stream delivered, up to
+        the last of them, through the replicated AcknowledgeMessages like a
+        ReceiveMessages client does. Archiving them on this replica only
+        would make the replicas diverge, and a new primary redeliver them.
+        Raises Aborted if the stream has to end.
+        '''
+        return self.AcknowledgeMessages(pb2.Cursor(username=username, id=delivered[-1][0]), AckContext(context))
+
+    def acknowledge_messages(self, tx, request):
+        '''Applies AcknowledgeMessages to this replica's database.'''
+        username = request.username
+        acknowledged = self.db.acknowledge_messages(tx, username, request.id)
+        return pb2.ServerResponse(message=f'{acknowledged} messages to {username} acknowledged.', error=False)
+
+    def pending_messages(self, username, after=0, limit=-1):
+        '''
+        Returns whether the user is logged in and, if so, the (id, source,
+        text) rows queued for them after the given id, oldest first and at
+        most limit of them (-1 for all).
+        '''
+        if self.accounts.status(username) != 1:
+            return False, []
+
+        with metrics.SQLITE_LATENCY.labels('pending_messages').time():
+            rows = self.db.queued_messages(username, after, limit)
+        return True, rows
 
-        cursor.close()
 
+    def GetHistory(self, request, context):
+        '''
+        Returns a page of the delivered messages between the user and a peer,
+        going back in time from before_id. Each direction of the conversation
+        is a range of the storage's (source, destination, id) order, so a page
+        costs the same however long the history is. Any replica serves it as long
+        as it is within the client's staleness bound.
+        '''
+        if not self.fresh_enough(context):
+            return pb2.History()
+
+        username, peer = request.username, request.peer
+        limit = min(request.limit or HISTORY_PAGE_SIZE, MAX_HISTORY_PAGE_SIZE)
+        before_id = request.before_id or (1 << 63) - 1
+
+        print(f'GetHistory called from {index} for {username} and {peer}.')
+
+        with metrics.SQLITE_LATENCY.labels('GetHistory').time():
+            rows = self.db.conversation(username, peer, before_id, limit)
+
+        messages = [
+            pb2.MessageInfo(id=message_id, source=source, destination=destination, text=text)
+            for message_id, source, destination, text in rows
+        ]
+        return pb2.History(messages=messages, before_id=rows[0][0] if len(rows) == limit else 0)
+
+    def account_data(self, tx, username):
+        '''Reads the user's account, the messages queued for them and the ones delivered to them.'''
+        data = self.db.export_account(tx, username)
+        if data is None:
+            return pb2.AccountData(username=username, found=False)
+
+        password, status, queued, delivered = data
+        to_messages = lambda rows: [
+            pb2.MessageInfo(id=message_id, source=source, destination=destination, text=text)
+            for message_id, source, destination, text in rows
+        ]
+        return pb2.AccountData(username=username, password=password, status=status,
+                               messages=to_messages(queued), history=to_messages(delivered), found=True)
+
+    def ImportAccount(self, request, context):
+        '''
+        Stores an account moved from another shard, with its messages under
+        their original ids. Importing the same data twice stores it once, so
+        a failed import can simply be retried.
+        '''
+        forwarded = self.forward('ImportAccount', request, context)
+        if forwarded is not None:
+            return forwarded
+        return self.replicated('ImportAccount', request, context)
+
+    def import_account(self, tx, request):
+        '''Applies ImportAccount to this replica's database.'''
+        username = request.username
+
+        print(f'ImportAccount called from {index} for {username}.')
+
+        rows = lambda messages: [(m.id, m.source, m.destination, m.text) for m in messages]
+        self.db.put_account(tx, username, request.password, request.status)
+        self.db.import_messages(tx, rows(request.messages), rows(request.history))
+        self.reserve_message_ids(list(request.messages) + list(request.history))
+
+        if self.accounts.status(username) is None:
+            self.accounts.add(username)
+            self.db.on_rollback(lambda: self.accounts.remove(username))
+        self.set_status(username, request.status)
+        self.changed(username)
+
+        result = f"Import success: '{username}' stored with {len(request.messages)} queued messages."
+        return pb2.ServerResponse(message=result, error=False)
+
+    def ReleaseAccount(self, request, context):
+        '''
+        Deletes the user's account, queued messages and history from this
+        shard once it has been moved to another one, and returns them as
+        they were at that point.
+        '''
+        forwarded = self.forward('ReleaseAccount', request, context)
+        if forwarded is not None:
+            return forwarded
+        return self.replicated('ReleaseAccount', request, context)
+
+    def release_account(self, tx, request):
+        '''Applies ReleaseAccount to this replica's database.'''
+        username = request.username
+
+        print(f'ReleaseAccount called from {index} for {username}.')
+
+        data = self.account_data(tx, username)
+        if data.found:
+            self.db.remove_account(tx, username)
+
+            status = self.accounts.status(username)
+            self.accounts.remove(username)
+            self.db.on_rollback(lambda: self.restore_account(username, status))
+
+            # End the user's message streams, the client reconnects to the new shard
+            self.changed(username)
+        return data
+
+    def SetRing(self, request, context):
+        '''
+        Switches this replica to a new layout of shards. During a rebalance
+        the layout before it is kept to find the accounts not moved yet.
+        '''
+        use_ring(request)
+        if workers is not None:
+            workers.publish('ring', request.SerializeToString())
+        return pb2.NoParam()
+
+    def Stats(self, request, context):
+        '''Returns this replica's metrics in the Prometheus text format.'''
+        return pb2.Metrics(text=metrics.render())
 
     def Heartbeat(self, request, context):
+        '''
+        Answers a liveness check with the index of the primary this replica
+        follows, the last sequence number it handed out or received and, in
+        consensus mode, its term.
+        '''
+        forwarded = self.forward('Heartbeat', request, context)
+        if forwarded is not None:
+            return forwarded
+        return pb2.Leader(index=primary_index, seq=self.last_seq, term=current_term())
+
+    def AnnounceLeader(self, request, context):
+        '''
+        Switches to a newly elected primary right away instead of waiting to
+        suspect the old one, whichever replica it is, as long as it claims a
+        later term, or the same term with a higher index, than the primary
+        followed so far. A primary that hears of such a claim steps down, and
+        heartbeat_primary brings it up to date with the new one. In consensus
+        mode the leader is known from its lease instead.
+        '''
+        forwarded = self.forward('AnnounceLeader', request, context)
+        if forwarded is not None:
+            return forwarded
+        if election is None and (request.term, request.index) > (primary_term, primary_index):
+            follow(request.index, request.term)
         return pb2.NoParam()
 
+    def RequestVote(self, request, context):
+        '''Answers a candidate's request for a vote in consensus mode, see Election.vote.'''
+        forwarded = self.forward('RequestVote', request, context)
+        if forwarded is not None:
+            return forwarded
+        if election is None:
+            return pb2.Grant(granted=False)
+        candidate_log = (request.last_term, request.last_seq)
+        term, granted = election.vote(request.term, request.candidate, candidate_log, self.log_position(), monotonic())
+        return pb2.Grant(term=term, granted=granted)
+
+    def RenewLease(self, request, context):
+        '''
+        Grants a leader's lease in consensus mode and follows it. The seq it
+        sends along tells how stale this replica's reads are, like the
+        primary's heartbeat answers do without consensus.
+        '''
+        global primary_index
+        forwarded = self.forward('RenewLease', request, context)
+        if forwarded is not None:
+            return forwarded
+        if election is None:
+            return pb2.Grant(granted=False)
+        received = monotonic()
+        term, granted = election.follow(request.term, request.leader, received)
+        if granted:
+            if primary_index != request.leader:
+                primary_index = request.leader
+                print(f'Replica {index} follows replica {primary_index}, the leader of term {term}.')
+            # The leader held seq when it sent the renewal, which is off by no more than the one-way delay
+            record_position(received, request.seq)
+        return pb2.Grant(term=term, granted=granted)
+
+
+
+class AsyncChatService(ChatService):
+    '''
+    ChatService for the grpc.aio server.
+
+    ListenMessages and ReceiveMessages streams are coroutines: an idle stream
+    is a suspended task waiting for its user's notification, not a blocked
+    thread, so one process can hold tens of thousands of them. Their database
+    reads run in a small thread pool and their writes are awaited from the
+    writer thread. SendMessage and SendMessages are admitted on the event
+    loop and then run in a pool of their own, so a flood of messages over
+    the rate limit is turned away before it queues up for a thread. Every
+    other RPC is served unchanged by the server's thread pool.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.readers = futures.ThreadPoolExecutor(max_workers=AIO_READ_THREADS)
+        self.senders = futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+    async def SendMessage(self, request, context):
+        '''Like ChatService.SendMessage, admitted on the event loop.'''
+        return await self.admitted(ChatService.SendMessage, 'SendMessage', request, [request], context)
+
+    async def SendMessages(self, request_iterator, context):
+        '''Like ChatService.SendMessages, admitted on the event loop.'''
+        messages = [message async for message in request_iterator]
+        return await self.admitted(ChatService.SendMessages, 'SendMessages', iter(messages), messages, context)
+
+    async def admitted(self, handler, method, request, messages, context):
+        '''
+        Admits the messages of a write this worker handles itself on the
+        event loop, then runs the plain handler in the senders' pool. Writes
+        for the lead worker, or from senders on another shard, are admitted
+        where they are handled, and relayed ones never are.
+        '''
+        thread_context = ThreadContext(context)
+        try:
+            if self.lead is None and not relayed_seq(context):
+                local = messages if forwarded(context) else [m for m in messages if self.locate(m.source) == shard_index]
+                if local:
+                    self.admit(method, local, thread_context)
+                    thread_context.admitted = True
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.senders, handler, self, request, thread_context)
+        except Aborted as e:
+            await context.abort(e.code, e.details)
+
+    async def ListenMessages(self, request, context):
+        '''
+        Streams the user's queued messages to them, sleeping on an asyncio
+        event between deliveries. The task is cancelled when the client goes
+        away.
+        '''
+        username = request.username
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+
+        def notify():
+            loop.call_soon_threadsafe(wakeup.set)
+
+        self.notifier.subscribe(username, notify)
+        try:
+            while True:
+                wakeup.clear()
+                logged_in, delivered = await loop.run_in_executor(self.readers, self.pending_messages, username)
+                if not logged_in:
+                    break
+
+                for message_id, source, text in delivered:
+                    yield pb2.MessageInfo(id=message_id, source=source, text=text, destination=username)
+                    print(f'Message from {source} to {username} sent.')
+
+                # Move the delivered messages to the history on every replica
+                if delivered:
+                    try:
+                        await loop.run_in_executor(None, self.acknowledge_delivered, username, delivered, context)
+                    except Aborted as e:
+                        await context.abort(e.code, e.details)
+
+                # Sleep until something changes for this user
+                try:
+                    await asyncio.wait_for(wakeup.wait(), LISTEN_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.notifier.unsubscribe(username, notify)
+
+    async def ReceiveMessages(self, request, context):
+        '''Like ChatService.ReceiveMessages, sleeping on an asyncio event.'''
+        username = request.username
+        position = request.id
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+
+        def notify():
+            loop.call_soon_threadsafe(wakeup.set)
+
+        self.notifier.subscribe(username, notify)
+        try:
+            while True:
+                wakeup.clear()
+                logged_in, batch = await loop.run_in_executor(
+                    self.readers, self.pending_messages, username, position, DELIVERY_BATCH_SIZE
+                )
+                if not logged_in:
+                    break
+
+                if batch:
+                    yield self.message_batch(username, batch)
+                    position = batch[-1][0]
+                    continue
+
+                # Sleep until something changes for this user
+                try:
+                    await asyncio.wait_for(wakeup.wait(), LISTEN_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.notifier.unsubscribe(username, notify)
+
+def use_ring(request):
+    '''Switches this worker to the layout of shards of a SetRing request.'''
+    global RING, PREVIOUS_RING, GROUPS
+    layout = ring_layout(request.shards)
+    GROUPS = [
+        None if i == shard_index else
+        GROUPS[i] if i < len(GROUPS) and GROUPS[i] is not None and GROUPS[i].hierarchy == hierarchy else
+        ReplicaGroup(hierarchy)
+        for i, hierarchy in enumerate(layout)
+    ]
+    RING = HashRing(range(len(layout)))
+    PREVIOUS_RING = HashRing(range(len(request.previous))) if request.previous else None
+
+    print(f'Replica {index} of shard {shard_index} uses {len(layout)} shards'
+          + (f', {len(request.previous)} before the rebalance.' if request.previous else '.'))
+
+
+def install_snapshot(path):
+    '''
+    Replaces the database at path with a snapshot streamed from the
+    lowest-indexed replica that answers. Returns the snapshot's log position.
+    '''
+    seq = download_snapshot(path, [i for i in range(len(STUBS)) if i != index])
+    replace_storage(path)
+    return seq
+
+
+def download_snapshot(path, sources):
+    '''
+    Streams a snapshot from the first of the given replicas that answers to
+    path + '.download'. Returns the snapshot's log position.
+    '''
+    for i in sources:
+        start = perf_counter()
+        try:
+            with open(path + '.download', 'wb') as f:
+                for chunk in STUBS[i].StreamSnapshot(pb2.NoParam(), timeout=SNAPSHOT_TIMEOUT):
+                    if chunk.size:
+                        seq, size = chunk.seq, chunk.size
+                    f.write(chunk.data)
+        except grpc.RpcError:
+            continue
+        elapsed = perf_counter() - start
+
+        print(f'Downloaded snapshot of replica {i} at operation {seq}: {size / 1e6:.1f} MB in '
+              f'{elapsed:.2f} s ({size / 1e6 / elapsed:.1f} MB/s).')
+        return seq
+
+    raise RuntimeError('No replica could provide a snapshot.')
+
 
-def heartbeat_primary():
+def replace_storage(path):
+    '''Installs the snapshot downloaded for the storage at path, removing the old storage together with its log files.'''
+    storage_engine.remove(path)
+    os.rename(path + '.download', path)
+
+
+def probe_replicas():
+    '''Asks every other replica for a Heartbeat at once. Returns {replica: Leader} of those that answered.'''
+    calls = {i: stub.Heartbeat.future(pb2.NoParam(), timeout=HEARTBEAT_INTERVAL) for i, stub in enumerate(STUBS) if i != index}
+    answers = {}
+    for i, call in calls.items():
+        try:
+            answers[i] = call.result()
+        except grpc.RpcError:
+            pass
+    return answers
+
+
+def latest_claim(answers):
+    '''
+    Returns the (term, index) of the latest claim to be the primary among
+    Heartbeat answers: the one of the latest term, then of the highest
+    index, like clients pick it in choose_primary(). None if nobody claims it.
+    '''
+    return max(((leader.term, i) for i, leader in answers.items() if leader.index == i), default=None)
+
+
+def latest_term(answers):
+    '''Returns the latest term this replica or any of the Heartbeat answers knows of.'''
+    return max([primary_term] + [leader.term for leader in answers.values()])
+
+
+def next_term(term, i=None):
+    '''
+    Returns the first term after the given one in which replica i, by
+    default this one, may take over. Terms go round the replicas by index,
+    so two replicas that take over at once never claim the same term.
+    '''
+    i = index if i is None else i
+    return term + 1 + (i - term - 1) % len(STUBS)
+
+
+def discover_primary():
+    '''
+    Returns the (index, term) of the primary a replica follows when it
+    starts without consensus. A restarted replica that took the role from
+    its index alone would act as a second primary and serve stale reads as
+    fresh. It follows the latest claim among the replicas that answer a
+    Heartbeat, see latest_claim(). If nobody claims the role, replica 0
+    takes it in a new term and the others follow it.
+    '''
+    answers = probe_replicas()
+    claim = latest_claim(answers)
+    if claim is not None:
+        return claim[1], claim[0]
+    return 0, next_term(latest_term(answers), 0)
+
+
+def take_over(suspect):
+    '''
+    Picks the primary to follow once the one followed so far is suspected
+    to be down. Every replica is probed first: if one that answers already
+    acts as the primary, e.g. because it took over before this replica
+    noticed, the latest claim is followed. Otherwise the role goes to the
+    next replica in line after the suspect that answered, or to this
+    replica, so a replica that is down is skipped at once. Returns the
+    (index, term) of the new primary and the replicas that answered; the
+    index is this replica's if it has to take over in that new term. A
+    successor is followed in the term it is going to claim, so frames the
+    suspect still sends in its own term are refused.
+    '''
+    answers = probe_replicas()
+    claim = latest_claim(answers)
+    if claim is not None:
+        return claim[1], claim[0], answers
+    successor = min(list(answers) + [index], key=lambda i: (i - suspect - 1) % len(STUBS))
+    return successor, next_term(latest_term(answers), successor), answers
+
+
+def follow(leader, term):
+    '''Follows the primary that claimed the role in a term, stepping down if this replica was the primary.'''
+    global primary_index, primary_term
+    if primary_index == index != leader:
+        share_lease(0.0)
+    primary_index, primary_term = leader, term
+    print(f'Replica {index} follows replica {leader} as the primary replica of term {term}.')
+
+
+def promote(service, term, answers):
+    '''
+    Makes this replica the primary in a new term. It first catches up from
+    the replicas that answered, which may have received operations from the
+    old primary that it missed, and skips the ones none of them has. Then it
+    announces itself to every other replica.
+    '''
+    global primary_index, primary_term
+    for i in answers:
+        service.catch_up(i)
+    service.skip_missing(term)
+    primary_index, primary_term = index, term
+    print(f'Replica {index} is now the primary replica of term {term}.')
+    share_lease(float('inf'))
+    announce_leadership()
+
+
+def heartbeat_primary(service):
     """
-    Function that pings primary replica and determines whether it is still
-    functioning. If the primary is no longer functional, the next lowest-indexed
-    replica that responds is selected.
+    Failure detector that pings the primary replica every HEARTBEAT_INTERVAL
+    (plus up to HEARTBEAT_JITTER, so replicas do not ping in lockstep). If the
+    primary has not answered as the primary for SUSPICION_TIMEOUT it is
+    considered down, and take_over() picks the replica to follow instead,
+    wrapping around past the last one. A replica that becomes the primary
+    announces it to all the others. The primary's answers also tell how far
+    its operation log was, see ChatService.staleness.
+
+    The primary keeps probing every other replica instead and steps down
+    once one claims the role in a later term, e.g. after this replica was
+    paused or both took over at once. A replica that stepped down is then
+    brought up to date with the new primary, see ChatService.reconcile.
     """
-    global primary_index
-    while primary_index < index:
-        try:
-            STUBS[primary_index].Heartbeat(pb2.NoParam())
-        except grpc._channel._InactiveRpcError:
-            primary_index += 1
+    global primary_term
+    watched, last_seen = primary_index, monotonic()
+    if watched == index:
+        print(f'Replica {index} is now the primary replica of term {primary_term}.')
+        share_lease(float('inf'))
+        announce_leadership()
+    while True:
+        sleep(HEARTBEAT_INTERVAL + random.uniform(0, HEARTBEAT_JITTER))
 
-    # If a replica exits the loop, we know that it has become the primary replica
-    print(f'Replica {index} is now the primary replica.')
+        if primary_index == index:
+            claim = latest_claim(probe_replicas())
+            if claim is not None and claim > (primary_term, index):
+                follow(claim[1], claim[0])
+            continue
 
+        # A new primary may have been announced in the meantime, possibly replacing this replica
+        if watched != primary_index:
+            if watched == index:
+                service.reconcile(primary_index)
+            watched, last_seen = primary_index, monotonic()
 
-def serve(i, server_hierarchy):
+        try:
+            sent = monotonic()
+            leader = STUBS[watched].Heartbeat(pb2.NoParam(), timeout=HEARTBEAT_INTERVAL)
+
+            # Remember how far the primary was, to tell how stale this replica's reads are
+            if leader.index == watched:
+                last_seen = monotonic()
+                primary_term = leader.term
+                record_position(sent, leader.seq)
+            elif (leader.term, leader.index) > (primary_term, watched):
+                follow(leader.index, leader.term)
+                continue
+        except grpc.RpcError:
+            pass
+
+        if monotonic() - last_seen > SUSPICION_TIMEOUT and watched == primary_index:
+            successor, term, answers = take_over(watched)
+            if successor == index:
+                promote(service, term, answers)
+                watched = index
+            else:
+                follow(successor, term)
+
+
+def ask_replicas(method, request, needed, timeout):
+    '''
+    Calls a unary rpc that returns a Grant on every other replica at once.
+    Returns the answers as soon as needed of them granted it, or once every
+    call finished or the timeout expired.
+    '''
+    cond = Condition()
+    answers, done = [], []
+    others = [stub for i, stub in enumerate(STUBS) if i != index]
+
+    def finished(call):
+        with cond:
+            try:
+                answers.append(call.result())
+            except grpc.RpcError:
+                pass
+            done.append(call)
+            cond.notify_all()
+
+    for stub in others:
+        getattr(stub, method).future(request, timeout=timeout).add_done_callback(finished)
+    with cond:
+        cond.wait_for(lambda: sum(a.granted for a in answers) >= needed or len(done) == len(others), timeout)
+        return list(answers)
+
+
+def run_election(service):
+    '''
+    Replaces heartbeat_primary in consensus mode. A follower that has not
+    heard from a leader for its election timeout stands for election, and
+    the leader renews its lease with the other replicas every LEASE_INTERVAL.
+    '''
+    while True:
+        if election.election_due(monotonic()):
+            stand_for_election(service)
+        if election.role == LEADER:
+            renew_lease(service)
+        sleep(LEASE_INTERVAL)
+
+
+def stand_for_election(service):
+    '''
+    Asks every other replica for its vote in a new term. With the votes of
+    a majority, this replica becomes the leader and catches up on whatever
+    operations acknowledged by the others it is still missing.
+    '''
+    global primary_index
+    term = election.stand(monotonic())
+    last_term, last_seq = service.log_position()
+    request = pb2.Candidacy(term=term, candidate=index, last_term=last_term, last_seq=last_seq)
+    answers = ask_replicas('RequestVote', request, election.majority() - 1, ELECTION_TIMEOUT)
+    for answer in answers:
+        election.observe(answer.term)
+
+    if election.won(term, 1 + sum(a.granted for a in answers)):
+        metrics.ELECTIONS.labels('won').inc()
+        primary_index = index
+        print(f'Replica {index} is now the leader of term {term}.')
+        Thread(target=service.catch_up, daemon=True).start()
+    else:
+        metrics.ELECTIONS.labels('lost').inc()
+
+
+def renew_lease(service):
+    '''Renews the leader's lease, which lasts LEASE_TIMEOUT from now if a majority grants it.'''
+    term, sent = election.term, monotonic()
+    request = pb2.Lease(term=term, leader=index, seq=service.last_seq)
+    answers = ask_replicas('RenewLease', request, election.majority() - 1, LEASE_TIMEOUT)
+    for answer in answers:
+        election.observe(answer.term)
+    election.renew(term, sent, 1 + sum(a.granted for a in answers))
+    share_lease(election.lease)
+
+
+def announce_leadership():
+    """Tells every other replica that this replica is now the primary."""
+    calls = [
+        stub.AnnounceLeader.future(pb2.Leader(index=index, term=primary_term), timeout=HEARTBEAT_INTERVAL)
+        for i, stub in enumerate(STUBS) if i != index
+    ]
+    for call in calls:
+        try:
+            call.result()
+        except grpc.RpcError:
+            pass
+
+
+def serve(i, server_hierarchy, max_workers=MAX_WORKERS, bootstrap=False, mode=SERVER_MODE, metrics_port=None,
+          shards=None, shard=0, write_concern=None, consensus=False, processes=PROCESSES, pool=None, worker=0,
+          storage=STORAGE, user_rate=USER_RATE_LIMIT, global_rate=GLOBAL_RATE_LIMIT):
+    '''
+    Runs replica i of the given hierarchy of (host, port) pairs. With
+    bootstrap=True, a new replica first copies a snapshot of another
+    replica's database instead of starting from its own file. mode picks
+    the grpc.aio server ('aio') or the thread pool server ('thread'). With
+    a metrics_port, the replica's metrics can also be scraped over HTTP.
+    In a sharded cluster, shards lists the hierarchy of every shard and
+    shard is the one this replica belongs to. write_concern is the write
+    concern of writes that do not ask for one, by default 'majority' in
+    consensus mode and WRITE_CONCERN otherwise. With consensus=True, the
+    primary is elected by a majority of the replicas and holds a lease (see
+    consensus.Election) instead of being the lowest-indexed replica alive.
+    With processes above 1, that many worker processes share the replica's
+    port and database (see workers.Workers); serve() starts the others,
+    which run it again with the pool and their worker index. storage picks
+    the engine the replica keeps its data in, see storage.STORAGE_ENGINES;
+    only the SQLite one can be shared by several worker processes.
+    user_rate and global_rate limit the messages per second each user and
+    all users together may send, see Admission.
+    '''
+    global storage_engine
+    storage_engine = STORAGE_ENGINES[storage]
+    if processes > 1 and storage_engine is not SqliteStorage:
+        raise ValueError(f"The '{storage}' storage engine cannot be shared by several worker processes.")
+
+    # The other workers are forked before gRPC is used in this process
+    global workers
+    workers = pool
+    if processes > 1 and pool is None:
+        workers = Workers(processes)
+        settings = {'max_workers': max_workers, 'mode': mode, 'shards': shards, 'shard': shard,
+                    'write_concern': write_concern, 'consensus': consensus, 'pool': workers, 'storage': storage,
+                    'user_rate': user_rate, 'global_rate': global_rate}
+        for w in range(1, processes):
+            Process(target=serve, args=(i, server_hierarchy), kwargs={**settings, 'worker': w}, daemon=True).start()
+    if workers is not None:
+        workers.worker = worker
     # Index of the primary replica (initialized to 0)
     global primary_index
     primary_index = 0
@@ -322,46 +2306,150 @@ def serve(i, server_hierarchy):
     global index
     index = i
 
-    # Set up server infra
-    host, port = server_hierarchy[index]
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10)) # 10 threads
-    pb2_grpc.add_ChatServicer_to_server(ChatService(), server) # Add service to server
-    server.add_insecure_port(f'{host}:{port}')
-    server.start()
-    print(f'Server started on host {host} and port {port}' + (' (Replica)' if index > 0 else ''))
+    global cluster_concern, admission
+    cluster_concern = write_concern or ('majority' if consensus else WRITE_CONCERN)
+    admission = Admission(user_rate, global_rate)
 
     # Define replica stubs for primary to communicate with
     global STUBS
+    options = [('grpc.max_reconnect_backoff_ms', MAX_RECONNECT_BACKOFF_MS)]
     STUBS = [
-        pb2_grpc.ChatStub(grpc.insecure_channel(f'{host}:{port}'))
+        pb2_grpc.ChatStub(grpc.insecure_channel(f'{host}:{port}', options=options))
         for host, port in server_hierarchy
     ]
 
-    # Start heartbeat with primary replica
-    heartbeat_thread = Thread(target=heartbeat_primary, args=())
-    heartbeat_thread.start()
-
-    # Server waits for termination
-    server.wait_for_termination()
-
+    # Users are spread over the shards by a consistent hash of their username
+    global shard_index, RING, GROUPS
+    shard_index = shard
+    shards = shards or [server_hierarchy]
+    RING = HashRing(range(len(shards)))
+    GROUPS = [None if j == shard else ReplicaGroup(hierarchy) for j, hierarchy in enumerate(shards)]
+
+    # A new replica starts from a snapshot and catches up from its log position
+    if bootstrap:
+        install_snapshot(database_path())
+
+    # The other workers wait for the lead to set up the database, then only serve
+    if worker:
+        workers.ready.wait()
+        service = AsyncChatService() if mode == 'aio' else ChatService()
+        Thread(target=service.follow_workers, daemon=True).start()
+        Thread(target=exit_with_lead, daemon=True).start()
+        run_server(service, server_hierarchy[index], mode, max_workers)
+        return
+
+    # Pick up the operations this replica missed while it was down, and any it misses later on
+    service = AsyncChatService() if mode == 'aio' else ChatService()
+    if workers is not None:
+        workers.ready.set()
+        Thread(target=service.follow_workers, daemon=True).start()
+
+    # Without consensus, replicas follow the lowest-indexed replica alive
+    global election
+    if consensus:
+        term, voted_for = service.saved_vote()
+        election = Election(index, len(STUBS), term, voted_for, save=service.save_vote)
+        Thread(target=run_election, args=(service,), daemon=True).start()
+    else:
+        global primary_term
+        election = None
+        primary_term = service.log_position()[0]
+        primary_index, primary_term = discover_primary()
+        if primary_index != index and service.diverged_from(primary_index):
+            service.rejoin(primary_index)
+        heartbeat_thread = Thread(target=heartbeat_primary, args=(service,))
+        heartbeat_thread.start()
+
+    Thread(target=service.repair_gaps, daemon=True).start()
+
+    if metrics_port is not None:
+        metrics.serve_http(metrics_port)
+
+    run_server(service, server_hierarchy[index], mode, max_workers)
+
+
+def exit_with_lead():
+    '''Ends a worker once the lead worker of its replica is gone, so the replica goes down as a whole.'''
+    lead = os.getppid()
+    while os.getppid() == lead:
+        sleep(HEARTBEAT_INTERVAL)
+    os._exit(1)
+
+
+def listen_addresses(host, port):
+    '''
+    Returns the addresses this worker listens on: the replica's port, shared
+    by every worker, and the lead's unix socket for the other workers.
+    '''
+    addresses = [f'{host}:{port}']
+    if workers is not None and not workers.worker:
+        addresses.append(lead_address())
+    return addresses
+
+
+def run_server(service, address, mode, max_workers):
+    '''Sets up the gRPC server of this worker and waits for termination.'''
+    host, port = address
+    if mode == 'aio':
+        asyncio.run(serve_aio(service, host, port, max_workers))
+    else:
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers), interceptors=[metrics.MetricsInterceptor()],
+                             options=[('grpc.so_reuseport', 1)])
+        pb2_grpc.add_ChatServicer_to_server(service, server) # Add service to server
+        for address in listen_addresses(host, port):
+            server.add_insecure_port(address)
+        server.start()
+        print(f'Server started on host {host} and port {port}' + (' (Replica)' if index > 0 else ''))
+        server.wait_for_termination()
+
+
+async def serve_aio(service, host, port, max_workers):
+    '''
+    Runs the grpc.aio server. Coroutine handlers run on the event loop and
+    plain ones in a pool of max_workers threads.
+    '''
+    server = grpc.aio.server(
+        migration_thread_pool=futures.ThreadPoolExecutor(max_workers=max_workers),
+        interceptors=[metrics.AsyncMetricsInterceptor()],
+        options=[('grpc.so_reuseport', 1)],
+    )
+    pb2_grpc.add_ChatServicer_to_server(service, server)
+    for address in listen_addresses(host, port):
+        server.add_insecure_port(address)
+    await server.start()
+    print(f'Server started on host {host} and port {port}' + (' (Replica)' if index > 0 else ''))
+    await server.wait_for_termination()
 
 if __name__ == '__main__':
-    SERVER_HIERARCHY = [
-        (PRIMARY_HOST, PRIMARY_PORT),
-        (REP_1_HOST, REP_1_PORT),
-        (REP_2_HOST, REP_2_PORT)
-    ]
-
-    primary = Process(target=serve, args=(0, SERVER_HIERARCHY))
-    replica_1 = Process(target=serve, args=(1, SERVER_HIERARCHY))
-    replica_2 = Process(target=serve, args=(2, SERVER_HIERARCHY))
+    parser = argparse.ArgumentParser(description='Replicated chat server.')
+    parser.add_argument('--replica', type=int, help='only run the replica with this index')
+    parser.add_argument('--bootstrap', action='store_true', help='start the replica from a snapshot of another replica')
+    parser.add_argument('--mode', choices=['aio', 'thread'], default=SERVER_MODE, help='serve from an asyncio loop or a thread pool')
+    parser.add_argument('--metrics-port', type=int, help='serve the metrics over HTTP, replica i on this port + i')
+    parser.add_argument('--shard', type=int, default=0, help='run the replicas of this shard in SHARDS')
+    parser.add_argument('--write-concern', choices=WRITE_CONCERNS,
+                        help='replicas that must apply a write before the primary answers, unless the client asks otherwise '
+                             f'(default: majority with --consensus, else {WRITE_CONCERN})')
+    parser.add_argument('--consensus', action='store_true', help='elect the primary by majority vote, with terms and leases')
+    parser.add_argument('--processes', type=int, default=PROCESSES, help='worker processes serving each replica on its port')
+    parser.add_argument('--storage', choices=STORAGE_ENGINES, default=STORAGE, help='engine each replica keeps its data in')
+    parser.add_argument('--user-rate', type=float, default=USER_RATE_LIMIT, help='messages per second each user may send, 0 for no limit')
+    parser.add_argument('--global-rate', type=float, default=GLOBAL_RATE_LIMIT, help='messages per second each replica accepts, 0 for no limit')
+    args = parser.parse_args()
+    metrics_port = lambda i: None if args.metrics_port is None else args.metrics_port + i
+    SERVER_HIERARCHY = SHARDS[args.shard]
+    shard_args = {'shards': SHARDS, 'shard': args.shard, 'write_concern': args.write_concern, 'consensus': args.consensus,
+                  'processes': args.processes, 'storage': args.storage, 'user_rate': args.user_rate, 'global_rate': args.global_rate}
+
+    # Run a single replica, e.g. to replace a failed node with an empty disk
+    if args.replica is not None:
+        serve(args.replica, SERVER_HIERARCHY, bootstrap=args.bootstrap, mode=args.mode, metrics_port=metrics_port(args.replica), **shard_args)
+        exit(0)
+
+    primary = Process(target=serve, args=(0, SERVER_HIERARCHY), kwargs={'mode': args.mode, 'metrics_port': metrics_port(0), **shard_args})
+    replica_1 = Process(target=serve, args=(1, SERVER_HIERARCHY), kwargs={'mode': args.mode, 'metrics_port': metrics_port(1), **shard_args})
+    replica_2 = Process(target=serve, args=(2, SERVER_HIERARCHY), kwargs={'mode': args.mode, 'metrics_port': metrics_port(2), **shard_args})
 
     primary.start()
     replica_1.start()
-    replica_2.start()
-
-    # Uncomment below to test swapping between replicas
-    sleep(10)
-    print('Primary and replica 1 been terminated, duuude')
-    primary.terminate()
-    replica_1.terminate()
\ No newline at end of file
+    replica_2.start()
\ No newline at end of file
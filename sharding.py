@@ -0,0 +1,148 @@
+import hashlib
+from bisect import bisect_left
+from threading import Lock
+from time import sleep
+
+import grpc
+
+import chat_pb2 as pb2
+import chat_pb2_grpc as pb2_grpc
+from constants import *
+
+
+def hash_key(key):
+    '''Maps a string to a 64-bit position on the hash ring.'''
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    '''
+    Consistent hash ring over shard numbers. Every shard owns RING_VNODES
+    points of the ring, and a username belongs to the shard owning the
+    first point at or after the username's hash. Adding a shard only moves
+    the usernames that fall just before its points, all of them to the new
+    shard.
+    '''
+    def __init__(self, shards, vnodes=RING_VNODES):
+        self.shards = list(shards)
+        points = sorted((hash_key(f'{s}#{v}'), s) for s in self.shards for v in range(vnodes))
+        self.hashes = [h for h, _ in points]
+        self.owners = [s for _, s in points]
+
+    def shard_for(self, key):
+        '''Returns the shard that owns the given username.'''
+        return self.owners[bisect_left(self.hashes, hash_key(key)) % len(self.hashes)]
+
+
+def moved_ranges(old, new):
+    '''
+    Returns the (start, end, old shard, new shard) ranges of hashes, end
+    included, whose owner differs between two rings. A start above the end
+    wraps around.
+    '''
+    bounds = sorted(set(old.hashes) | set(new.hashes))
+    moves = []
+    for i, end in enumerate(bounds):
+        start = bounds[i - 1] + 1 if i else bounds[-1] + 1
+        before = old.owners[bisect_left(old.hashes, end) % len(old.hashes)]
+        after = new.owners[bisect_left(new.hashes, end) % len(new.hashes)]
+        if before != after:
+            moves.append((start % (1 << 64), end, before, after))
+    return moves
+
+
+def choose_primary(leaders, terms=None):
+    '''
+    Picks the primary from the answers to a Heartbeat probe, a dict of
+    replica index to the primary that replica follows. Replicas that
+    consider themselves the primary are preferred, then the primary the
+    replicas report, then the lowest-indexed replica alive. terms holds the
+    term of every replica that answered, and the claim of the latest term
+    wins, so a deposed primary that still claims the role is passed over.
+    '''
+    # Election only moves forward, so the highest claim is the most recent one
+    terms = terms or {}
+    claimed = [i for i, leader in leaders.items() if leader == i]
+    reported = [leader for leader in leaders.values() if leader in leaders]
+    return max(claimed, key=lambda i: (terms.get(i, 0), i)) if claimed else max(reported) if reported else min(leaders)
+
+
+class ReplicaGroup:
+    '''
+    The replicas of one shard, as seen from another shard or a tool. Calls
+    go to the cached primary, which is determined again when it fails.
+    '''
+    def __init__(self, hierarchy):
+        options = [('grpc.max_reconnect_backoff_ms', MAX_RECONNECT_BACKOFF_MS)]
+        self.hierarchy = list(hierarchy)
+        self.stubs = [
+            pb2_grpc.ChatStub(grpc.insecure_channel(f'{host}:{port}', options=options))
+            for host, port in self.hierarchy
+        ]
+        self.lock = Lock()
+        self.stub = self.stubs[0]
+
+    def find_primary(self, failed=None):
+        '''Probes every replica at once and caches the primary. Returns False if all are down.'''
+        with self.lock:
+            if failed is not None and self.stub is not failed:
+                return True
+
+            calls = [s.Heartbeat.future(pb2.NoParam(), timeout=PROBE_TIMEOUT) for s in self.stubs]
+            leaders, terms = {}, {}
+            for i, call in enumerate(calls):
+                try:
+                    leaders[i], terms[i] = call.result().index, call.result().term
+                except grpc.RpcError:
+                    pass
+
+            if not leaders:
+                return False
+            self.stub = self.stubs[choose_primary(leaders, terms)]
+            return True
+
+    def call(self, method, request, metadata=()):
+        '''Calls a unary rpc on the primary, retrying on another replica like ChatClient.call.'''
+        delay = RETRY_BACKOFF
+        for attempt in range(CLIENT_RETRIES):
+            stub = self.stub
+            try:
+                # A streamed request is kept as a list so it can be sent again
+                sent = iter(request) if isinstance(request, list) else request
+                return getattr(stub, method)(sent, timeout=CLIENT_TIMEOUT, metadata=metadata)
+            except grpc.RpcError as e:
+                retryable = e.code() == grpc.StatusCode.UNAVAILABLE or (
+                    e.code() == grpc.StatusCode.DEADLINE_EXCEEDED and method not in UNSAFE_RETRIES
+                )
+                if not retryable or attempt == CLIENT_RETRIES - 1:
+                    raise
+
+            sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_BACKOFF)
+            self.find_primary(stub)
+
+
+def parse_shards(text):
+    '''
+    Parses a shard layout like 'h:1,h:2,h:3;h:4,h:5,h:6', one group of
+    replicas per shard, into a list of [(host, port), ...] hierarchies.
+    '''
+    shards = []
+    for group in text.split(';'):
+        hierarchy = []
+        for replica in group.split(','):
+            host, port = replica.strip().rsplit(':', 1)
+            hierarchy.append((host, int(port)))
+        shards.append(hierarchy)
+    return shards
+
+
+def ring_message(shards, previous=None):
+    '''Builds the Ring request of SetRing from lists of hierarchies.'''
+    to_shard = lambda hierarchy: pb2.Shard(replicas=[f'{host}:{port}' for host, port in hierarchy])
+    return pb2.Ring(shards=[to_shard(h) for h in shards], previous=[to_shard(h) for h in previous or []])
+
+
+def ring_layout(shards):
+    '''Turns the repeated Shard field of a Ring back into a list of hierarchies.'''
+    return [[(r.rsplit(':', 1)[0], int(r.rsplit(':', 1)[1])) for r in s.replicas] for s in shards]
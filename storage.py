@@ -0,0 +1,760 @@
+import os
+import pickle
+import sqlite3
+from abc import ABC, abstractmethod
+from bisect import bisect_left, insort
+from collections import deque
+from concurrent.futures import Future
+from itertools import dropwhile, islice, takewhile
+from queue import Queue
+from threading import RLock, Thread
+from time import monotonic
+
+import chat_pb2 as pb2
+from constants import *
+from database import Database
+
+
+def migrate(conn):
+    '''
+    Upgrades a chat database written by an older version of the server to
+    the current schema. The schema version is kept in SQLite's user_version.
+    Runs inside the caller's transaction.
+    '''
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+
+    if version < 1:
+        # Version 1 gives every message a stable integer id. Archived messages
+        # keep their id in history, so old history rows are numbered first.
+        offset = 0
+        for table in ('history', 'messages'):
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+            if 'id' not in columns:
+                conn.execute(f'ALTER TABLE {table} RENAME TO {table}_old')
+                conn.execute(f'''CREATE TABLE {table}
+                             (id INTEGER PRIMARY KEY, source TEXT, destination TEXT, text TEXT)''')
+                conn.execute(f'''INSERT INTO {table} SELECT rowid + ?, source, destination, text
+                             FROM {table}_old ORDER BY rowid''', (offset,))
+                conn.execute(f'DROP TABLE {table}_old')
+            offset = conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+        conn.execute('CREATE INDEX IF NOT EXISTS messages_destination ON messages (destination, id)')
+        conn.execute('PRAGMA user_version = 1')
+
+    if version < 2:
+        # Version 2 adds the operation log that replicas catch up from, and
+        # the sequence number up to which every operation has been applied
+        conn.execute('CREATE TABLE IF NOT EXISTS oplog (seq INTEGER PRIMARY KEY, method TEXT, payload BLOB)')
+        conn.execute('CREATE TABLE IF NOT EXISTS replication (applied_seq INTEGER)')
+        conn.execute('INSERT INTO replication VALUES (0)')
+        conn.execute('PRAGMA user_version = 2')
+
+    if version < 3:
+        # Version 3 indexes history by conversation for GetHistory. Until
+        # now ListenMessages archived messages with source and destination
+        # swapped, so those rows are swapped back. AcknowledgeMessages
+        # (version 2) archived them the right way round: a row its
+        # destination acknowledged, as the operation log tells, is kept.
+        acknowledged = {}
+        for (payload,) in conn.execute("SELECT payload FROM oplog WHERE method = 'AcknowledgeMessages'"):
+            cursor = pb2.Cursor.FromString(payload)
+            acknowledged[cursor.username] = max(acknowledged.get(cursor.username, 0), cursor.id)
+        conn.execute('CREATE TEMP TABLE acknowledged (username TEXT PRIMARY KEY, id INTEGER)')
+        conn.executemany('INSERT INTO acknowledged VALUES (?, ?)', acknowledged.items())
+        conn.execute('''UPDATE history SET source = destination, destination = source
+                        WHERE id > COALESCE((SELECT id FROM acknowledged WHERE username = history.destination), 0)''')
+        conn.execute('DROP TABLE acknowledged')
+        conn.execute('CREATE INDEX IF NOT EXISTS history_conversation ON history (source, destination, id)')
+        conn.execute('PRAGMA user_version = 3')
+
+    if version < 4:
+        # Version 4 logs the term of every operation, and keeps the current
+        # term and the vote cast in it, for consensus mode
+        conn.execute('ALTER TABLE oplog ADD COLUMN term INTEGER DEFAULT 0')
+        conn.execute('ALTER TABLE replication ADD COLUMN term INTEGER DEFAULT 0')
+        conn.execute('ALTER TABLE replication ADD COLUMN voted_for INTEGER')
+        conn.execute('PRAGMA user_version = 4')
+
+
+class Storage(ABC):
+    '''
+    What ChatService needs from the storage of a replica: the accounts, the
+    queue of messages waiting for every user, the history of delivered
+    messages and the operation log.
+
+    Changes are made inside write(fn), which runs fn(tx) in the storage's
+    writer thread and returns once the write is durable. Every method that
+    changes something takes that tx; reads take it too when they have to see
+    the changes made so far in the same write. A write that raises is undone
+    as a whole, like with database.Database, whose after_commit() and
+    on_rollback() every engine offers as well. Every method here is
+    abstract, so an engine that misses one cannot be created.
+
+    Messages are (id, source, destination, text) rows, or (id, source, text)
+    rows of a single user's queue.
+    '''
+    suffix = ''       # Extension of the file the storage of a replica lives in
+    files = ('',)     # Suffixes of every file that belongs to that storage
+
+    @classmethod
+    def remove(cls, path):
+        '''Deletes the storage at path with every file that belongs to it.'''
+        for suffix in cls.files:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    @abstractmethod
+    def write(self, fn):
+        '''Runs fn(tx) in the writer thread and returns its result once it is durable.'''
+
+    @abstractmethod
+    def submit(self, fn):
+        '''Like write(), but returns a concurrent.futures.Future instead of waiting.'''
+
+    @abstractmethod
+    def after_commit(self, callback):
+        '''From inside a write: runs callback() once the write is durable.'''
+
+    @abstractmethod
+    def on_rollback(self, callback):
+        '''From inside a write: runs callback() if the write is undone after all.'''
+
+    @abstractmethod
+    def snapshot(self, path):
+        '''Writes a consistent copy of the storage to path, for a new replica. Returns its applied_seq().'''
+
+    @abstractmethod
+    def close(self):
+        '''Finishes the queued writes and closes the storage.'''
+
+    @abstractmethod
+    def accounts(self):
+        '''Returns the (username, status) of every account.'''
+
+    @abstractmethod
+    def account(self, username, tx=None):
+        '''Returns the (password, status) of an account, or None if there is no such account.'''
+
+    @abstractmethod
+    def add_account(self, tx, username, password):
+        '''Creates a logged out account. Returns False if the username is taken.'''
+
+    @abstractmethod
+    def put_account(self, tx, username, password, status):
+        '''Creates an account or replaces the one with the same username.'''
+
+    @abstractmethod
+    def delete_account(self, tx, username, password):
+        '''Deletes an account if the password matches. Returns whether it did.'''
+
+    @abstractmethod
+    def remove_account(self, tx, username):
+        '''Deletes an account together with the messages queued for it and delivered to it.'''
+
+    @abstractmethod
+    def set_status(self, tx, username, status):
+        '''Marks an account as logged in (1) or logged out (0).'''
+
+    @abstractmethod
+    def last_message_id(self):
+        '''Returns the highest id of a queued or delivered message, or 0.'''
+
+    @abstractmethod
+    def queue_messages(self, tx, messages):
+        '''Queues new messages for their destinations. Raises if an id is queued already.'''
+
+    @abstractmethod
+    def import_messages(self, tx, queued, delivered):
+        '''Stores queued and delivered messages under their ids, skipping the ids stored already.'''
+
+    @abstractmethod
+    def queued_messages(self, username, after=0, limit=-1):
+        '''Returns the user's queue after the given id, oldest first and at most limit (-1 for all).'''
+
+    @abstractmethod
+    def acknowledge_messages(self, tx, username, last_id):
+        '''Moves the user's queued messages up to last_id to the history. Returns how many.'''
+
+    @abstractmethod
+    def archive_messages(self, tx, username, delivered):
+        '''Moves the given messages of the user's queue to the history.'''
+
+    @abstractmethod
+    def conversation(self, username, peer, before_id, limit):
+        '''Returns the last limit delivered messages between two users before before_id, oldest first.'''
+
+    @abstractmethod
+    def export_account(self, tx, username):
+        '''
+        Returns the password and status of an account with the messages
+        queued for it and the ones delivered to it, each by id, or None if
+        there is no such account.
+        '''
+
+    @abstractmethod
+    def log_operation(self, tx, seq, method, payload, term):
+        '''
+        Adds an operation to the operation log and moves the applied position
+        forward over every operation without a gap. Returns None if the log
+        did not hold seq yet, otherwise the term it was logged in.
+        '''
+
+    @abstractmethod
+    def applied_seq(self):
+        '''Returns the sequence number up to which every operation has been applied.'''
+
+    @abstractmethod
+    def log_position(self):
+        '''Returns the (term, seq) of the operation at applied_seq().'''
+
+    @abstractmethod
+    def last_seq(self):
+        '''Returns the highest sequence number in the operation log, or 0.'''
+
+    @abstractmethod
+    def log_entries(self, after, limit):
+        '''Returns up to limit (seq, method, payload, term) operations logged after the given one.'''
+
+    @abstractmethod
+    def saved_vote(self):
+        '''Returns the current term and the vote cast in it, for consensus mode.'''
+
+    @abstractmethod
+    def save_vote(self, term, voted_for):
+        '''Durably saves the current term and the vote cast in it.'''
+
+
+class SqliteStorage(Database, Storage):
+    '''The storage of a replica in a SQLite database, see database.Database.'''
+    suffix = '.db'
+    files = ('', '-wal', '-shm')
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.write(self.create_tables)
+
+    def create_tables(self, conn):
+        '''Creates the tables of a new database and upgrades old ones.'''
+        conn.execute('''CREATE TABLE IF NOT EXISTS accounts
+                     (username TEXT unique, password TEXT, status INTEGER)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS messages
+                     (id INTEGER PRIMARY KEY, source TEXT, destination TEXT, text TEXT)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS history
+                     (id INTEGER PRIMARY KEY, source TEXT, destination TEXT, text TEXT)''')
+        migrate(conn)
+
+    def snapshot(self, path):
+        super().snapshot(path)
+        copy = sqlite3.connect(path)
+        try:
+            return copy.execute('SELECT applied_seq FROM replication').fetchone()[0]
+        finally:
+            copy.close()
+
+    def accounts(self):
+        return self.read().execute('SELECT username, status FROM accounts').fetchall()
+
+    def account(self, username, tx=None):
+        return (tx or self.read()).execute('SELECT password, status FROM accounts WHERE username = ?', (username,)).fetchone()
+
+    def add_account(self, tx, username, password):
+        try:
+            tx.execute('INSERT INTO accounts VALUES (?, ?, ?)', (username, password, 0))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def put_account(self, tx, username, password, status):
+        tx.execute('INSERT OR REPLACE INTO accounts VALUES (?, ?, ?)', (username, password, status))
+
+    def delete_account(self, tx, username, password):
+        return tx.execute('DELETE FROM accounts WHERE username = ? AND password = ?', (username, password)).rowcount > 0
+
+    def remove_account(self, tx, username):
+        tx.execute('DELETE FROM accounts WHERE username = ?', (username,))
+        tx.execute('DELETE FROM messages WHERE destination = ?', (username,))
+        tx.execute('DELETE FROM history WHERE destination = ?', (username,))
+
+    def set_status(self, tx, username, status):
+        tx.execute('UPDATE accounts SET status = ? WHERE username = ?', (status, username))
+
+    def last_message_id(self):
+        cursor = self.read().execute('SELECT MAX(id) FROM (SELECT MAX(id) AS id FROM messages UNION ALL SELECT MAX(id) FROM history)')
+        return cursor.fetchone()[0] or 0
+
+    def queue_messages(self, tx, messages):
+        tx.executemany('INSERT INTO messages VALUES (?, ?, ?, ?)', messages)
+
+    def import_messages(self, tx, queued, delivered):
+        tx.executemany('INSERT OR IGNORE INTO messages (id, source, destination, text) VALUES (?, ?, ?, ?)', queued)
+        tx.executemany('INSERT OR IGNORE INTO history (id, source, destination, text) VALUES (?, ?, ?, ?)', delivered)
+
+    def queued_messages(self, username, after=0, limit=-1):
+        return self.read().execute(
+            'SELECT id, source, text FROM messages WHERE destination = ? AND id > ? ORDER BY id LIMIT ?',
+            (username, after, limit)
+        ).fetchall()
+
+    def acknowledge_messages(self, tx, username, last_id):
+        tx.execute(
+            '''INSERT INTO history (id, source, destination, text)
+               SELECT id, source, destination, text FROM messages WHERE destination = ? AND id <= ?''',
+            (username, last_id)
+        )
+        return tx.execute('DELETE FROM messages WHERE destination = ? AND id <= ?', (username, last_id)).rowcount
+
+    def archive_messages(self, tx, username, delivered):
+        tx.executemany('DELETE FROM messages WHERE id = ?', [(message_id,) for message_id, _, _ in delivered])
+        tx.executemany(
+            'INSERT INTO history (id, source, destination, text) VALUES (?, ?, ?, ?)',
+            [(message_id, source, username, text) for message_id, source, text in delivered]
+        )
+
+    def conversation(self, username, peer, before_id, limit):
+        # Each direction is a range of the history_conversation index
+        return self.read().execute(
+            '''SELECT * FROM (SELECT id, source, destination, text FROM history
+                              WHERE source = ? AND destination = ? AND id < ? ORDER BY id DESC LIMIT ?)
+               UNION
+               SELECT * FROM (SELECT id, source, destination, text FROM history
+                              WHERE source = ? AND destination = ? AND id < ? ORDER BY id DESC LIMIT ?)
+               ORDER BY id DESC LIMIT ?''',
+            (username, peer, before_id, limit, peer, username, before_id, limit, limit)
+        ).fetchall()[::-1]
+
+    def export_account(self, tx, username):
+        account = self.account(username, tx)
+        if account is None:
+            return None
+        rows = lambda table: tx.execute(
+            f'SELECT id, source, destination, text FROM {table} WHERE destination = ? ORDER BY id', (username,)
+        ).fetchall()
+        return account[0], account[1], rows('messages'), rows('history')
+
+    def log_operation(self, tx, seq, method, payload, term):
+        cursor = tx.execute('INSERT OR IGNORE INTO oplog VALUES (?, ?, ?, ?)', (seq, method, payload, term))
+        if cursor.rowcount == 0:
+            return tx.execute('SELECT term FROM oplog WHERE seq = ?', (seq,)).fetchone()[0]
+
+        applied = tx.execute('SELECT applied_seq FROM replication').fetchone()[0]
+        if seq == applied + 1:
+            while tx.execute('SELECT 1 FROM oplog WHERE seq = ?', (seq + 1,)).fetchone():
+                seq += 1
+            tx.execute('UPDATE replication SET applied_seq = ?', (seq,))
+        return None
+
+    def applied_seq(self):
+        return self.read().execute('SELECT applied_seq FROM replication').fetchone()[0]
+
+    def log_position(self):
+        cursor = self.read().execute('''SELECT COALESCE(oplog.term, 0), applied_seq
+                                        FROM replication LEFT JOIN oplog ON oplog.seq = applied_seq''')
+        return cursor.fetchone()
+
+    def last_seq(self):
+        return self.read().execute('SELECT MAX(seq) FROM oplog').fetchone()[0] or 0
+
+    def log_entries(self, after, limit):
+        return self.read().execute(
+            'SELECT seq, method, payload, term FROM oplog WHERE seq > ? ORDER BY seq LIMIT ?', (after, limit)
+        ).fetchall()
+
+    def saved_vote(self):
+        return self.read().execute('SELECT term, voted_for FROM replication').fetchone()
+
+    def save_vote(self, term, voted_for):
+        self.write(lambda conn: conn.execute('UPDATE replication SET term = ?, voted_for = ?', (term, voted_for)))
+
+
+class MemoryTransaction:
+    '''The changes one write made to a MemoryStorage, to log them or to undo them.'''
+    def __init__(self):
+        self.changes = []   # (name, args) of every change, replayed from the journal
+        self.inverse = []   # (name, args) that undo every change, in the order they were made
+
+
+class MemoryStorage(Storage):
+    '''
+    The storage of a replica in plain dicts and deques: every user's queue
+    is a deque of message ids in order, and every conversation a sorted list
+    of the ids delivered in it, so the message rpcs never run a query.
+
+    Every change is a call of one of the put_* or set_* methods below, which
+    returns the call that undoes it. A write's changes are appended to a
+    journal next to the storage file and fsynced before the write returns,
+    for a group of writes at a time like database.Database does. Because
+    the operation log is stored too, the journal holds the replication log.
+    Every MEMORY_SNAPSHOT_INTERVAL, the writer thread saves everything to
+    the storage file and empties the journal. On startup the last snapshot
+    is loaded and the journal replayed on top of it.
+
+    Reads see a write once it is applied, which may be shortly before it is
+    on disk.
+    '''
+    suffix = '.mem'
+    files = ('', '-journal')
+
+    # What a snapshot holds, the other structures are built from it
+    STATE = ('users', 'queued', 'archived', 'oplog', 'applied', 'term', 'voted_for')
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = RLock()
+        self.users = {}         # username -> (password, status)
+        self.queued = {}        # id -> (source, destination, text) of every queued message
+        self.archived = {}      # id -> (source, destination, text) of every delivered message
+        self.oplog = {}         # seq -> (method, payload, term)
+        self.applied = 0        # Every operation up to here has been applied
+        self.term, self.voted_for = 0, None
+        self.load()
+
+        self.journal = open(path + '-journal', 'ab')
+        self.saved = monotonic()
+        self.queue = Queue()
+        self.callbacks = []
+        self.undo = []
+        self.writer = Thread(target=self.run_writer, daemon=True)
+        self.writer.start()
+
+    def load(self):
+        '''Loads the last snapshot and replays the journal, dropping a group of changes cut short by a crash.'''
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+            for name in self.STATE:
+                setattr(self, name, state[name])
+        self.index()
+
+        if not os.path.exists(self.path + '-journal'):
+            return
+        with open(self.path + '-journal', 'r+b') as f:
+            end = 0
+            while True:
+                try:
+                    changes = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError):
+                    break
+                for name, args in changes:
+                    getattr(self, name)(*args)
+                end = f.tell()
+            f.truncate(end)
+
+    def index(self):
+        '''Builds every user's queue, the conversations and the sorted log positions from a snapshot.'''
+        self.inboxes = {}       # username -> deque of the ids queued for them, in order
+        for message_id in sorted(self.queued):
+            self.inboxes.setdefault(self.queued[message_id][1], deque()).append(message_id)
+        self.conversations = {} # (source, destination) -> sorted list of the ids delivered
+        for message_id in sorted(self.archived):
+            self.conversations.setdefault(self.archived[message_id][:2], []).append(message_id)
+        self.seqs = sorted(self.oplog)
+
+    def dump(self, path):
+        '''Saves a snapshot to path. Called in the writer thread, so no write is half done.'''
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump({name: getattr(self, name) for name in self.STATE}, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        return self.applied
+
+    def checkpoint(self):
+        '''Saves a snapshot to the storage file and empties the journal.'''
+        self.dump(self.path)
+        self.journal.truncate(0)
+        os.fsync(self.journal.fileno())
+        self.saved = monotonic()
+
+    # Changes, each returning the change that undoes it. They set rather
+    # than add, so replaying a journal on a snapshot that has some of it
+    # already is harmless.
+
+    def put_user(self, username, account):
+        previous = self.users.get(username)
+        if account is None:
+            self.users.pop(username, None)
+        else:
+            self.users[username] = account
+        return 'put_user', (username, previous)
+
+    def put_queued(self, message_id, message):
+        previous = self.queued.pop(message_id, None)
+        if previous is not None:
+            inbox = self.inboxes[previous[1]]
+            if inbox[0] == message_id:
+                inbox.popleft()
+            else:
+                inbox.remove(message_id)
+            if not inbox:
+                del self.inboxes[previous[1]]
+        if message is not None:
+            self.queued[message_id] = message
+            inbox = self.inboxes.setdefault(message[1], deque())
+            if not inbox or inbox[-1] < message_id:
+                inbox.append(message_id)
+            else:
+                self.inboxes[message[1]] = deque(sorted([*inbox, message_id]))
+        return 'put_queued', (message_id, previous)
+
+    def put_archived(self, message_id, message):
+        previous = self.archived.pop(message_id, None)
+        if previous is not None:
+            ids = self.conversations[previous[:2]]
+            del ids[bisect_left(ids, message_id)]
+            if not ids:
+                del self.conversations[previous[:2]]
+        if message is not None:
+            self.archived[message_id] = message
+            insort(self.conversations.setdefault(message[:2], []), message_id)
+        return 'put_archived', (message_id, previous)
+
+    def put_logged(self, seq, entry):
+        previous = self.oplog.pop(seq, None)
+        if previous is not None:
+            del self.seqs[bisect_left(self.seqs, seq)]
+        if entry is not None:
+            self.oplog[seq] = entry
+            insort(self.seqs, seq)
+        return 'put_logged', (seq, previous)
+
+    def set_applied(self, seq):
+        previous, self.applied = self.applied, seq
+        return 'set_applied', (previous,)
+
+    def set_vote(self, term, voted_for):
+        previous, (self.term, self.voted_for) = (self.term, self.voted_for), (term, voted_for)
+        return 'set_vote', previous
+
+    def change(self, tx, name, *args):
+        '''Makes a change as part of a write.'''
+        tx.inverse.append(getattr(self, name)(*args))
+        tx.changes.append((name, args))
+
+    def revert(self, tx):
+        '''Undoes the changes of a write.'''
+        for name, args in reversed(tx.inverse):
+            getattr(self, name)(*args)
+
+    def write(self, fn):
+        return self.submit(fn).result()
+
+    def submit(self, fn):
+        future = Future()
+        self.queue.put((fn, future))
+        return future
+
+    def after_commit(self, callback):
+        self.callbacks.append(callback)
+
+    def on_rollback(self, callback):
+        self.undo.append(callback)
+
+    def run_writer(self):
+        '''Applies queued writes in groups, one journal append per group, and saves a snapshot now and then.'''
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < GROUP_COMMIT_SIZE and not self.queue.empty():
+                batch.append(self.queue.get())
+
+            if batch[-1] is None:
+                batch.pop()
+                self.commit(batch)
+                return
+            self.commit(batch)
+
+            if monotonic() - self.saved >= MEMORY_SNAPSHOT_INTERVAL:
+                try:
+                    self.checkpoint()
+                except OSError as e:
+                    print(f'Error saving a snapshot of {self.path}: {e}')
+
+    def commit(self, batch):
+        '''Applies a group of writes, makes their changes durable and resolves their futures.'''
+        if not batch:
+            return
+
+        results = []
+        callbacks = []
+        undo = []
+        done = []
+        for fn, future in batch:
+            tx = MemoryTransaction()
+            self.callbacks = []
+            self.undo = []
+            with self.lock:
+                try:
+                    results.append((future, fn(tx), None))
+                    done.append(tx)
+                    callbacks.extend(self.callbacks)
+                    undo.extend(self.undo)
+                except Exception as e:
+                    self.revert(tx)
+                    self.run_callbacks(reversed(self.undo))
+                    results.append((future, None, e))
+
+        changes = [change for tx in done for change in tx.changes]
+        try:
+            if changes:
+                pickle.dump(changes, self.journal, pickle.HIGHEST_PROTOCOL)
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+        except Exception as e:
+            # The group never reached the disk, so none of the writes happened
+            with self.lock:
+                for tx in reversed(done):
+                    self.revert(tx)
+            self.run_callbacks(reversed(undo))
+            results = [(future, None, e) for _, future in batch]
+            callbacks = []
+
+        self.run_callbacks(callbacks)
+
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def run_callbacks(self, callbacks):
+        '''Runs after-commit or rollback callbacks, reporting the ones that fail.'''
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f'Error in storage callback: {e}')
+
+    def snapshot(self, path):
+        return self.write(lambda tx: self.dump(path))
+
+    def close(self):
+        self.queue.put(None)
+        self.writer.join()
+        self.journal.close()
+
+    def accounts(self):
+        with self.lock:
+            return [(username, status) for username, (_, status) in self.users.items()]
+
+    def account(self, username, tx=None):
+        with self.lock:
+            return self.users.get(username)
+
+    def add_account(self, tx, username, password):
+        if username in self.users:
+            return False
+        self.change(tx, 'put_user', username, (password, 0))
+        return True
+
+    def put_account(self, tx, username, password, status):
+        self.change(tx, 'put_user', username, (password, status))
+
+    def delete_account(self, tx, username, password):
+        account = self.users.get(username)
+        if account is None or account[0] != password:
+            return False
+        self.change(tx, 'put_user', username, None)
+        return True
+
+    def remove_account(self, tx, username):
+        if username in self.users:
+            self.change(tx, 'put_user', username, None)
+        for message_id in list(self.inboxes.get(username, ())):
+            self.change(tx, 'put_queued', message_id, None)
+        for source, destination in [key for key in self.conversations if key[1] == username]:
+            for message_id in list(self.conversations[source, destination]):
+                self.change(tx, 'put_archived', message_id, None)
+
+    def set_status(self, tx, username, status):
+        account = self.users.get(username)
+        if account is not None:
+            self.change(tx, 'put_user', username, (account[0], status))
+
+    def last_message_id(self):
+        with self.lock:
+            return max(max(self.queued, default=0), max(self.archived, default=0))
+
+    def queue_messages(self, tx, messages):
+        duplicates = [m[0] for m in messages if m[0] in self.queued]
+        if duplicates:
+            raise ValueError(f'Messages {duplicates} are queued already.')
+        for message_id, source, destination, text in messages:
+            self.change(tx, 'put_queued', message_id, (source, destination, text))
+
+    def import_messages(self, tx, queued, delivered):
+        for name, stored, messages in (('put_queued', self.queued, queued), ('put_archived', self.archived, delivered)):
+            for message_id, source, destination, text in messages:
+                if message_id not in stored:
+                    self.change(tx, name, message_id, (source, destination, text))
+
+    def queued_messages(self, username, after=0, limit=-1):
+        with self.lock:
+            ids = dropwhile(lambda message_id: message_id <= after, self.inboxes.get(username, ()))
+            return [(i, self.queued[i][0], self.queued[i][2]) for i in islice(ids, None if limit < 0 else limit)]
+
+    def acknowledge_messages(self, tx, username, last_id):
+        acknowledged = list(takewhile(lambda message_id: message_id <= last_id, self.inboxes.get(username, ())))
+        for message_id in acknowledged:
+            message = self.queued[message_id]
+            self.change(tx, 'put_queued', message_id, None)
+            self.change(tx, 'put_archived', message_id, message)
+        return len(acknowledged)
+
+    def archive_messages(self, tx, username, delivered):
+        for message_id, source, text in delivered:
+            self.change(tx, 'put_queued', message_id, None)
+            self.change(tx, 'put_archived', message_id, (source, username, text))
+
+    def conversation(self, username, peer, before_id, limit):
+        with self.lock:
+            ids = []
+            for key in ((username, peer), (peer, username)):
+                sent = self.conversations.get(key, [])
+                end = bisect_left(sent, before_id)
+                ids.extend(sent[max(0, end - limit):end])
+            return [(i, *self.archived[i]) for i in sorted(ids)[-limit:]]
+
+    def export_account(self, tx, username):
+        account = self.users.get(username)
+        if account is None:
+            return None
+        queued = [(i, *self.queued[i]) for i in self.inboxes.get(username, ())]
+        delivered = sorted((i, *self.archived[i]) for key, ids in self.conversations.items() if key[1] == username for i in ids)
+        return account[0], account[1], queued, delivered
+
+    def log_operation(self, tx, seq, method, payload, term):
+        if seq in self.oplog:
+            return self.oplog[seq][2]
+        self.change(tx, 'put_logged', seq, (method, payload, term))
+        if seq == self.applied + 1:
+            while seq + 1 in self.oplog:
+                seq += 1
+            self.change(tx, 'set_applied', seq)
+        return None
+
+    def applied_seq(self):
+        with self.lock:
+            return self.applied
+
+    def log_position(self):
+        with self.lock:
+            entry = self.oplog.get(self.applied)
+            return (entry[2] if entry else 0), self.applied
+
+    def last_seq(self):
+        with self.lock:
+            return self.seqs[-1] if self.seqs else 0
+
+    def log_entries(self, after, limit):
+        with self.lock:
+            start = bisect_left(self.seqs, after + 1)
+            return [(seq, *self.oplog[seq]) for seq in self.seqs[start:start + limit]]
+
+    def saved_vote(self):
+        with self.lock:
+            return self.term, self.voted_for
+
+    def save_vote(self, term, voted_for):
+        self.write(lambda tx: self.change(tx, 'set_vote', term, voted_for))
+
+
+# Storage engines by name, see serve()
+STORAGE_ENGINES = {'sqlite': SqliteStorage, 'memory': MemoryStorage}
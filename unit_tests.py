@@ -1,11 +1,25 @@
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import ANY, AsyncMock, MagicMock, patch
 
 import inquirer
+from prometheus_client import REGISTRY
 
 from client import *
+from consensus import LEADER, Election
+from database import Database
 from constants import *
 from server import *
+from sharding import HashRing, hash_key, moved_ranges
+from storage import MemoryStorage, SqliteStorage, Storage, migrate
+from workers import Workers
+import metrics
+import server
 
 
 class TestServerMethods(unittest.TestCase):
@@ -46,5 +60,1033 @@ class TestServerMethods(unittest.TestCase):
         with self.assertRaises(inquirer.errors.ValidationError):
             validate_regex('*\\')
 
+
+class TestChatClientRouting(unittest.TestCase):
+    def make_client(self, leaders):
+        """Builds a client whose replicas report the given leaders (None if down)"""
+        client = ChatClient.__new__(ChatClient)
+        client.lock = threading.Lock()
+        client.STUBS = []
+        for leader in leaders:
+            stub = MagicMock()
+            if leader is None:
+                stub.Heartbeat.future.return_value.result.side_effect = grpc.RpcError()
+            else:
+                stub.Heartbeat.future.return_value.result.return_value = pb2.Leader(index=leader)
+            client.STUBS.append(stub)
+        client.stub = client.STUBS[0]
+        client.max_staleness = READ_STALENESS
+        client.alive = []
+        client.reads = count()
+        client.metadata = ()
+        return client
+
+    def test_Determine_primary_Elected_replica_Preferred(self):
+        client = self.make_client([None, 1, 1])
+        self.assertTrue(client.determine_primary())
+        self.assertEqual(client.primary_index, 1)
+
+    def test_Determine_primary_Nobody_elected_yet_Lowest_alive(self):
+        client = self.make_client([None, 0, 0])
+        self.assertTrue(client.determine_primary())
+        self.assertEqual(client.primary_index, 1)
+
+    def test_Determine_primary_All_down_Returns_false(self):
+        self.assertFalse(self.make_client([None, None, None]).determine_primary())
+
+    def test_Call_Primary_down_Retries_on_new_primary(self):
+        client = self.make_client([None, 1, 1])
+        error = grpc.RpcError()
+        error.code = lambda: grpc.StatusCode.UNAVAILABLE
+        client.STUBS[0].Login.side_effect = error
+        client.STUBS[1].Login.return_value = pb2.ServerResponse(message='ok')
+        self.assertEqual(client.call('Login', pb2.Account()).message, 'ok')
+
+    def test_Call_Timed_out_send_Retried_with_same_request_id(self):
+        client = self.make_client([0, 0, 0])
+        error = grpc.RpcError()
+        error.code = lambda: grpc.StatusCode.DEADLINE_EXCEEDED
+        client.STUBS[0].SendMessage.side_effect = [error, pb2.ServerResponse(message='ok')]
+        self.assertEqual(client.send_message('yessir', 'asdfk', 'hi').message, 'ok')
+        first, second = [c.args[0] for c in client.STUBS[0].SendMessage.call_args_list]
+        self.assertTrue(first.request_id)
+        self.assertEqual(first.request_id, second.request_id)
+
+    def test_Call_Timed_out_create_account_Not_retried(self):
+        client = self.make_client([0, 0, 0])
+        error = grpc.RpcError()
+        error.code = lambda: grpc.StatusCode.DEADLINE_EXCEEDED
+        client.STUBS[0].CreateAccount.side_effect = error
+        with self.assertRaises(grpc.RpcError):
+            client.create_account('yessir', 'pw')
+        client.STUBS[0].CreateAccount.assert_called_once()
+
+    def test_Read_Stale_follower_Falls_back_to_primary(self):
+        client = self.make_client([0, 0, 0])
+        client.determine_primary()
+        client.reads = count(1)
+        error = grpc.RpcError()
+        error.code = lambda: grpc.StatusCode.FAILED_PRECONDITION
+        client.STUBS[1].ListAccounts.side_effect = error
+        client.STUBS[0].ListAccounts.return_value = pb2.Accounts(accounts=['yessir'])
+        self.assertEqual(list(client.list_accounts('yes').accounts), ['yessir'])
+        metadata = (('max-staleness', str(READ_STALENESS)),)
+        client.STUBS[1].ListAccounts.assert_called_once_with(ANY, timeout=CLIENT_TIMEOUT, metadata=metadata)
+
+
+class TestMessageNotifier(unittest.TestCase):
+    def test_Wait_Notified_Returns_new_version(self):
+        notifier = MessageNotifier()
+        version = notifier.version('yessir')
+        Thread(target=notifier.notify, args=('yessir',)).start()
+        self.assertEqual(notifier.wait('yessir', version, timeout=5), version + 1)
+
+    def test_Wait_Other_user_notified_Times_out(self):
+        notifier = MessageNotifier()
+        version = notifier.version('yessir')
+        notifier.notify('asdfk')
+        self.assertEqual(notifier.wait('yessir', version, timeout=0.01), version)
+
+
+class TestMetrics(unittest.TestCase):
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_Instrument_Code_set_by_handler_Counts_error(self):
+        def handler(request, context):
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            return 'response'
+        before = self.sample('chat_errors_total', method='Unary', code='NOT_FOUND')
+        self.assertEqual(metrics.instrument(handler, 'Unary', False)(None, MagicMock()), 'response')
+        self.assertEqual(self.sample('chat_errors_total', method='Unary', code='NOT_FOUND'), before + 1)
+        self.assertEqual(self.sample('chat_request_seconds_count', method='Unary'), 1)
+
+    def test_Instrument_Stream_closed_early_Counts_cancelled_stream(self):
+        def handler(request, context):
+            yield from range(10)
+        stream = metrics.instrument(handler, 'Stream', True)(None, MagicMock())
+        next(stream)
+        self.assertEqual(self.sample('chat_active_streams', method='Stream'), 1)
+        stream.close()
+        self.assertEqual(self.sample('chat_active_streams', method='Stream'), 0)
+        self.assertEqual(self.sample('chat_errors_total', method='Stream', code='CANCELLED'), 1)
+
+    def test_Instrument_Abort_returns_in_thread_pool_Handler_stops(self):
+        def handler(request, context):
+            context.abort(grpc.StatusCode.UNAVAILABLE, 'Not the primary.')
+            return 'applied anyway'
+        context = MagicMock()
+        context.abort.return_value = None
+        with self.assertRaises(metrics.AbortedCall):
+            metrics.instrument(handler, 'Aborted', False)(None, context)
+        self.assertEqual(self.sample('chat_errors_total', method='Aborted', code='UNAVAILABLE'), 1)
+
+
+class TestAccountIndex(unittest.TestCase):
+    index = AccountIndex(['bob', 'alice', 'alan', 'albert', 'carol'])
+
+    def test_Search_Pages_Follow_cursor(self):
+        self.assertEqual(self.index.search('a', '', 2), (['alan', 'albert'], 'albert'))
+        self.assertEqual(self.index.search('a', 'albert', 2), (['alice', 'carol'], ''))
+
+    def test_Search_Anchored_prefix_Only_returns_prefix_range(self):
+        self.assertEqual(self.index.search('^al.*t$', '', 10), (['albert'], ''))
+
+    def test_Literal_prefix_Optional_char_Is_dropped(self):
+        self.assertEqual(literal_prefix('^abc*'), 'ab')
+        self.assertEqual(literal_prefix('abc'), '')
+
+
+class TestAdmission(unittest.TestCase):
+    def test_Admit_User_over_burst_Rejects_only_that_user(self):
+        admission = Admission(user_rate=1)
+        self.assertEqual([admission.admit({'yessir': 1}) for _ in range(3)], [None, None, 'user'])
+        self.assertIsNone(admission.admit({'asdfk': 1}))
+
+    def test_Admit_Over_global_rate_Takes_no_user_tokens(self):
+        admission = Admission(user_rate=10, global_rate=1)
+        self.assertIsNone(admission.admit({'yessir': 2}))
+        self.assertEqual(admission.admit({'asdfk': 1}), 'global')
+        self.assertNotIn('asdfk', admission.users)
+
+    def test_Admit_Batch_larger_than_bucket_Leaves_it_in_debt(self):
+        admission = Admission(user_rate=1)
+        self.assertIsNone(admission.admit({'yessir': 5}))
+        self.assertEqual(admission.admit({'yessir': 1}), 'user')
+
+
+class TestDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.tmpdir.name, 'test.db'))
+        self.db.write(lambda conn: conn.execute('CREATE TABLE t (x INTEGER UNIQUE)'))
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    def test_Write_Failing_write_Only_rolls_back_itself(self):
+        def insert(x):
+            return lambda conn: conn.execute('INSERT INTO t VALUES (?)', (x,))
+        with futures.ThreadPoolExecutor(max_workers=8) as pool:
+            results = [pool.submit(self.db.write, insert(x % 5)) for x in range(10)]
+            errors = [r.exception() for r in results]
+        self.assertEqual(sum(e is not None for e in errors), 5)
+        self.assertEqual(self.db.read().execute('SELECT COUNT(*) FROM t').fetchone()[0], 5)
+
+    def test_On_rollback_Failing_write_Runs_undo(self):
+        undone = []
+        def write(conn):
+            conn.execute('INSERT INTO t VALUES (1)')
+            self.db.on_rollback(lambda: undone.append(1))
+            conn.execute('INSERT INTO t VALUES (1)')
+        self.assertRaises(sqlite3.IntegrityError, self.db.write, write)
+        self.assertEqual(undone, [1])
+
+    def test_Read_Uses_wal_mode(self):
+        self.assertEqual(self.db.read().execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+
+class StorageConformance:
+    """Tests every storage engine has to pass, run by a TestCase per engine"""
+    engine = None
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'chat' + self.engine.suffix)
+        self.store = self.engine(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmpdir.cleanup()
+
+    def write(self, method, *args):
+        return self.store.write(lambda tx: getattr(self.store, method)(tx, *args))
+
+    def test_Accounts_Add_status_and_delete_Round_trip(self):
+        self.assertTrue(self.write('add_account', 'yessir', 'pw'))
+        self.assertFalse(self.write('add_account', 'yessir', 'other'))
+        self.write('set_status', 'yessir', 1)
+        self.assertEqual(tuple(self.store.account('yessir')), ('pw', 1))
+        self.assertFalse(self.write('delete_account', 'yessir', 'wrong'))
+        self.assertTrue(self.write('delete_account', 'yessir', 'pw'))
+        self.assertEqual(list(self.store.accounts()), [])
+
+    def test_Messages_Acknowledged_and_archived_Page_back_through_conversation(self):
+        rows = [(i, 'asdfk', 'yessir', str(i)) if i % 2 else (i, 'yessir', 'asdfk', str(i)) for i in range(1, 7)]
+        self.write('queue_messages', rows)
+        self.assertEqual(self.store.queued_messages('yessir', after=1, limit=1), [(3, 'asdfk', '3')])
+
+        self.assertEqual(self.write('acknowledge_messages', 'yessir', 3), 2)
+        self.write('archive_messages', 'asdfk', self.store.queued_messages('asdfk'))
+        self.assertEqual(self.store.queued_messages('yessir'), [(5, 'asdfk', '5')])
+        self.assertEqual(self.store.queued_messages('asdfk'), [])
+        page = self.store.conversation('asdfk', 'yessir', 6, 3)
+        self.assertEqual([tuple(row) for row in page], [(2, 'yessir', 'asdfk', '2'), (3, 'asdfk', 'yessir', '3'), (4, 'yessir', 'asdfk', '4')])
+        self.assertEqual(self.store.last_message_id(), 6)
+
+    def test_Log_operation_Out_of_order_Applied_position_skips_no_gap(self):
+        self.assertIsNone(self.write('log_operation', 2, 'Login', b'2', 1))
+        self.assertEqual(self.store.applied_seq(), 0)
+        self.assertIsNone(self.write('log_operation', 1, 'Login', b'1', 1))
+        self.assertEqual(tuple(self.store.log_position()), (1, 2))
+        self.assertEqual(self.write('log_operation', 2, 'Login', b'2', 3), 1)
+        self.assertEqual([tuple(e) for e in self.store.log_entries(1, 10)], [(2, 'Login', b'2', 1)])
+        self.assertEqual(self.store.last_seq(), 2)
+
+    def test_Write_Failing_write_Undoes_all_its_changes(self):
+        undone = []
+        def write(tx):
+            self.store.add_account(tx, 'yessir', 'pw')
+            self.store.queue_messages(tx, [(1, 'asdfk', 'yessir', 'hi')])
+            self.store.on_rollback(lambda: undone.append(1))
+            self.store.queue_messages(tx, [(1, 'asdfk', 'yessir', 'again')])
+        self.assertRaises(Exception, self.store.write, write)
+        self.assertIsNone(self.store.account('yessir'))
+        self.assertEqual(self.store.queued_messages('yessir'), [])
+        self.assertEqual(undone, [1])
+
+    def test_Snapshot_and_reopen_Keep_committed_writes(self):
+        self.write('add_account', 'yessir', 'pw')
+        self.write('log_operation', 1, 'CreateAccount', b'', 0)
+        self.store.save_vote(3, 1)
+        copy = os.path.join(self.tmpdir.name, 'copy' + self.engine.suffix)
+        self.assertEqual(self.store.snapshot(copy), 1)
+
+        self.store.close()
+        for path in (self.path, copy):
+            self.store = self.engine(path)
+            self.assertEqual(tuple(self.store.account('yessir')), ('pw', 0))
+            self.assertEqual((self.store.applied_seq(), tuple(self.store.saved_vote())), (1, (3, 1)))
+            if path == self.path:
+                self.store.close()
+
+
+class TestSqliteStorage(StorageConformance, unittest.TestCase):
+    engine = SqliteStorage
+
+    def test_Engine_Missing_method_Cannot_be_created(self):
+        class Partial(Storage):
+            def write(self, fn):
+                return fn(None)
+
+        with self.assertRaises(TypeError):
+            Partial()
+
+
+class TestMemoryStorage(StorageConformance, unittest.TestCase):
+    engine = MemoryStorage
+
+    def test_Reopen_After_snapshot_Replays_journal_and_drops_torn_tail(self):
+        self.write('add_account', 'yessir', 'pw')
+        self.store.write(lambda tx: self.store.checkpoint())
+        self.write('set_status', 'yessir', 1)
+        self.store.close()
+        with open(self.path + '-journal', 'ab') as f:
+            f.write(b'\x80\x05torn')
+
+        self.store = MemoryStorage(self.path)
+        self.assertEqual(self.store.account('yessir'), ('pw', 1))
+        self.write('add_account', 'asdfk', 'pw')
+        self.store.close()
+        self.store = MemoryStorage(self.path)
+        self.assertEqual(sorted(self.store.accounts()), [('asdfk', 0), ('yessir', 1)])
+
+
+class TestChatService(unittest.TestCase):
+    def setUp(self):
+        # Every test gets a fresh database in its own directory
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        server.index = server.primary_index = server.primary_term = 0
+        server.election = None
+        server.workers = None
+        server.STUBS = [MagicMock()]
+        server.admission = Admission()
+        self.service = ChatService()
+        self.context = MagicMock()
+        self.context.invocation_metadata.return_value = []
+
+    def tearDown(self):
+        self.service.db.close()
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def test_Replicated_Primary_Streams_to_all_secondaries(self):
+        received = []
+
+        def replicate(batches):
+            for batch in batches:
+                received.extend((entry.seq, entry.method) for entry in batch.entries)
+                yield pb2.LogPosition(seq=batch.entries[-1].seq)
+
+        healthy, dead = MagicMock(), MagicMock()
+        healthy.Replicate.side_effect = replicate
+        dead.Heartbeat.side_effect = grpc.RpcError()
+        server.STUBS = [server.STUBS[0], healthy, dead]
+        for username in ('yessir', 'asdfk'):
+            response = self.service.CreateAccount(pb2.Account(username=username, password='pw'), self.context)
+            self.assertFalse(response.error)
+
+        self.service.wait_for_acks(2, 1, 1.0)
+        self.assertEqual(received, [(1, 'CreateAccount'), (2, 'CreateAccount')])
+        self.assertEqual(self.service.replicators[0].acked, 2)
+        dead.Replicate.assert_not_called()
+
+    def test_Replicated_Write_concern_all_Dead_secondary_Aborts_after_applying(self):
+        dead = MagicMock()
+        dead.Heartbeat.side_effect = grpc.RpcError()
+        server.STUBS = [server.STUBS[0], dead]
+        self.context.invocation_metadata.return_value = [('write-concern', 'all')]
+        self.service.CreateAccount(pb2.Account(username='yessir', password='pw'), self.context)
+        self.context.set_code.assert_called_once_with(grpc.StatusCode.ABORTED)
+        self.assertEqual(self.service.accounts.usernames, ['yessir'])
+
+    def test_Replicated_Write_concern_majority_Secondaries_down_Fails_without_applying(self):
+        dead = MagicMock()
+        dead.Heartbeat.side_effect = grpc.RpcError()
+        server.STUBS = [server.STUBS[0], dead, dead]
+        replicators = self.service.secondaries()
+        deadline = time.monotonic() + 1.0
+        while not all(r.down for r in replicators) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.context.invocation_metadata.return_value = [('write-concern', 'majority')]
+        self.context.abort.side_effect = grpc.RpcError()
+        with self.assertRaises(grpc.RpcError):
+            self.service.CreateAccount(pb2.Account(username='yessir', password='pw'), self.context)
+        self.assertEqual(self.context.abort.call_args[0][0], grpc.StatusCode.UNAVAILABLE)
+        self.assertEqual(self.service.accounts.usernames, [])
+
+    def test_Required_acks_Consensus_mode_Takes_a_majority_whatever_the_concern(self):
+        server.STUBS = [MagicMock() for _ in range(5)]
+        self.assertEqual([self.service.required_acks(c) for c in WRITE_CONCERNS], [0, 2, 4])
+        server.election = Election(0, 5, now=0.0)
+        self.assertEqual([self.service.required_acks(c) for c in WRITE_CONCERNS], [2, 2, 4])
+
+    def test_Replicated_Last_replica_as_primary_Streams_to_replicas_before_it(self):
+        received = []
+
+        def replicate(batches):
+            for batch in batches:
+                received.extend(entry.seq for entry in batch.entries)
+                yield pb2.LogPosition(seq=batch.entries[-1].seq)
+
+        server.index = server.primary_index = 2
+        server.STUBS = [MagicMock(), MagicMock(), server.STUBS[0]]
+        server.STUBS[0].Replicate.side_effect = replicate
+        self.context.invocation_metadata.return_value = [('write-concern', 'majority')]
+        response = self.service.CreateAccount(pb2.Account(username='yessir', password='pw'), self.context)
+        self.assertFalse(response.error)
+        self.context.set_code.assert_not_called()
+        self.assertEqual(received, [1])
+
+    def test_Replicated_Write_concern_primary_Answers_before_lagging_secondary(self):
+        stuck = MagicMock()
+        stuck.Replicate.side_effect = lambda batches: iter(threading.Event().wait, True)
+        server.STUBS = [server.STUBS[0], stuck]
+        self.context.invocation_metadata.return_value = [('write-concern', 'primary')]
+        start = time.monotonic()
+        self.service.CreateAccount(pb2.Account(username='yessir', password='pw'), self.context)
+        self.assertLess(time.monotonic() - start, server.REPLICATION_TIMEOUT)
+        self.context.set_code.assert_not_called()
+        self.assertEqual(self.service.replicators[0].lag()[0], 1)
+
+    def test_Replicated_Concurrent_writes_Are_queued_in_seq_order(self):
+        next_seq, queue_entries, queued = self.service.next_seq, self.service.queue_entries, []
+
+        def slow_next_seq(seq=0):
+            seq = next_seq(seq)
+            time.sleep(random.random() / 100)
+            return seq
+
+        def record(entries):
+            queued.extend(seq for seq, _, _, _ in entries)
+            return queue_entries(entries)
+
+        self.service.next_seq, self.service.queue_entries = slow_next_seq, record
+        threads = [
+            threading.Thread(target=self.service.CreateAccount, args=(pb2.Account(username=f'user{i}', password='pw'), self.context))
+            for i in range(10)
+        ]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        self.assertEqual(queued, sorted(queued))
+        self.assertEqual(len(self.service.accounts.usernames), 10)
+
+    def test_Replicated_Unknown_write_concern_Aborts(self):
+        self.context.invocation_metadata.return_value = [('write-concern', 'some')]
+        self.context.abort.side_effect = grpc.RpcError()
+        with self.assertRaises(grpc.RpcError):
+            self.service.CreateAccount(pb2.Account(username='yessir', password='pw'), self.context)
+        self.assertEqual(self.context.abort.call_args[0][0], grpc.StatusCode.INVALID_ARGUMENT)
+
+    def test_Replicate_Applies_batches_and_acknowledges_last_seq(self):
+        entries = [
+            pb2.LogEntry(seq=seq, method='CreateAccount', payload=pb2.Account(username=username).SerializeToString())
+            for seq, username in ((1, 'yessir'), (2, 'asdfk'), (3, 'bob'))
+        ]
+        batches = [pb2.LogBatch(entries=entries[:2]), pb2.LogBatch(entries=entries[2:])]
+        acks = [position.seq for position in self.service.Replicate(iter(batches), self.context)]
+        self.assertEqual(acks, [2, 3])
+        self.assertEqual(self.service.applied_seq(), 3)
+        self.assertEqual(self.service.accounts.usernames, ['asdfk', 'bob', 'yessir'])
+
+    def test_Send_messages_Batch_Inserts_valid_messages(self):
+        for username in ('yessir', 'asdfk'):
+            account = pb2.Account(username=username, password='pw')
+            self.service.CreateAccount(account, self.context)
+        self.service.Login(pb2.Account(username='yessir', password='pw'), self.context)
+        messages = [
+            pb2.MessageInfo(source='yessir', destination='asdfk', text='hi'),
+            pb2.MessageInfo(source='yessir', destination='nobody', text='hi'),
+            pb2.MessageInfo(source='asdfk', destination='yessir', text='hi'),
+        ]
+        response = self.service.SendMessages(iter(messages), self.context)
+        self.assertTrue(response.error)
+        rows = self.service.db.read().execute("SELECT source, destination FROM messages").fetchall()
+        self.assertEqual(rows, [('yessir', 'asdfk')])
+
+    def test_Receive_messages_Acknowledged_batch_Moves_to_history(self):
+        for username in ('yessir', 'asdfk'):
+            account = pb2.Account(username=username, password='pw')
+            self.service.CreateAccount(account, self.context)
+            self.service.Login(account, self.context)
+        for text in ('a', 'b', 'c'):
+            self.service.SendMessage(pb2.MessageInfo(source='asdfk', destination='yessir', text=text), self.context)
+
+        stream = self.service.ReceiveMessages(pb2.Cursor(username='yessir'), self.context)
+        batch = next(stream).messages
+        stream.close()
+        self.assertEqual([m.text for m in batch], ['a', 'b', 'c'])
+
+        self.service.AcknowledgeMessages(pb2.Cursor(username='yessir', id=batch[1].id), self.context)
+        conn = self.service.db.read()
+        self.assertEqual(conn.execute('SELECT source, destination, text FROM history ORDER BY id').fetchall(),
+                         [('asdfk', 'yessir', 'a'), ('asdfk', 'yessir', 'b')])
+        self.assertEqual(conn.execute('SELECT text FROM messages').fetchall(), [('c',)])
+
+    def test_Get_history_Pages_Back_through_conversation(self):
+        rows = [(i, 'yessir', 'asdfk', str(i)) if i % 2 else (i, 'asdfk', 'yessir', str(i)) for i in range(1, 8)]
+        rows.append((8, 'bob', 'yessir', 'other conversation'))
+        self.service.db.write(lambda conn: conn.executemany('INSERT INTO history VALUES (?, ?, ?, ?)', rows))
+
+        page = self.service.GetHistory(pb2.HistoryQuery(username='yessir', peer='asdfk', limit=3), self.context)
+        self.assertEqual([m.text for m in page.messages], ['5', '6', '7'])
+        page = self.service.GetHistory(pb2.HistoryQuery(username='yessir', peer='asdfk', before_id=page.before_id, limit=3), self.context)
+        self.assertEqual([m.text for m in page.messages], ['2', '3', '4'])
+        page = self.service.GetHistory(pb2.HistoryQuery(username='asdfk', peer='yessir', before_id=page.before_id, limit=3), self.context)
+        self.assertEqual(([m.text for m in page.messages], page.before_id), (['1'], 0))
+
+        plan = self.service.db.read().execute(
+            'EXPLAIN QUERY PLAN SELECT id FROM history WHERE source = ? AND destination = ? AND id < ? ORDER BY id DESC', ('a', 'b', 5)
+        )
+        self.assertIn('history_conversation', str(plan.fetchall()))
+
+    def test_Send_message_Retried_request_Is_stored_once(self):
+        account = pb2.Account(username='yessir', password='pw')
+        self.service.CreateAccount(account, self.context)
+        self.service.Login(account, self.context)
+        message = pb2.MessageInfo(source='yessir', destination='yessir', text='hi', request_id='a1')
+        self.service.SendMessage(message, self.context)
+        response = self.service.SendMessage(message, self.context)
+        self.assertFalse(response.error)
+        self.assertEqual(len(self.service.db.queued_messages('yessir')), 1)
+
+        # A restarted replica finds the request ids in its operation log again
+        self.service.db.close()
+        self.service = ChatService()
+        self.service.SendMessage(message, self.context)
+        self.service.SendMessage(pb2.MessageInfo(source='yessir', destination='yessir', text='hi'), self.context)
+        self.assertEqual(len(self.service.db.queued_messages('yessir')), 2)
+
+    def test_Send_message_Concurrent_sends_Are_committed_in_id_order(self):
+        account = pb2.Account(username='yessir', password='pw')
+        self.service.CreateAccount(account, self.context)
+        self.service.Login(account, self.context)
+        assign_message_ids = self.service.assign_message_ids
+
+        def slow_assign_message_ids(messages):
+            assign_message_ids(messages)
+            time.sleep(random.random() / 100)
+
+        # A message that got the lower id but committed later would be skipped by a stream's cursor
+        self.service.assign_message_ids = slow_assign_message_ids
+        threads = [
+            threading.Thread(target=self.service.SendMessage,
+                             args=(pb2.MessageInfo(source='yessir', destination='yessir', text=str(i)), self.context))
+            for i in range(10)
+        ]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        ids = [decode_request(method, payload).id for _, method, payload, _ in self.service.db.log_entries(0, -1) if method == 'SendMessage']
+        self.assertEqual(len(ids), 10)
+        self.assertEqual(ids, sorted(ids))
+
+    def test_Send_message_Unknown_sender_Returns_error(self):
+        self.service.CreateAccount(pb2.Account(username='yessir', password='pw'), self.context)
+        response = self.service.SendMessage(pb2.MessageInfo(source='nobody', destination='yessir', text='hi'), self.context)
+        self.assertTrue(response.error)
+
+    def test_Send_message_Over_user_rate_Aborts_before_replicating(self):
+        account = pb2.Account(username='yessir', password='pw')
+        self.service.CreateAccount(account, self.context)
+        self.service.Login(account, self.context)
+        server.admission = Admission(user_rate=1)
+        self.context.abort.side_effect = grpc.RpcError()
+        throttled = REGISTRY.get_sample_value('chat_throttled_total', {'method': 'SendMessage', 'limit': 'user'}) or 0
+
+        message = pb2.MessageInfo(source='yessir', destination='yessir', text='hi')
+        for _ in range(2):
+            self.assertFalse(self.service.SendMessage(message, self.context).error)
+        seq = self.service.last_seq
+        with self.assertRaises(grpc.RpcError):
+            self.service.SendMessage(message, self.context)
+        self.assertEqual(self.context.abort.call_args[0][0], grpc.StatusCode.RESOURCE_EXHAUSTED)
+        self.assertEqual(self.service.last_seq, seq)
+        self.assertEqual(REGISTRY.get_sample_value('chat_throttled_total', {'method': 'SendMessage', 'limit': 'user'}), throttled + 1)
+
+    def test_Send_message_Secondary_Takes_no_tokens(self):
+        server.index = 1
+        server.admission = Admission(user_rate=1)
+        self.context.abort.side_effect = grpc.RpcError()
+        with self.assertRaises(grpc.RpcError):
+            self.service.SendMessage(pb2.MessageInfo(source='yessir', destination='yessir', text='hi'), self.context)
+        self.assertEqual(self.context.abort.call_args[0][0], grpc.StatusCode.UNAVAILABLE)
+        self.assertEqual(server.admission.users, {})
+
+    def test_Async_send_message_Over_user_rate_Rejected_before_thread_pool(self):
+        self.service.db.close()
+        self.service = AsyncChatService()
+        account = pb2.Account(username='yessir', password='pw')
+        self.service.CreateAccount(account, self.context)
+        self.service.Login(account, self.context)
+        server.admission = Admission(user_rate=1)
+        self.context.abort = AsyncMock(side_effect=grpc.RpcError())
+        message = pb2.MessageInfo(source='yessir', destination='yessir', text='hi')
+
+        async def send(n):
+            for _ in range(n):
+                await self.service.SendMessage(message, self.context)
+
+        with patch.object(self.service.senders, 'submit', wraps=self.service.senders.submit) as submit:
+            asyncio.run(send(2))
+            with self.assertRaises(grpc.RpcError):
+                asyncio.run(send(1))
+        self.assertEqual(self.context.abort.call_args[0][0], grpc.StatusCode.RESOURCE_EXHAUSTED)
+        self.assertEqual(submit.call_count, 2)
+        self.assertEqual(len(self.service.db.queued_messages('yessir')), 2)
+
+    def test_Apply_Login_then_send_in_one_transaction_Sees_presence(self):
+        account = pb2.Account(username='yessir', password='pw')
+        message = pb2.MessageInfo(id=1, source='yessir', destination='yessir', text='hi')
+        responses = self.service.apply([(1, 'CreateAccount', account, 0), (2, 'Login', account, 0), (3, 'SendMessage', message, 0)])
+        self.assertEqual([r.error for r in responses], [False, False, False])
+        self.assertEqual(self.service.accounts.status('yessir'), 1)
+
+    def test_Migrate_Legacy_database_Adds_ids_and_index(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE messages (source TEXT, destination TEXT, text TEXT)')
+        conn.execute('CREATE TABLE history (source TEXT, destination TEXT, text TEXT)')
+        conn.executemany('INSERT INTO messages VALUES (?, ?, ?)', [('yessir', 'asdfk', 'hi')] * 2)
+        conn.execute('INSERT INTO history VALUES (?, ?, ?)', ('asdfk', 'yessir', 'yo'))
+        migrate(conn)
+        self.assertEqual(conn.execute('SELECT id, source, destination FROM history').fetchall(), [(1, 'yessir', 'asdfk')])
+        self.assertEqual(conn.execute('SELECT id FROM messages').fetchall(), [(2,), (3,)])
+        plan = conn.execute('EXPLAIN QUERY PLAN SELECT id FROM messages WHERE destination = ? ORDER BY id', ('asdfk',))
+        self.assertIn('messages_destination', str(plan.fetchall()))
+
+    def test_Migrate_Version_2_history_Swaps_only_rows_archived_by_listen(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY, source TEXT, destination TEXT, text TEXT)')
+        conn.execute('CREATE TABLE history (id INTEGER PRIMARY KEY, source TEXT, destination TEXT, text TEXT)')
+        conn.execute('CREATE TABLE oplog (seq INTEGER PRIMARY KEY, method TEXT, payload BLOB)')
+        conn.execute('CREATE TABLE replication (applied_seq INTEGER)')
+        conn.execute('INSERT INTO replication VALUES (1)')
+        conn.execute('PRAGMA user_version = 2')
+        # Message 1 was archived by ListenMessages, message 2 by AcknowledgeMessages
+        conn.execute('INSERT INTO history VALUES (?, ?, ?, ?)', (1, 'yessir', 'asdfk', 'yo'))
+        conn.execute('INSERT INTO history VALUES (?, ?, ?, ?)', (2, 'asdfk', 'yessir', 'hi'))
+        cursor = pb2.Cursor(username='yessir', id=2).SerializeToString()
+        conn.execute('INSERT INTO oplog VALUES (?, ?, ?)', (1, 'AcknowledgeMessages', cursor))
+        migrate(conn)
+        rows = conn.execute('SELECT id, source, destination FROM history ORDER BY id').fetchall()
+        self.assertEqual(rows, [(1, 'asdfk', 'yessir'), (2, 'asdfk', 'yessir')])
+
+    def test_List_accounts_Invalid_regex_Sets_invalid_argument(self):
+        response = self.service.ListAccounts(pb2.SearchTerm(searchterm='*\\'), self.context)
+        self.context.set_code.assert_called_once_with(grpc.StatusCode.INVALID_ARGUMENT)
+        self.assertEqual(list(response.accounts), [])
+
+    def test_Apply_Out_of_order_and_repeated_ops_Applied_once(self):
+        account = lambda name: pb2.Account(username=name, password='pw')
+        self.service.apply([(2, 'CreateAccount', account('asdfk'), 0)])
+        self.assertEqual(self.service.applied_seq(), 0)
+        self.service.apply([(1, 'CreateAccount', account('yessir'), 0)])
+        self.assertEqual(self.service.applied_seq(), 2)
+        response = self.service.apply([(1, 'CreateAccount', account('yessir'), 0)])[0]
+        self.assertIn('already applied', response.message)
+
+    def test_Catch_up_Streams_entries_after_position(self):
+        for name in ('yessir', 'asdfk', 'bob'):
+            self.service.CreateAccount(pb2.Account(username=name, password='pw'), self.context)
+        entries = list(self.service.CatchUp(pb2.LogPosition(seq=1), self.context))
+        self.assertEqual([e.seq for e in entries], [2, 3])
+        self.assertEqual(decode_request(entries[0].method, entries[0].payload).username, 'asdfk')
+
+    def test_Stream_snapshot_Chunks_Form_consistent_database(self):
+        self.service.CreateAccount(pb2.Account(username='yessir', password='pw'), self.context)
+        chunks = list(self.service.StreamSnapshot(pb2.NoParam(), self.context))
+        self.assertEqual((chunks[0].seq, chunks[0].size), (1, sum(len(c.data) for c in chunks)))
+        with open('copy.db', 'wb') as f:
+            f.write(b''.join(c.data for c in chunks))
+        conn = sqlite3.connect('copy.db')
+        self.assertEqual(conn.execute('SELECT username FROM accounts').fetchall(), [('yessir',)])
+        conn.close()
+
+    def test_Replicate_Operation_from_another_term_Aborts(self):
+        self.service.apply([(1, 'CreateAccount', pb2.Account(username='yessir'), 1)])
+        server.election = Election(0, 3, term=2, now=0.0)
+        self.context.abort.side_effect = grpc.RpcError()
+        payload = pb2.Account(username='asdfk').SerializeToString()
+        batch = pb2.LogBatch(entries=[pb2.LogEntry(seq=1, method='CreateAccount', payload=payload, term=2)])
+        with self.assertRaises(grpc.RpcError):
+            list(self.service.Replicate(iter([batch]), self.context))
+        self.assertEqual(self.context.abort.call_args[0][0], grpc.StatusCode.FAILED_PRECONDITION)
+        self.assertEqual(self.service.accounts.usernames, ['yessir'])
+
+    def test_Replicate_Primary_replaced_while_catching_up_Not_acknowledged(self):
+        server.index, server.primary_index, server.primary_term = 1, 0, 4
+        server.STUBS = [MagicMock(), server.STUBS[0]]
+
+        def catch_up(source):
+            # Another replica took over while the old primary's operations were streamed
+            server.primary_index, server.primary_term = 2, 5
+        self.service.catch_up = catch_up
+        self.context.abort.side_effect = grpc.RpcError()
+        payload = pb2.Account(username='asdfk').SerializeToString()
+        batch = pb2.LogBatch(entries=[pb2.LogEntry(seq=2, method='CreateAccount', payload=payload, term=4)])
+        with self.assertRaises(grpc.RpcError):
+            next(self.service.Replicate(iter([batch]), self.context))
+        self.assertEqual(self.context.abort.call_args[0][0], grpc.StatusCode.FAILED_PRECONDITION)
+
+    def test_Replicated_Consensus_without_lease_Unavailable(self):
+        server.election = Election(0, 3, now=0.0)
+        self.context.abort.side_effect = grpc.RpcError()
+        with self.assertRaises(grpc.RpcError):
+            self.service.CreateAccount(pb2.Account(username='yessir', password='pw'), self.context)
+        self.assertEqual(self.context.abort.call_args[0][0], grpc.StatusCode.UNAVAILABLE)
+        self.assertEqual(self.service.applied_seq(), 0)
+
+    def test_Replicated_Secondary_without_relay_Unavailable(self):
+        server.index = 1
+        self.context.abort.side_effect = grpc.RpcError()
+        with self.assertRaises(grpc.RpcError):
+            self.service.CreateAccount(pb2.Account(username='yessir', password='pw'), self.context)
+        self.assertEqual(self.context.abort.call_args[0][0], grpc.StatusCode.UNAVAILABLE)
+        self.assertEqual(self.service.applied_seq(), 0)
+
+    def test_Announce_leader_Lower_replica_in_later_term_Followed(self):
+        server.index, server.primary_index, server.primary_term = 1, 2, 1
+        self.service.AnnounceLeader(pb2.Leader(index=0, term=2), self.context)
+        self.assertEqual(self.service.Heartbeat(pb2.NoParam(), self.context).index, 0)
+
+    def test_Announce_leader_Claim_of_earlier_term_Ignored(self):
+        server.index, server.primary_index, server.primary_term = 1, 0, 2
+        self.service.AnnounceLeader(pb2.Leader(index=2, term=1), self.context)
+        self.assertEqual(self.service.Heartbeat(pb2.NoParam(), self.context).index, 0)
+
+    def test_Announce_leader_Primary_Steps_down_for_later_term(self):
+        server.primary_term = 1
+        self.service.AnnounceLeader(pb2.Leader(index=1, term=0), self.context)
+        self.assertTrue(server.leading())
+        self.service.AnnounceLeader(pb2.Leader(index=1, term=2), self.context)
+        self.assertFalse(server.leading())
+        self.assertEqual(self.service.Heartbeat(pb2.NoParam(), self.context).term, 2)
+
+    def test_Take_over_Replica_already_took_over_Follows_it(self):
+        server.index = 1
+        server.STUBS = [MagicMock(), server.STUBS[0], MagicMock()]
+        server.STUBS[0].Heartbeat.future.return_value.result.side_effect = grpc.RpcError()
+        server.STUBS[2].Heartbeat.future.return_value.result.return_value = pb2.Leader(index=2, term=3)
+        self.assertEqual(server.take_over(0)[:2], (2, 3))
+
+    def test_Take_over_Next_replica_down_Takes_role_in_new_term(self):
+        server.index, server.primary_term = 0, 3
+        server.STUBS = [server.STUBS[0], MagicMock(), MagicMock()]
+        for stub in server.STUBS[1:]:
+            stub.Heartbeat.future.return_value.result.side_effect = grpc.RpcError()
+        self.assertEqual(server.take_over(1)[:2], (0, 6))
+
+    def test_Take_over_Next_replica_up_Followed_in_the_term_it_claims(self):
+        server.index, server.primary_term = 0, 4
+        server.STUBS = [server.STUBS[0], MagicMock(), MagicMock()]
+        server.STUBS[1].Heartbeat.future.return_value.result.side_effect = grpc.RpcError()
+        server.STUBS[2].Heartbeat.future.return_value.result.return_value = pb2.Leader(index=1, term=4)
+        self.assertEqual(server.take_over(1)[:2], (2, 5))
+
+    def test_Next_term_Replicas_taking_over_at_once_Claim_different_terms(self):
+        server.STUBS = [MagicMock()] * 3
+        terms = []
+        for server.index in range(3):
+            terms.append(server.next_term(4))
+        self.assertEqual(terms, [6, 7, 5])
+
+    def test_Discover_primary_Restarted_replica_0_Follows_latest_claim(self):
+        server.STUBS = [server.STUBS[0], MagicMock(), MagicMock()]
+        server.STUBS[1].Heartbeat.future.return_value.result.return_value = pb2.Leader(index=1, term=2)
+        server.STUBS[2].Heartbeat.future.return_value.result.return_value = pb2.Leader(index=2, term=1)
+        server.primary_index, server.primary_term = server.discover_primary()
+        self.assertEqual((server.primary_index, server.primary_term), (1, 2))
+
+        # It no longer serves reads as the primary before it has caught up with it
+        server.primary_positions.clear()
+        self.context.invocation_metadata.return_value = [('max-staleness', '1.0')]
+        self.service.ListAccounts(pb2.SearchTerm(searchterm=''), self.context)
+        self.context.set_code.assert_called_once_with(grpc.StatusCode.FAILED_PRECONDITION)
+
+    def test_Discover_primary_No_replica_claims_it_Starts_from_replica_0(self):
+        server.index = 2
+        server.STUBS = [MagicMock(), MagicMock(), server.STUBS[0]]
+        server.STUBS[0].Heartbeat.future.return_value.result.side_effect = grpc.RpcError()
+        server.STUBS[1].Heartbeat.future.return_value.result.return_value = pb2.Leader(index=0, term=1)
+        # Followed in the term replica 0 is going to claim
+        self.assertEqual(server.discover_primary(), (0, 3))
+
+    def test_Diverged_from_Replica_lacks_last_operation_Diverged(self):
+        self.service.CreateAccount(pb2.Account(username='yessir', password='pw'), self.context)
+        server.STUBS = [server.STUBS[0], MagicMock()]
+        server.STUBS[1].CatchUp.return_value = iter([])
+        self.assertTrue(self.service.diverged_from(1))
+        server.STUBS[1].CatchUp.return_value = iter([pb2.LogEntry(seq=1, term=0)])
+        self.assertFalse(self.service.diverged_from(1))
+        server.STUBS[1].CatchUp.return_value = iter([pb2.LogEntry(seq=1, term=1)])
+        self.assertTrue(self.service.diverged_from(1))
+
+    def replicate_conflict(self, term):
+        """Streams to this replica an operation of replica 1 in the given term, which conflicts with one it logged"""
+        primary = ChatService.__new__(ChatService)
+        os.mkdir('primary')
+        os.chdir('primary')
+        server.index = 1
+        primary.__init__()
+        primary.apply([(1, 'CreateAccount', pb2.Account(username='asdfk', password='pw'), term)])
+        primary.save_vote(term, 1)
+        os.chdir('..')
+        server.index = 0
+
+        # This replica applied an operation of a deposed primary under the same number
+        self.service.apply([(1, 'CreateAccount', pb2.Account(username='yessir', password='pw'), term - 1)])
+        server.primary_index = 1
+        server.STUBS = [server.STUBS[0], MagicMock()]
+        server.STUBS[1].StreamSnapshot.side_effect = lambda request, timeout: primary.StreamSnapshot(request, self.context)
+        batch = pb2.LogBatch(entries=[pb2.LogEntry(seq=1, method='CreateAccount', payload=pb2.Account(username='asdfk').SerializeToString(), term=term)])
+        positions = list(self.service.Replicate(iter([batch]), self.context))
+        primary.db.close()
+        return positions
+
+    def test_Catch_up_Last_operation_logged_in_another_term_Rejoins(self):
+        # A deposed leader's last operation, which the new leader logged in its own term
+        self.service.apply([(1, 'CreateAccount', pb2.Account(username='yessir', password='pw'), 1)])
+        server.primary_index = 1
+        server.STUBS = [server.STUBS[0], MagicMock()]
+        payload = pb2.Account(username='asdfk').SerializeToString()
+        server.STUBS[1].CatchUp.return_value = iter([pb2.LogEntry(seq=1, method='CreateAccount', payload=payload, term=2)])
+        self.service.rejoin = MagicMock()
+        self.service.catch_up(1)
+        self.assertEqual(server.STUBS[1].CatchUp.call_args[0][0], pb2.LogPosition(seq=0))
+        self.service.rejoin.assert_called_once_with(1)
+
+    def test_Replicate_Conflict_with_primary_Rejoins_from_its_snapshot(self):
+        server.primary_term = 1
+        positions = self.replicate_conflict(1)
+        self.assertEqual(positions, [pb2.LogPosition(seq=1)])
+        self.assertEqual(self.service.accounts.usernames, ['asdfk'])
+        self.assertEqual(self.service.log_position(), (1, 1))
+
+    def test_Replicate_Consensus_conflict_with_leader_Rejoins_and_keeps_its_vote(self):
+        server.election = Election(0, 2, term=3, voted_for=0, now=0.0)
+        self.service.save_vote(3, 0)
+        positions = self.replicate_conflict(3)
+        self.assertEqual(positions, [pb2.LogPosition(seq=1)])
+        self.assertEqual(self.service.accounts.usernames, ['asdfk'])
+        self.assertEqual(self.service.saved_vote(), (3, 0))
+
+    def test_List_accounts_Stale_secondary_Sets_failed_precondition(self):
+        server.index = 1
+        server.primary_positions.clear()
+        server.primary_positions.append((monotonic(), 5))
+        self.context.invocation_metadata.return_value = [('max-staleness', '1.0')]
+        self.service.ListAccounts(pb2.SearchTerm(searchterm=''), self.context)
+        self.context.set_code.assert_called_once_with(grpc.StatusCode.FAILED_PRECONDITION)
+
+        # Once the primary is seen at a position this replica has reached, it serves reads again
+        server.primary_positions.append((monotonic(), 0))
+        self.service.ListAccounts(pb2.SearchTerm(searchterm=''), self.context)
+        self.context.set_code.assert_called_once()
+
+    def test_Listen_messages_Delivered_messages_Acknowledged_through_log(self):
+        for username in ('yessir', 'asdfk'):
+            account = pb2.Account(username=username, password='pw')
+            self.service.CreateAccount(account, self.context)
+            self.service.Login(account, self.context)
+        for text in ('hi', 'yo'):
+            self.service.SendMessage(pb2.MessageInfo(source='asdfk', destination='yessir', text=text), self.context)
+        self.context.is_active.side_effect = [True, False]
+        self.service.notifier.wait = lambda username, version, timeout: version
+
+        delivered = list(self.service.ListenMessages(pb2.Account(username='yessir'), self.context))
+        self.assertEqual([m.text for m in delivered], ['hi', 'yo'])
+        # The secondaries archive them too, since the acknowledgement is a replicated operation
+        _, method, payload, _ = self.service.db.log_entries(0, -1)[-1]
+        self.assertEqual((method, decode_request(method, payload).id), ('AcknowledgeMessages', delivered[-1].id))
+        self.assertEqual(self.service.db.queued_messages('yessir'), [])
+
+    def test_Async_listen_messages_Wakes_up_on_new_message(self):
+        self.service.db.close()
+        self.service = AsyncChatService()
+        for username in ('yessir', 'asdfk'):
+            account = pb2.Account(username=username, password='pw')
+            self.service.CreateAccount(account, self.context)
+            self.service.Login(account, self.context)
+        send = lambda text: asyncio.run(self.service.SendMessage(pb2.MessageInfo(source='asdfk', destination='yessir', text=text), self.context))
+        send('queued')
+
+        async def listen():
+            stream = self.service.ListenMessages(pb2.Account(username='yessir'), self.context)
+            first = await anext(stream)
+            await asyncio.get_running_loop().run_in_executor(None, send, 'live')
+            second = await asyncio.wait_for(anext(stream), 5)
+            await stream.aclose()
+            return [first.text, second.text]
+
+        self.assertEqual(asyncio.run(listen()), ['queued', 'live'])
+        self.assertEqual(self.service.notifier.callbacks, {})
+
+    def test_Send_message_Destination_on_other_shard_Is_delivered_there(self):
+        account = pb2.Account(username='yessir', password='pw')
+        self.service.CreateAccount(account, self.context)
+        self.service.Login(account, self.context)
+        remote = MagicMock()
+        remote.call.return_value = pb2.ServerResponse(message='delivered', error=False)
+        server.RING, server.GROUPS = HashRing(range(2)), [None, remote]
+        try:
+            destination = next(f'user{i}' for i in range(100) if server.RING.shard_for(f'user{i}') == 1)
+            message = pb2.MessageInfo(source='yessir', destination=destination, text='hi')
+            response = self.service.SendMessage(message, self.context)
+        finally:
+            server.RING, server.GROUPS = HashRing([0]), [None]
+
+        self.assertEqual(response.message, 'delivered')
+        remote.call.assert_called_once_with('DeliverMessage', message, metadata=(('forwarded', '1'),))
+        self.assertEqual(self.service.last_seq, 2)
+
+    def test_Send_messages_Sender_on_other_shard_Is_sent_there(self):
+        for username in ('yessir', 'asdfk'):
+            account = pb2.Account(username=username, password='pw')
+            self.service.CreateAccount(account, self.context)
+            self.service.Login(account, self.context)
+        remote = MagicMock()
+        remote.call.return_value = pb2.ServerResponse(message='sent', error=False)
+        server.RING, server.GROUPS = HashRing(range(2)), [None, remote]
+        try:
+            source = next(f'user{i}' for i in range(100) if server.RING.shard_for(f'user{i}') == 1)
+            remote_message = pb2.MessageInfo(source=source, destination='yessir', text='hi')
+            local_message = pb2.MessageInfo(source='asdfk', destination='yessir', text='hi')
+            response = self.service.SendMessages(iter([remote_message, local_message]), self.context)
+        finally:
+            server.RING, server.GROUPS = HashRing([0]), [None]
+
+        self.assertFalse(response.error)
+        remote.call.assert_called_once_with('SendMessages', [remote_message], metadata=(('forwarded', '1'),))
+        self.assertEqual(len(self.service.db.queued_messages('yessir')), 1)
+
+    def test_Release_then_import_account_Moves_account_and_messages(self):
+        for username in ('yessir', 'asdfk'):
+            account = pb2.Account(username=username, password='pw')
+            self.service.CreateAccount(account, self.context)
+            self.service.Login(account, self.context)
+        self.service.SendMessage(pb2.MessageInfo(source='asdfk', destination='yessir', text='hi'), self.context)
+
+        data = self.service.ReleaseAccount(pb2.Account(username='yessir'), self.context)
+        self.assertTrue(data.found)
+        self.assertEqual([m.text for m in data.messages], ['hi'])
+        self.assertIsNone(self.service.accounts.status('yessir'))
+        self.assertEqual(self.service.pending_messages('yessir'), (False, []))
+
+        self.service.ImportAccount(data, self.context)
+        self.service.ImportAccount(data, self.context)
+        self.assertEqual(self.service.pending_messages('yessir'), (True, [(data.messages[0].id, 'asdfk', 'hi')]))
+
+    def test_Assign_message_ids_Ordered_and_tagged_with_shard(self):
+        messages = [pb2.MessageInfo() for _ in range(3)]
+        server.shard_index = 5
+        try:
+            self.service.assign_message_ids(messages)
+        finally:
+            server.shard_index = 0
+        ids = [m.id for m in messages]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertTrue(all(i & ((1 << SHARD_BITS) - 1) == 5 for i in ids))
+
+    def test_Forward_Worker_other_than_lead_Hands_write_to_lead(self):
+        self.service.lead = MagicMock()
+        self.service.lead.CreateAccount.return_value = pb2.ServerResponse(message='created by the lead')
+        self.context.invocation_metadata.return_value = [('write-concern', 'all'), ('user-agent', 'grpc-python')]
+        account = pb2.Account(username='yessir', password='pw')
+
+        response = self.service.CreateAccount(account, self.context)
+        self.assertEqual(response.message, 'created by the lead')
+        self.service.lead.CreateAccount.assert_called_once_with(account, metadata=[('write-concern', 'all')])
+        self.assertEqual(self.service.applied_seq(), 0)
+
+    def test_Handle_event_Write_on_lead_Reloads_account_and_wakes_streams(self):
+        server.workers = Workers(2)
+        server.workers.worker = 1
+        follower = ChatService()
+        server.workers.worker = 0
+        try:
+            version = follower.notifier.version('yessir')
+            for username in ('yessir', 'asdfk'):
+                account = pb2.Account(username=username, password='pw')
+                self.service.CreateAccount(account, self.context)
+                self.service.Login(account, self.context)
+            self.service.SendMessage(pb2.MessageInfo(source='asdfk', destination='yessir', text='hi'), self.context)
+
+            inbox = server.workers.inboxes[1]
+            for _ in range(5):
+                follower.handle_event(inbox.get(timeout=5))
+            self.assertEqual(follower.accounts.status('yessir'), 1)
+            self.assertNotEqual(follower.notifier.version('yessir'), version)
+            self.assertEqual(follower.pending_messages('yessir')[1][0][1:], ('asdfk', 'hi'))
+            self.assertTrue(inbox.empty())
+        finally:
+            follower.db.close()
+
+
+class TestHashRing(unittest.TestCase):
+    def test_Added_shard_Only_takes_usernames(self):
+        old, new = HashRing(range(2)), HashRing(range(3))
+        usernames = [f'user{i}' for i in range(3000)]
+        moved = [u for u in usernames if old.shard_for(u) != new.shard_for(u)]
+        self.assertTrue(all(new.shard_for(u) == 2 for u in moved))
+        self.assertAlmostEqual(len(moved) / len(usernames), 1 / 3, delta=0.1)
+
+        # The moved usernames are exactly those in the ranges moved_ranges reports
+        ranges = moved_ranges(old, new)
+        in_range = lambda h: any(s <= h <= e if s <= e else h >= s or h <= e for s, e, _, _ in ranges)
+        self.assertEqual(moved, [u for u in usernames if in_range(hash_key(u))])
+
+
+class TestElection(unittest.TestCase):
+    def test_Vote_Candidate_behind_Refused(self):
+        voter = Election(1, 3, now=0.0)
+        self.assertEqual(voter.vote(1, 0, (1, 4), (1, 5), 10.0), (1, False))
+        self.assertEqual(voter.vote(1, 2, (2, 3), (1, 5), 10.0), (1, True))
+        self.assertEqual(voter.vote(1, 0, (2, 9), (1, 5), 10.0), (1, False))
+
+    def test_Vote_Leader_heard_recently_Refused(self):
+        follower = Election(1, 3, now=0.0)
+        follower.follow(1, 0, 10.0)
+        self.assertFalse(follower.vote(2, 2, (1, 0), (0, 0), 10.0 + ELECTION_TIMEOUT / 2)[1])
+        self.assertTrue(follower.vote(2, 2, (1, 0), (0, 0), 10.0 + ELECTION_TIMEOUT)[1])
+
+    def test_Simulated_partitions_Never_two_leases(self):
+        random.seed(1)
+        nodes = [Election(i, 3, now=0.0) for i in range(3)]
+        leaders = {}
+        side = set()
+        for step in range(6000):
+            now = step * 0.01
+
+            # A new partition every half second, none in the last two seconds
+            if step % 50 == 0:
+                side = set(random.sample(range(3), random.randint(0, 2))) if step < 5800 else set()
+            for node in nodes:
+                peers = [p for p in nodes if p is not node and (p.index in side) == (node.index in side)]
+                delay = lambda: now + random.uniform(0, 0.05)
+                if node.election_due(now):
+                    term = node.stand(now)
+                    answers = [p.vote(term, node.index, (0, 0), (0, 0), delay()) for p in peers]
+                    for answer_term, _ in answers:
+                        node.observe(answer_term)
+                    if node.won(term, 1 + sum(granted for _, granted in answers)):
+                        self.assertNotIn(term, leaders)
+                        leaders[term] = node.index
+                if node.role == LEADER:
+                    term = node.term
+                    answers = [p.follow(term, node.index, delay()) for p in peers]
+                    for answer_term, _ in answers:
+                        node.observe(answer_term)
+                    node.renew(term, now, 1 + sum(granted for _, granted in answers))
+            self.assertLessEqual(sum(n.has_lease(now) for n in nodes), 1)
+
+        self.assertGreater(len(leaders), 5)
+        self.assertEqual(sum(n.has_lease(now) for n in nodes), 1)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
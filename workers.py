@@ -0,0 +1,36 @@
+from multiprocessing import Event, Queue, Value
+
+
+class Workers:
+    '''
+    The processes serving one replica. They all listen on the replica's
+    port, which the kernel shares between them with SO_REUSEPORT, and read
+    the replica's SQLite database in WAL mode side by side.
+
+    Worker 0, the lead, is the replica as far as the other replicas are
+    concerned: it runs the failure detector or election, replicates and
+    applies every write, and is the only one that hands out sequence numbers
+    and message ids. The other workers serve reads and message streams
+    themselves and forward everything else to the lead over a unix socket.
+    Once a write is committed, the lead publishes the users it changed to the
+    other workers, which reload their accounts and wake up their streams.
+
+    Created before the workers are forked, so that they share the queues
+    and values.
+    '''
+    def __init__(self, count):
+        self.count = count
+        self.worker = 0                                # Index of the worker in this process
+        self.ready = Event()                           # Set once the lead has created or upgraded the database
+        self.lease = Value('d', 0.0, lock=False)       # Until when the replica acts as the primary, on monotonic time
+        self.inboxes = [Queue() for _ in range(count)] # Events published to every worker
+
+    def publish(self, *event):
+        '''Sends an event to every other worker of the replica.'''
+        for i, inbox in enumerate(self.inboxes):
+            if i != self.worker:
+                inbox.put(event)
+
+    def receive(self):
+        '''Waits for the next event another worker published to this one.'''
+        return self.inboxes[self.worker].get()